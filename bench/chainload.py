@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Load time benchmark for chain definitions and chain configs.
+
+Generates a tree of chain definition and config files and loads all of
+them without bytecode cache, with a cold (empty) and with a warm
+bytecode cache, e.g.:
+
+    python bench/chainload.py --chains 200 --steps 50
+'''
+
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import argparse
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+import conduct
+from conduct import loggers
+from conduct.application import ConductApplication
+from conduct.util import loadChainDefinition, loadChainConfig, \
+    ensureDirectory
+
+CHAIN_HEADER = '''
+description = 'Generated chain %(index)d'
+
+parameters = {
+    'basedir' : Parameter(type=str,
+                          description='Base directory',
+                          default='/tmp'),
+    'distribution' : Parameter(type=str,
+                          description='Distribution',
+                          default='jessie'),
+}
+'''
+
+CHAIN_STEP = '''
+steps.step%(step)d = Step('syscall.SystemCall',
+                    description='Generated step %(step)d',
+                    command='echo {chain.basedir}/{chain.distribution}/%(step)d')
+'''
+
+CHAIN_CONFIG = '''
+basedir = '/tmp/generated/%(index)d'
+distribution = 'wheezy'
+'''
+
+
+def generateTree(baseDir, numChains, numSteps):
+    names = []
+
+    for index in range(numChains):
+        name = 'group%d:chain%d' % (index % 10, index)
+        relPath = path.join('group%d' % (index % 10), 'chain%d.py' % index)
+
+        for subDir, content in [
+            ('chains', CHAIN_HEADER % {'index' : index} +
+                ''.join(CHAIN_STEP % {'step' : step}
+                        for step in range(numSteps))),
+            ('config', CHAIN_CONFIG % {'index' : index})]:
+            filePath = path.join(baseDir, subDir, relPath)
+            ensureDirectory(path.dirname(filePath))
+            with open(filePath, 'w') as f:
+                f.write(content)
+
+        names.append(name)
+
+    return names
+
+
+def setupApp(baseDir, bytecodeCache):
+    conduct.app = ConductApplication()
+    conduct.app.cfg.update({
+        'chaindefdir' : path.join(baseDir, 'chains'),
+        'chaincfgdir' : path.join(baseDir, 'config'),
+        'cachedir' : path.join(baseDir, 'cache'),
+        'bytecodecache' : bytecodeCache,
+    })
+    logging.setLoggerClass(loggers.ConductLogger)
+    conduct.app.log = logging.getLogger('bench')
+    conduct.app.log.addHandler(logging.NullHandler())
+
+
+def loadAll(baseDir, names, bytecodeCache):
+    # fresh application: no in-memory caches (like a new process)
+    setupApp(baseDir, bytecodeCache)
+
+    start = time.time()
+    for name in names:
+        loadChainDefinition(name)
+        loadChainConfig(name)
+    return time.time() - start
+
+
+def run(numChains, numSteps):
+    baseDir = tempfile.mkdtemp(prefix='conduct-bench-')
+    try:
+        names = generateTree(baseDir, numChains, numSteps)
+
+        uncached = loadAll(baseDir, names, 'off')
+        cold = loadAll(baseDir, names, 'on')
+        warm = loadAll(baseDir, names, 'on')
+    finally:
+        shutil.rmtree(baseDir)
+
+    print('chains: %d, steps per chain: %d' % (numChains, numSteps))
+    print('  no cache:   %.3f s' % uncached)
+    print('  cold cache: %.3f s' % cold)
+    print('  warm cache: %.3f s (%.1fx)' % (warm, uncached / warm))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chains', type=int, default=200,
+                        help='Number of generated chains')
+    parser.add_argument('--steps', type=int, default=50,
+                        help='Number of steps per chain')
+    args = parser.parse_args(argv)
+
+    run(args.chains, args.steps)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Logging throughput benchmark for the console formatter.
+
+Formats and emits records (like the output lines of a system call)
+through the console handler to /dev/null and reports records per
+second, e.g.:
+
+    python bench/logthroughput.py --records 200000 --nocolor
+'''
+
+import os
+import sys
+import time
+import logging
+import argparse
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from conduct import loggers, colors
+
+
+def run(numRecords, useColors):
+    logging.setLoggerClass(loggers.ConductLogger)
+    log = logging.getLogger('bench.step')
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+
+    if not useColors:
+        colors.nocolor()
+
+    handler = loggers.ColoredConsoleHandler()
+    handler.stream = open(os.devnull, 'w')
+    log.addHandler(handler)
+
+    record = log.makeRecord(log.name, logging.DEBUG, __file__, 0,
+                            'output line %d of a chatty command', (0,), None)
+
+    start = time.time()
+    for _ in range(numRecords):
+        handler.format(record)
+    formatTime = time.time() - start
+
+    start = time.time()
+    for i in range(numRecords):
+        log.debug('output line %d of a chatty command', i)
+    emitTime = time.time() - start
+
+    print('records: %d, colors: %s' % (numRecords, useColors))
+    print('  format only: %.0f records/s' % (numRecords / formatTime))
+    print('  log call:    %.0f records/s' % (numRecords / emitTime))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=200000,
+                        help='Number of records')
+    parser.add_argument('--nocolor', action='store_true',
+                        help='Disable colored output')
+    args = parser.parse_args(argv)
+
+    run(args.records, not args.nocolor)
+
+
+if __name__ == '__main__':
+    main()
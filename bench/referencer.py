@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Microbenchmark for the evaluation of parameter references.
+
+Creates a chain of steps with thousands of references (to the chain
+parameters, the config and the outparameters of the previous step) and
+reads all referencing parameters repeatedly, once with the compiled,
+memoized referencers and once with a plain format() per evaluation
+(the former implementation), e.g.:
+
+    python bench/referencer.py --steps 1000 --reads 2
+'''
+
+import sys
+import time
+import logging
+import argparse
+from os import path
+from collections import OrderedDict
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+import conduct
+from conduct import loggers
+from conduct.application import ConductApplication
+from conduct.buildsteps.syscall import SystemCall
+from conduct.param import Referencer, Dataholder, createReferencer
+from conduct.util.container import OrderedAttrDict
+
+
+class BenchChain(object):
+    def __init__(self, numSteps):
+        self.name = 'bench'
+        self.log = conduct.app.log
+        self.params = {'basedir' : '/tmp/bench', 'distribution' : 'jessie'}
+        self.steps = OrderedDict()
+        self.referenceContext = None
+        self.paramsVersion = 0
+
+        for index in range(numSteps):
+            params = {
+                'command' : 'echo {chain.basedir}/{chain.distribution}/'
+                            '{cfg[cachedir]}/{steps.s%d.commandoutput}'
+                            % max(index - 1, 0),
+                'workingdir' : '{chain.basedir}',
+            }
+            for name, value in params.items():
+                params[name] = createReferencer(value)
+
+            name = 's%d' % index
+            self.steps[name] = SystemCall(name, params, self)
+            self.steps[name].commandoutput = 'out%d' % index
+
+
+    def paramsChanged(self):
+        self.paramsVersion += 1
+
+
+def legacyEvaluate(self, chain, valType=str):
+    # the former implementation: copies of the contexts and a fresh
+    # parse of the format string on each evaluation
+    app = conduct.app
+    result = self.fmt.format(chain=Dataholder(chain.params),
+                             steps=Dataholder(chain.steps),
+                             app=app,
+                             cfg=OrderedAttrDict(app.cfg),
+                             sysinfo=OrderedAttrDict(app.sysinfo),
+                             buildinfo=OrderedAttrDict(app.buildinfo),
+                             )
+    return valType(result)
+
+
+def setupApp():
+    conduct.app = ConductApplication()
+    conduct.app.cfg.update({'cachedir' : 'cache', 'loglevel' : 'info'})
+    conduct.app.sysinfo.update({'arch' : 'x86_64', 'hostname' : 'bench'})
+    logging.setLoggerClass(loggers.ConductLogger)
+    conduct.app.log = logging.getLogger('bench')
+    conduct.app.log.addHandler(logging.NullHandler())
+
+
+def readAll(chain, reads):
+    start = time.time()
+    for _ in range(reads):
+        for step in chain.steps.values():
+            step.command
+            step.workingdir
+    return time.time() - start
+
+
+def run(numSteps, reads):
+    start = time.time()
+    chain = BenchChain(numSteps)
+    setup = time.time() - start
+    evaluations = numSteps * 2 * reads
+
+    compiled = readAll(chain, reads)
+
+    # no memoization at all (neither per referencer nor per step)
+    evaluate, memoKey = Referencer.evaluate, Referencer.memoKey
+    Referencer.evaluate = legacyEvaluate
+    Referencer.memoKey = lambda self, chain: None
+    try:
+        legacy = readAll(chain, reads)
+    finally:
+        Referencer.evaluate, Referencer.memoKey = evaluate, memoKey
+
+    print('steps: %d, reads: %d (%d evaluations)'
+          % (numSteps, reads, evaluations))
+    print('  chain setup: %.3f s' % setup)
+    print('  compiled:    %.3f s (%.1f us/evaluation)'
+          % (compiled, compiled / evaluations * 1e6))
+    print('  legacy:      %.3f s (%.1f us/evaluation)'
+          % (legacy, legacy / evaluations * 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--steps', type=int, default=1000,
+                        help='Number of steps in the chain')
+    parser.add_argument('--reads', type=int, default=2,
+                        help='How often each parameter is read')
+    args = parser.parse_args(argv)
+
+    setupApp()
+    run(args.steps, args.reads)
+
+
+if __name__ == '__main__':
+    main()
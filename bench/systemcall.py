@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Throughput benchmark for systemCall.
+
+Pipes a configurable amount of line based output through the SystemCall
+build step and reports wall time, throughput and the CPU time spent by
+conduct itself (relaying output), e.g.:
+
+    python bench/systemcall.py --size 512 --linelength 100 --loglevel info
+'''
+
+import sys
+import time
+import logging
+import resource
+import argparse
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+import conduct
+from conduct import loggers
+from conduct.application import ConductApplication
+from conduct.buildsteps.syscall import SystemCall
+
+
+def setupApp(loglevel):
+    conduct.app = ConductApplication()
+    logging.setLoggerClass(loggers.ConductLogger)
+    conduct.app.log = logging.getLogger('bench')
+    conduct.app.log.setLevel(loggers.LOGLEVELS[loglevel])
+    conduct.app.log.addHandler(logging.NullHandler())
+
+
+def run(sizeMb, lineLength, loglevel):
+    cmd = 'head -c %d /dev/zero | tr "\\0" "x" | fold -w %d' \
+          % (sizeMb * 1024 * 1024, lineLength)
+    step = SystemCall('bench', {'command' : cmd, 'loglevel' : loglevel})
+
+    usageBefore = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    step.run()
+    wall = time.time() - start
+    usageAfter = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (usageAfter.ru_utime - usageBefore.ru_utime) \
+        + (usageAfter.ru_stime - usageBefore.ru_stime)
+    outLen = len(step.commandoutput)
+
+    print('size: %d MB, line length: %d, loglevel: %s'
+          % (sizeMb, lineLength, loglevel))
+    print('  relayed:    %.1f MB' % (outLen / 1048576.0))
+    print('  wall:       %.2f s (%.1f MB/s)' % (wall, outLen / 1048576.0 / wall))
+    print('  conduct cpu: %.2f s' % cpu)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=256,
+                        help='Amount of output in MB')
+    parser.add_argument('--linelength', type=int, default=100,
+                        help='Length of each output line')
+    parser.add_argument('--loglevel', choices=sorted(loggers.LOGLEVELS),
+                        default='info',
+                        help='Log level of the build step (debug logs '
+                        'every output line)')
+    args = parser.parse_args(argv)
+
+    setupApp(args.loglevel)
+    run(args.size, args.linelength, args.loglevel)
+
+
+if __name__ == '__main__':
+    main()
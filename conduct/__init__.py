@@ -23,6 +23,5 @@
 import logging
 
 from conduct.util import systemCall
-from conduct.buildsteps import *
 
 app = None
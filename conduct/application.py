@@ -22,15 +22,26 @@
 
 # TODO: Refactor q&d applications!!
 
+import os
 import time
 import logging
+import multiprocessing
 import argparse
+from os import path
 from ConfigParser import SafeConfigParser
 
-from conduct import loggers
+from conduct import loggers, profiling
+from conduct.batch import BatchBuild, loadBatchFile
+from conduct.cache import StepCache
+from conduct.catalog import ChainCatalog, parameterType
 from conduct.chain import Chain
+from conduct.history import BuildHistory
+from conduct.journal import BuildJournal, chainFingerprint
+from conduct.server import BuildServer, submitBuild
+from conduct.param import boolean
 from conduct.util import getDefaultConfigPath, analyzeSystem, \
-    loadChainDefinition, loadChainConfig, chainPathToName
+    loadChainConfig, chainPathToName, getCacheDir, ensureDirectory, \
+    chainDefinitionFile
 
 
 class ConductApplication(object):
@@ -39,6 +50,8 @@ class ConductApplication(object):
         self._cfg = {}
         self._sysinfo = {}
         self._buildinfo = {}
+        self._stepcache = None
+        self._catalog = None
 
     @property
     def cfg(self):
@@ -52,11 +65,29 @@ class ConductApplication(object):
     def buildinfo(self):
         return self._buildinfo
 
+    @property
+    def stepcache(self):
+        return self._stepcache
+
+    @property
+    def catalog(self):
+        '''
+        Index of the available chains (updated on first access).
+        '''
+        if self._catalog is None:
+            self._catalog = ChainCatalog(
+                self.cfg['chaindefdir'],
+                path.join(getCacheDir('catalog', self), 'chains.pickle'))
+            self._catalog.update()
+        return self._catalog
+
     def run(self, argv=[]):
         raise NotImplementedError('Abstract application cannot be used!')
 
-    def build(self, chainName, paramOverrides= {}):
+    def build(self, chainName, paramOverrides= {}, resume=False, only=None,
+              fromStep=None, untilStep=None):
         self._analyzeSystem()
+        self._initStepCache()
         self.log.info('Build chain: %s' % chainName)
         self.log.debug('Load chain default params ...')
         chainParams = loadChainConfig(chainName)
@@ -72,22 +103,142 @@ class ConductApplication(object):
         self._buildinfo['localtime'] = time.localtime(timestamp)
         self._buildinfo['ctime'] = time.ctime(timestamp)
 
+        if boolean(self.cfg.get('profiling', 'on')):
+            profiling.startProfiling()
+
         failed = False
+        chain = None
         try:
-            chain = Chain(chainName, chainParams)
-            chain.build()
+            with profiling.measure(chainName, 'chain'):
+                chain = Chain(chainName, chainParams)
+                selection = None
+                if only or fromStep or untilStep:
+                    selection = chain.selectSteps(only, fromStep, untilStep)
+                journal = self._openJournal(chain, chainParams, resume,
+                                            selection is not None)
+                # (a resumed build stays resumable)
+                resumable = resume \
+                    or boolean(self.cfg.get('resumable', 'off'))
+                chain.build(journal, resume, selection, resumable)
         except Exception as e:
             self.log.debug(e)
             failed = True
 
+        self._writeProfile(profiling.stopProfiling(), chainName, timestamp)
+        self._recordHistory(chain, chainName, chainParams, timestamp, failed)
+
         self.log.info('')
         self.log.info('')
         self.log.info('='*80)
         self.log.info('')
         self.log.info('BUILD RESULT: %s' % 'FAILED' if failed else 'SUCCESS' )
+        loggers.flushLogs()
 
         return failed
 
+    def _openJournal(self, chain, chainParams, resume, selective):
+        '''
+        Open the build journal of the given chain (None if disabled).
+        The leftovers of a former build that is neither resumed nor
+        partially rebuilt (selective) are cleaned up.
+        '''
+        if not boolean(self.cfg.get('journal', 'on')):
+            if resume:
+                self._resumeError('Build journal disabled')
+            return None
+
+        journal = BuildJournal(
+            path.join(getCacheDir('journal', self),
+                      '%s.pickle' % chain.name.replace(':', '-')),
+            chain.name,
+            chainFingerprint(chainDefinitionFile(chain.name), chainParams))
+
+        if resume:
+            if not journal.steps:
+                self._resumeError('No unfinished build (failed builds are '
+                                  'only kept with --resumable)')
+            if not journal.valid:
+                self._resumeError('Chain definition or parameters changed '
+                                  'since the former build')
+        elif journal.steps and not selective:
+            self.log.info('Clean up the unfinished former build ...')
+            journal.cleanup(chain.log)
+
+        return journal
+
+    def _resumeError(self, reason):
+        self.log.error('Cannot resume: %s' % reason)
+        raise RuntimeError('Cannot resume: %s' % reason)
+
+    def _recordHistory(self, chain, chainName, chainParams, timestamp,
+                       failed):
+        '''
+        Store the run (and its steps) in the build history.
+        '''
+        if not boolean(self.cfg.get('history', 'on')):
+            return
+
+        steps = []
+        if chain is not None:
+            for name, step in chain.steps.items():
+                steps.append({
+                    'name' : name,
+                    'class' : type(step).__name__,
+                    'duration' : getattr(step, 'buildDuration', None),
+                    'attempts' : getattr(step, 'buildAttempts', 0),
+                    'result' : getattr(step, 'buildResult', None),
+                })
+
+        buildinfo = dict(self._buildinfo)
+        buildinfo['localtime'] = tuple(buildinfo['localtime'])
+
+        try:
+            history = self.openHistory()
+            try:
+                runId = history.record(chainName, chainParams, buildinfo,
+                                       timestamp, time.time() - timestamp,
+                                       failed, steps)
+            finally:
+                history.close()
+            self.log.info('Build run recorded: %d' % runId)
+        except Exception as e:
+            self.log.warning('Could not record build history: %s' % e)
+
+    def openHistory(self):
+        '''
+        Open the build history database (configured by the global config).
+        '''
+        return BuildHistory(
+            self.cfg.get('historydb',
+                         path.join(self.cfg['logdir'], 'history.sqlite')),
+            int(self.cfg.get('historymaxruns', 200)),
+            float(self.cfg.get('historymaxage', 90)))
+
+    def _writeProfile(self, profiler, chainName, timestamp):
+        '''
+        Log the most time consuming steps and export the timing and
+        resource usage of the build (JSON, Chrome trace events).
+        '''
+        if profiler is None:
+            return
+
+        self.log.info('')
+        self.log.info('Most time consuming steps:')
+        for line in profiler.summary('step'):
+            self.log.info(line)
+
+        profileDir = path.join(self.cfg['logdir'], 'profile')
+        prefix = path.join(profileDir, '%s-%s' % (
+            chainName.replace(':', '-'),
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))))
+
+        try:
+            ensureDirectory(profileDir)
+            for filePath in profiler.export(prefix):
+                self.log.info('Profile written: %s' % filePath)
+        except (IOError, OSError) as e:
+            self.log.warning('Could not write profile: %s' % e)
+
     def loadCfg(self, path):
         self._cfgFile = path
 
@@ -102,7 +253,43 @@ class ConductApplication(object):
         if not self._sysinfo:
             self._sysinfo = analyzeSystem()
 
-    def _initLogging(self):
+    def _initStepCache(self):
+        if self._stepcache is None and boolean(self.cfg.get('stepcache', 'on')):
+            self._stepcache = StepCache(
+                getCacheDir('steps', self),
+                int(self.cfg.get('stepcachesize', 2048)) * 1024 * 1024,
+                self.log)
+
+    def makePathsAbsolute(self):
+        '''
+        Make the configured directories independent of the working
+        directory (of the builds of worker processes).
+        '''
+        for option in ('logdir', 'cachedir', 'chaindefdir', 'chaincfgdir'):
+            if option in self.cfg:
+                self.cfg[option] = path.abspath(self.cfg[option])
+
+    def initWorker(self, workDir, logStream=None):
+        '''
+        Prepare a (forked) worker process of a batch build or of the
+        build server: own log and working directory, console output to
+        the given stream only.
+        '''
+        loggers.reinitAfterFork()
+        ensureDirectory(workDir)
+        os.chdir(workDir)
+
+        # common build history (instead of the per build log dirs)
+        self.cfg.setdefault('historydb', path.join(
+            path.abspath(self.cfg['logdir']), 'history.sqlite'))
+        self.cfg['logdir'] = path.join(workDir, 'log')
+        # builds of the same chain run concurrently (one journal per chain)
+        self.cfg['journal'] = 'off'
+        self._buildinfo = {}
+
+        self._initLogging(console=logStream is not None, stream=logStream)
+
+    def _initLogging(self, console=True, stream=None):
         '''
         Initialize custom logging and configure it by global config.
         '''
@@ -113,11 +300,20 @@ class ConductApplication(object):
         self.log.setLevel(loglevel)
 
         # console logging for fg process
-        self.log.addHandler(loggers.ColoredConsoleHandler())
+        if console:
+            handler = loggers.ColoredConsoleHandler()
+            if stream is not None:
+                handler.stream = stream
+            self.log.addHandler(handler)
 
         # logfile for fg and bg process
         self.log.addHandler(loggers.LogfileHandler(self.cfg['logdir'], 'conduct'))
 
+        # batched writes by a background thread
+        if boolean(self.cfg.get('asynclogging', 'on')):
+            loggers.enableAsyncLogging(float(self.cfg.get('logflushinterval',
+                                                 loggers.FLUSH_INTERVAL)))
+
 
 class CliApplication(ConductApplication):
     def run(self, args):
@@ -131,19 +327,33 @@ class CliApplication(ConductApplication):
             add_help=False)
 
         self._parseArgs()
+
+        if self._parsedArgs.action == 'report':
+            return self._report(self._parsedArgs)
+
+        if self._parsedArgs.action == 'submit':
+            return self._submit(self._parsedArgs)
+
         self._initLogging()
 
-        # determine param overrides
-        chainDef = loadChainDefinition(self._parsedArgs.chain)
-        paramOverrides = {}
-        for param in chainDef['parameters'].keys():
-            val = getattr(self._parsedArgs, param)
-            if val is not None:
-                paramOverrides[param] = getattr(self._parsedArgs, param)
+        if self._parsedArgs.action == 'batch':
+            return self._batch(self._parsedArgs)
+
+        if self._parsedArgs.action == 'serve':
+            return self._serve(self._parsedArgs)
 
+        paramOverrides = self._paramOverrides(self._parsedArgs)
 
         # start actual build process
-        return self.build(self._parsedArgs.chain, paramOverrides)
+        args = self._parsedArgs
+        if args.resume and (args.only or args.from_step or args.until_step):
+            self._parser.error('--resume cannot be combined with a step '
+                               'selection')
+        if args.resumable:
+            self.cfg['resumable'] = 'on'
+
+        return self.build(args.chain, paramOverrides, args.resume,
+                          args.only, args.from_step, args.until_step)
 
     def _parseArgs(self):
         '''
@@ -153,15 +363,73 @@ class CliApplication(ConductApplication):
         self._processGlobalArgs(self._args)
         self.loadCfg(self._globalArgs.global_config)
 
+        if self._globalArgs.jobs is not None:
+            self.cfg['jobs'] = self._globalArgs.jobs
+
+        if self._globalArgs.no_cache:
+            self.cfg['stepcache'] = 'off'
+
         subparsers = self._parser.add_subparsers(title='actions',
                                            description='valid actions',
                                            dest='action')
 
         build = subparsers.add_parser('build', help='Build chain')
+        build.add_argument('--resume',
+                           help='Continue the failed former build of the '
+                           'chain (with unchanged chain and parameters)',
+                           action='store_true')
+        build.add_argument('--resumable',
+                           help='Keep the state of a failed build (instead '
+                           'of cleaning up) to continue it with --resume',
+                           action='store_true')
+        build.add_argument('--only',
+                           nargs='+',
+                           metavar='STEP',
+                           help='Build only the given steps (names or glob '
+                           'patterns) and the steps they require')
+        build.add_argument('--from',
+                           dest='from_step',
+                           metavar='STEP',
+                           help='Build the steps starting with the given one '
+                           '(and the steps they require)')
+        build.add_argument('--until',
+                           dest='until_step',
+                           metavar='STEP',
+                           help='Build the steps up to the given one '
+                           '(and the steps they require)')
+        report = subparsers.add_parser('report', help='Show the build history')
+        self._addReportArgs(report)
+        batch = subparsers.add_parser('batch',
+                                      help='Build many chains concurrently')
+        self._addBatchArgs(batch)
+        serve = subparsers.add_parser('serve',
+                                      help='Run the build server')
+        self._addServeArgs(serve)
+        submit = subparsers.add_parser('submit',
+                                       help='Let the build server build '
+                                       'a chain')
+        self._addSubmitArgs(submit)
+
+        if self._globalArgs.list:
+            self._listChains()
+            self._parser.exit()
+
+        if self._globalArgs.completion:
+            self._printCompletion(self._globalArgs.chain)
+            self._parser.exit()
+
+        if self._specArgs[:1] in (['report'], ['batch'], ['serve']):
+            # (report: optional chain filter; batch: chains in batch file;
+            # serve: chains requested by the clients)
+            self._parsedArgs = self._parser.parse_args(self._args)
+            return
+
+        if not self._globalArgs.chain:
+            self._parser.error('argument -c/--chain is required')
 
         # add chain specific params
-        if self._globalArgs.chain:
-            self._addChainArgs(build, self._globalArgs.chain)
+        self._addChainArgs(build, self._globalArgs.chain)
+        self._addChainArgs(submit, self._globalArgs.chain)
 
         self._parsedArgs = self._parser.parse_args(self._args)
 
@@ -178,8 +446,28 @@ class CliApplication(ConductApplication):
         self._parser.add_argument('-c',
                             '--chain',
                             type=chainPathToName,
-                            help='Desired chain',
-                            required=True)
+                            help='Desired chain')
+
+        self._parser.add_argument('-l',
+                            '--list',
+                            help='List the available chains',
+                            action='store_true')
+
+        self._parser.add_argument('--completion',
+                            help='Print the chain names (or with -c: the '
+                            'chain arguments) for shell completion',
+                            action='store_true')
+
+        self._parser.add_argument('-j',
+                            '--jobs',
+                            type=int,
+                            help='Number of steps that may be built '
+                            'concurrently (parallel chains only)',
+                            default=None)
+
+        self._parser.add_argument('--no-cache',
+                            help='Do not use the step result cache',
+                            action='store_true')
 
         self._parser.add_argument('-h',
                             '--help',
@@ -187,32 +475,301 @@ class CliApplication(ConductApplication):
                             action='store_true')
 
         # parse global args
-        self._globalArgs, specArgs = self._parser.parse_known_args(argv)
+        self._globalArgs, self._specArgs = self._parser.parse_known_args(argv)
 
         # handle help stuff
-        if self._globalArgs.help and not specArgs:
+        if self._globalArgs.help and not self._specArgs:
             self._parser.print_help()
             print('')
-            print('Available subcommands: build')
+            print('Available subcommands: build, report, batch, serve, '
+                  'submit')
             self._parser.exit()
 
     def _addChainArgs(self, subparser, chainName):
         '''
         Add parameters of given chain (by name) as arguments to the argparse self._parser.
         '''
-        chainDef = loadChainDefinition(chainName)
+        chainInfo = self.catalog.get(chainName)
+        subparser.description = chainInfo['description']
 
-        for paramName, paramDef in chainDef['parameters'].items():
+        for paramName, paramInfo in chainInfo['parameters'].items():
             flag = '--%s' % paramName
             subparser.add_argument(
                 flag,
-                type=paramDef.type,
-                help=paramDef.description,
+                type=parameterType(paramInfo),
+                help=paramInfo['description'],
                 #required=(paramDef.default == None), # may be part of param file
             )
 
+    def _paramOverrides(self, args):
+        '''
+        The chain parameters given on the command line.
+        '''
+        chainInfo = self.catalog.get(args.chain)
+        paramOverrides = {}
+        for param in chainInfo['parameters'].keys():
+            val = getattr(args, param)
+            if val is not None:
+                paramOverrides[param] = val
+        return paramOverrides
+
+    def _addReportArgs(self, subparser):
+        subparser.description = ('List the recorded builds (of the chain '
+                                 'given by -c), show the steps of one run '
+                                 'or compare the steps of two runs')
+        subparser.add_argument('runs',
+                               type=int,
+                               nargs='*',
+                               metavar='RUN',
+                               help='Run id (show its steps) or two run ids '
+                               '(compare them)')
+        subparser.add_argument('--latest',
+                               help='Compare the newest run with the '
+                               'previous run of the same chain',
+                               action='store_true')
+        subparser.add_argument('-n',
+                               '--limit',
+                               type=int,
+                               help='Number of listed runs',
+                               default=20)
+        subparser.add_argument('--threshold',
+                               type=float,
+                               help='Duration increase (percent) of a step '
+                               'that counts as regression',
+                               default=20.0)
+        subparser.add_argument('--min-delta',
+                               type=float,
+                               help='Duration increase (s) below which a step '
+                               'never counts as regression',
+                               default=1.0)
+
+    def _addBatchArgs(self, subparser):
+        subparser.description = ('Build the chains (with parameter '
+                                 'overrides) listed in the given batch file '
+                                 'concurrently, each in its own process, '
+                                 'log and working directory')
+        subparser.add_argument('file',
+                               help='Batch file (python file defining the '
+                               'list builds = [(chain, {param: value}), ...])')
+        subparser.add_argument('-w',
+                               '--workers',
+                               type=int,
+                               help='Number of concurrent builds '
+                               '(default: cfg batchworkers or number of CPUs)',
+                               default=None)
+        subparser.add_argument('--batch-dir',
+                               help='Directory for the logs and working '
+                               'directories of the builds (default: '
+                               '<logdir>/batch/<time>)',
+                               default=None)
+
+    def _addServeArgs(self, subparser):
+        subparser.description = ('Serve build requests (see submit) on a '
+                                  'Unix socket, with the chain definitions '
+                                  'and system info kept loaded. Identical '
+                                  'pending requests are built once.')
+        subparser.add_argument('--socket',
+                               help='Socket path (default: cfg serversocket '
+                               'or <cachedir>/server.sock)',
+                               default=None)
+        subparser.add_argument('-w',
+                               '--workers',
+                               type=int,
+                               help='Number of concurrent builds '
+                               '(default: cfg serverworkers or 1)',
+                               default=None)
+        subparser.add_argument('--serve-dir',
+                               help='Directory for the logs and working '
+                               'directories of the builds (default: '
+                               '<logdir>/serve)',
+                               default=None)
+
+    def _addSubmitArgs(self, subparser):
+        subparser.add_argument('--socket',
+                               help='Socket path of the build server '
+                               '(default: cfg serversocket or '
+                               '<cachedir>/server.sock)',
+                               default=None)
+        subparser.add_argument('--priority',
+                               type=int,
+                               help='Requests with higher priority are '
+                               'built first',
+                               default=0)
+
+    def _serverSocket(self, args):
+        return args.socket or self.cfg.get(
+            'serversocket', path.join(getCacheDir('server', self),
+                                      'server.sock'))
+
+    def _serve(self, args):
+        '''
+        The serve subcommand (until interrupted).
+        '''
+        workers = args.workers or int(self.cfg.get('serverworkers', 1))
+        serveDir = args.serve_dir or path.join(self.cfg['logdir'], 'serve')
+
+        try:
+            server = BuildServer(self, self._serverSocket(args), workers,
+                                 serveDir)
+            server.run()
+        except Exception as e:
+            self.log.error('Build server failed: %s' % e)
+            loggers.flushLogs()
+            return True
+
+        return False
+
+    def _submit(self, args):
+        '''
+        The submit subcommand: build by the server, stream its log.
+        Returns True if the build failed.
+        '''
+        try:
+            return submitBuild(self._serverSocket(args), args.chain,
+                               self._paramOverrides(args), args.priority)
+        except RuntimeError as e:
+            self._parser.exit(1, '%s\n' % e)
 
+    def _batch(self, args):
+        '''
+        The batch subcommand. Returns True if any build failed.
+        '''
+        workers = args.workers or int(self.cfg.get(
+            'batchworkers', multiprocessing.cpu_count()))
+        batchDir = args.batch_dir or path.join(
+            self.cfg['logdir'], 'batch', time.strftime('%Y%m%d-%H%M%S'))
 
+        try:
+            builds = loadBatchFile(args.file)
+            batch = BatchBuild(self, builds, workers, batchDir)
+            batch.run()
+        except Exception as e:
+            self.log.error('Batch build failed: %s' % e)
+            loggers.flushLogs()
+            return True
 
+        self.log.info('')
+        self.log.info('=' * 80)
+        for line in batch.summary():
+            self.log.info(line)
+        loggers.flushLogs()
 
+        return any(entry['failed'] for entry in batch.results)
 
+    def _report(self, args):
+        '''
+        The report subcommand. Returns True if a comparison found
+        regressions.
+        '''
+        history = self.openHistory()
+        try:
+            runIds = args.runs
+            if args.latest:
+                chain = args.chain
+                if chain is None:
+                    # chain of the newest run
+                    chain = ([row['chain'] for row in history.runs(None, 1)]
+                             or [None])[0]
+                runIds = [row['id'] for row in history.runs(chain, 2)]
+                if len(runIds) < 2:
+                    self._parser.exit(1, 'Not enough recorded runs\n')
+                runIds.reverse()
+
+            if not runIds:
+                self._printRuns(history.runs(args.chain, args.limit))
+            elif len(runIds) == 1:
+                self._printRun(history, runIds[0])
+            elif len(runIds) == 2:
+                return self._printComparison(history, runIds[0], runIds[1],
+                                             args.threshold, args.min_delta)
+            else:
+                self._parser.error('at most two runs can be compared')
+        except RuntimeError as e:
+            self._parser.exit(1, '%s\n' % e)
+        finally:
+            history.close()
+
+        return False
+
+    def _printRuns(self, runs):
+        print('%6s  %-19s  %10s  %-7s  %s'
+              % ('RUN', 'STARTED', 'DURATION', 'RESULT', 'CHAIN'))
+        for row in runs:
+            print('%6d  %-19s  %9.1fs  %-7s  %s'
+                  % (row['id'], _formatTimestamp(row['started']),
+                     row['duration'], row['result'], row['chain']))
+
+    def _printRun(self, history, runId):
+        run = history.run(runId)
+        print('Run:        %d' % run['id'])
+        print('Chain:      %s' % run['chain'])
+        print('Started:    %s' % _formatTimestamp(run['started']))
+        print('Duration:   %.1fs' % run['duration'])
+        print('Result:     %s' % run['result'])
+        print('Parameters: %s' % run['params'])
+        print('')
+        print('%-30s  %-20s  %10s  %8s  %s'
+              % ('STEP', 'CLASS', 'DURATION', 'ATTEMPTS', 'RESULT'))
+        for row in history.steps(runId):
+            print('%-30s  %-20s  %10s  %8d  %s'
+                  % (row['name'], row['class'],
+                     _formatDuration(row['duration']), row['attempts'],
+                     row['result'] or 'not built'))
+
+    def _printComparison(self, history, oldRunId, newRunId, threshold,
+                         minDelta):
+        old, new = history.run(oldRunId), history.run(newRunId)
+        print('Compare run %d (%s, %s) with run %d (%s, %s)'
+              % (old['id'], old['chain'], _formatTimestamp(old['started']),
+                 new['id'], new['chain'], _formatTimestamp(new['started'])))
+        print('')
+        print('%-30s  %10s  %10s  %10s  %8s'
+              % ('STEP', 'OLD', 'NEW', 'DELTA', ''))
+
+        regressions = 0
+        for entry in history.compare(oldRunId, newRunId, threshold, minDelta):
+            delta = entry['delta']
+            flag = ''
+            if entry['regressed']:
+                flag = 'SLOWER'
+                regressions += 1
+            elif entry['old'] is None or entry['new'] is None:
+                flag = 'new' if entry['old'] is None else 'removed'
+
+            print('%-30s  %10s  %10s  %10s  %8s'
+                  % (entry['name'],
+                     _formatDuration(entry['old'] and entry['old']['duration']),
+                     _formatDuration(entry['new'] and entry['new']['duration']),
+                     '' if delta is None else '%+.1fs' % delta,
+                     flag))
+
+        print('')
+        print('%d step(s) regressed by more than %.0f%% (and %.1fs)'
+              % (regressions, threshold, minDelta))
+        return regressions > 0
+
+    def _listChains(self):
+        chains = self.catalog.chains
+        width = max([len(name) for name in chains] or [0])
+
+        for name, chainInfo in chains.items():
+            if 'error' in chainInfo:
+                print('%-*s  (broken: %s)' % (width, name, chainInfo['error']))
+            else:
+                print('%-*s  %s' % (width, name, chainInfo['description']))
+
+    def _printCompletion(self, chainName):
+        if chainName:
+            for paramName in self.catalog.get(chainName)['parameters']:
+                print('--%s' % paramName)
+        else:
+            for name in self.catalog.chains:
+                print(name)
+
+
+def _formatTimestamp(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def _formatDuration(duration):
+    return '-' if duration is None else '%.1fs' % duration
@@ -0,0 +1,208 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Batch builds: many chain builds (chain, parameter overrides) at once,
+on a pool of worker processes.
+
+A batch file is a python file defining the list 'builds':
+
+    builds = [
+        ('frm2:debpkg', {'project' : 'nicos'}),
+        ('frm2:debpkg', {'project' : 'taco', 'distribution' : 'jessie'}),
+    ]
+'''
+
+import os
+import time
+import traceback
+import multiprocessing
+from os import path
+
+import conduct
+from conduct import loggers
+from conduct.util import loadPyFile, loadChainDefinition, loadChainConfig, \
+    ensureDirectory, chainPathToName
+
+# a year (the wait for results has to be interruptible)
+RESULT_TIMEOUT = 3600 * 24 * 365
+
+
+def loadBatchFile(filePath):
+    '''
+    Load the builds (list of (chain name, parameter overrides)) of the
+    given batch file.
+    '''
+    ns = loadPyFile(filePath)
+
+    if 'builds' not in ns:
+        raise RuntimeError('%s: No builds defined' % filePath)
+
+    result = []
+    for entry in ns['builds']:
+        if isinstance(entry, basestring):
+            entry = (entry, {})
+        chainName, overrides = entry
+        result.append((chainPathToName(chainName), dict(overrides)))
+
+    return result
+
+
+class BatchBuild(object):
+    '''
+    Builds the given invocations (chain name, parameter overrides) on the
+    given number of worker processes. Each build runs in a fresh process
+    (forked from the prepared application: chain definitions and system
+    info are shared) with its own log and working directory.
+    '''
+
+    def __init__(self, app, builds, workers, batchDir):
+        self.app = app
+        self.builds = builds
+        self.workers = max(workers, 1)
+        self.batchDir = path.abspath(batchDir)
+        self.results = []
+
+    def run(self):
+        '''
+        Run all builds. Returns the results (dicts, in order of the
+        invocations).
+        '''
+        self._prepare()
+        log = self.app.log
+
+        log.info('Batch build: %d build(s) on %d worker(s)'
+                 % (len(self.builds), self.workers))
+        log.info('Batch directory: %s' % self.batchDir)
+
+        loggers.flushLogs()
+        pool = multiprocessing.Pool(self.workers, maxtasksperchild=1)
+        try:
+            pending = []
+            for index, (chainName, overrides) in enumerate(self.builds):
+                workDir = path.join(self.batchDir, '%03d-%s'
+                                    % (index + 1,
+                                       chainName.replace(':', '-')))
+                pending.append(pool.apply_async(
+                    _buildWorker, (index + 1, chainName, overrides,
+                                   workDir)))
+
+            for entry in pending:
+                result = entry.get(RESULT_TIMEOUT)
+                self.results.append(result)
+                log.info('[%d/%d] %s %s: %s (%.1f s)'
+                         % (result['index'], len(self.builds),
+                            result['chain'],
+                            _formatOverrides(result['overrides']),
+                            'FAILED' if result['failed'] else 'SUCCESS',
+                            result['duration']))
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return self.results
+
+    def summary(self):
+        '''
+        Lines of the aggregated pass/fail summary.
+        '''
+        failed = [entry for entry in self.results if entry['failed']]
+
+        lines = ['%4s  %-7s  %8s  %-20s  %s'
+                 % ('#', 'RESULT', 'DURATION', 'CHAIN', 'PARAMETERS')]
+        for entry in self.results:
+            lines.append('%4d  %-7s  %7.1fs  %-20s  %s'
+                         % (entry['index'],
+                            'FAILED' if entry['failed'] else 'SUCCESS',
+                            entry['duration'], entry['chain'],
+                            _formatOverrides(entry['overrides'])))
+        lines.append('')
+        lines.append('%d of %d build(s) failed'
+                     % (len(failed), len(self.results)))
+        for entry in failed:
+            lines.append('  %d: %s (log: %s)'
+                         % (entry['index'], entry['error'] or 'FAILED',
+                            entry['workdir']))
+        return lines
+
+    def _prepare(self):
+        '''
+        Prepare the application for the workers: the definitions and
+        configs of the chains and the system info are loaded once (and
+        inherited by the worker processes), relative paths are made
+        absolute.
+        '''
+        app = self.app
+        ensureDirectory(self.batchDir)
+
+        app.makePathsAbsolute()
+
+        app._analyzeSystem()
+
+        for chainName, overrides in self.builds:
+            chainInfo = app.catalog.get(chainName)
+            unknown = set(overrides) - set(chainInfo['parameters'])
+            if unknown:
+                raise RuntimeError('%s: Unknown parameter(s): %s'
+                                   % (chainName, ', '.join(sorted(unknown))))
+            loadChainDefinition(chainName)
+            loadChainConfig(chainName)
+
+
+def _buildWorker(index, chainName, overrides, workDir):
+    '''
+    Build one chain (in a pool process).
+    '''
+    app = conduct.app
+    result = {
+        'index' : index,
+        'chain' : chainName,
+        'overrides' : overrides,
+        'workdir' : workDir,
+        'failed' : True,
+        'error' : None,
+        'duration' : 0.0,
+    }
+
+    start = time.time()
+    try:
+        app.initWorker(workDir)
+        result['failed'] = bool(app.build(chainName, overrides))
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        try:
+            app.log.error(traceback.format_exc())
+        except Exception:
+            pass
+    finally:
+        result['duration'] = time.time() - start
+        loggers.disableAsyncLogging()
+
+    return result
+
+
+def _formatOverrides(overrides):
+    return ', '.join('%s=%s' % (key, overrides[key])
+                     for key in sorted(overrides))
@@ -20,9 +20,16 @@
 #
 # *****************************************************************************
 
+import time
+
 import conduct
-from conduct.loggers import LOGLEVELS, INVLOGLEVELS
-from conduct.param import Parameter, oneof, Referencer
+from conduct import profiling
+from conduct.loggers import LOGLEVELS, INVLOGLEVELS, flushLogs
+from conduct.param import Parameter, oneof, listof, Referencer
+
+# parameters that don't influence the result of a build step
+CACHE_NEUTRAL_PARAMS = ('description', 'loglevel', 'retries', 'condition',
+                        'after', 'before', 'cache')
 
 class BuildStepMeta(type):
     '''
@@ -36,8 +43,8 @@ class BuildStepMeta(type):
         mcls._mergeDictAttr('parameters', bases, attrs)
         mcls._mergeDictAttr('outparameters', bases, attrs)
 
-        mcls._createProperties(attrs['parameters'], attrs)
-        mcls._createProperties(attrs['outparameters'], attrs)
+        mcls._createProperties(attrs['parameters'], bases, attrs)
+        mcls._createProperties(attrs['outparameters'], bases, attrs)
 
 
         cls = type.__new__(mcls, name, bases, attrs)
@@ -64,47 +71,90 @@ class BuildStepMeta(type):
         attrs[name] = attr
 
     @classmethod
-    def _createProperties(mcls, paramDict, attrs):
+    def _createProperties(mcls, paramDict, bases, attrs):
         for name, definition in paramDict.items():
-            mcls._createProperty(name, definition, attrs)
+            mcls._createProperty(name, definition, bases, attrs)
+
+
+    @classmethod
+    def _findHook(mcls, hookName, bases, attrs):
+        '''
+        Determine the custom doRead/doWrite function of the class
+        (or its bases) at class creation.
+        '''
+        if hookName in attrs:
+            return attrs[hookName]
+
+        for base in bases:
+            hook = getattr(base, hookName, None)
+            if hook is not None:
+                # unbound method -> plain function
+                return getattr(hook, '__func__', hook)
 
+        return None
 
     @classmethod
-    def _createProperty(mcls, paramName, paramDef, attrs):
+    def _createProperty(mcls, paramName, paramDef, bases, attrs):
         capitalParamName = paramName.capitalize()
 
         # set default value for parameter
         #if paramDef.default is not None:
         #    attrs['_params'][paramName] = paramDef.default
 
+        readHook = mcls._findHook('doRead%s' % capitalParamName, bases, attrs)
+        writeHook = mcls._findHook('doWrite%s' % capitalParamName, bases,
+                                   attrs)
+
         # create parameter read function
         def readFunc(self):
-            if hasattr(self, 'doRead%s' % capitalParamName):
-                return getattr(self, 'doRead%s' % capitalParamName)()
+            if readHook is not None:
+                return readHook(self)
 
             value = self._params.get(paramName, paramDef.default)
 
             # resolve references
             if isinstance(value, Referencer):
+                key = value.memoKey(self.chain)
+
+                if key is not None:
+                    cached = self._resolved.get(paramName)
+                    if cached is not None and cached[0] == key:
+                        return cached[1]
+
                 # resolve and validate
                 value = paramDef.type(value.evaluate(self.chain))
 
+                if key is not None:
+                    self._resolved[paramName] = (key, value)
+
             return value
         readFunc.__name__ = '_readParam%s' % capitalParamName
 
         # create parameter write function
         def writeFunc(self, value):
+            self._resolved.pop(paramName, None)
+
+            if isinstance(value, Referencer):
+                if writeHook is not None:
+                    # the hook gets the resolved value before the build
+                    # (see _applyReferencedHooks)
+                    self._referencedHooks[paramName] = value
+                else:
+                    # resolved and validated on read
+                    self._params[paramName] = value
+                self._paramsChanged()
+                return
+
+            self._referencedHooks.pop(paramName, None)
             try:
-                validValue = paramDef.type(value)
-                if hasattr(self, 'doWrite%s' % capitalParamName):
-                    getattr(self, 'doWrite%s' % capitalParamName)(validValue)
+                value = paramDef.type(value)
+                if writeHook is not None:
+                    writeHook(self, value)
                 else:
-                    # special handling for references
-                    if not isinstance(value, Referencer):
-                        value = paramDef.type(value)
                     self._params[paramName] = value
             except ValueError as e:
                 raise ValueError('Cannot set %s: %s' % (paramName, e))
+            self._paramsChanged()
         writeFunc.__name__ = '_writeParam%s' % capitalParamName
         # create parameter property
         attrs[paramName] = property(readFunc, writeFunc)
@@ -113,6 +163,13 @@ class BuildStepMeta(type):
 class BuildStep(object):
     __metaclass__ = BuildStepMeta
 
+    # Results of pure steps (no side effects besides their outparameters)
+    # are cached by default, the ones of other steps only if their output
+    # artifacts are declared (cacheoutputs). Steps whose results can't be
+    # restored at all (e.g. mounts) are not cacheable.
+    cacheable = True
+    pure = False
+
     parameters = {
         'description' : Parameter(type=str,
                                   description='Build step description',
@@ -128,6 +185,27 @@ class BuildStep(object):
                                   description='Precondition for this build '
                                   'step. Step will be skipped if not fulfilled',
                                   default=''),
+        'after' : Parameter(type=listof(str),
+                                  description='Steps that have to be built '
+                                  'before this one (in addition to the '
+                                  'referenced ones)',
+                                  default=[]),
+        'before' : Parameter(type=listof(str),
+                                  description='Steps that have to be built '
+                                  'after this one',
+                                  default=[]),
+        'cache' : Parameter(type=bool,
+                                  description='Use the step result cache '
+                                  '(if the step is cacheable)',
+                                  default=True),
+        'cacheinputs' : Parameter(type=listof(str),
+                                  description='Input files/directories '
+                                  'the step result depends on',
+                                  default=[]),
+        'cacheoutputs' : Parameter(type=listof(str),
+                                  description='Output files/directories '
+                                  'that are restored from the cache',
+                                  default=[]),
     }
 
     outparameters = {
@@ -137,8 +215,22 @@ class BuildStep(object):
         self.name = name
         self.chain = chain # Maintain a reference to the chain (for refs)
         self.wasRun = False
+        self.wasRestored = False # result restored from the step cache
+
+        # outcome of the last build (see build history)
+        # success, restored, resumed, failed, skipped, coalesced
+        self.buildResult = None
+        self.buildDuration = None # s
+        self.buildAttempts = 0
+
+        # steps that are built together with this one (see canCoalesce)
+        self.coalesced = []
+        self.coalescedInto = None
 
         self._params = {}
+        self._resolved = {} # param name -> (memo key, resolved value)
+        # param name -> reference to resolve for the doWrite<Param> hook
+        self._referencedHooks = {}
 
         self._initLogger()
         self._applyParams(paramValues)
@@ -150,37 +242,50 @@ class BuildStep(object):
         This method is a wrapper around run() that does some logging and
         exception handling.
         '''
+        self._applyReferencedHooks()
+
         # log some bs stuff
         self.log.info('=' * 80)
         self.log.info('Build: %s' % self.name)
         self.log.info(self.description)
         self.log.info('-' * 80)
 
+        if self.coalescedInto is not None:
+            self.log.info('Built together with %s; Skip'
+                          % self.coalescedInto.name)
+            self.buildResult = 'coalesced'
+            return
+
         if not self._isConditionFulfilled():
             self.log.info('Precondition not fulfilled; Skip')
+            self.buildResult = 'skipped'
             return
 
-        success = False
+        started = time.time()
+        with profiling.measure(self.name, 'step',
+                               chain=getattr(self.chain, 'name', None),
+                               step=type(self).__name__) as span:
+            success = self._buildAttempts()
+            if span is not None:
+                span.args['restored'] = self.wasRestored
+                span.failed = not success
+        self.buildDuration = time.time() - started
 
-        for i in range(0, self.retries +1):
-            try:
-                # execute actual build actions
-                self.run()
-                self.wasRun = True
-                success = True
-                break
-            except Exception as exc:
-                self.log.exception(exc)
-
-                # handle retries
-                if self.retries > i:
-                    self.log.warn('Failed; Retry %s/%s' % (i+1, self.retries))
+        if not success:
+            self.buildResult = 'failed'
+        elif self.wasRestored:
+            self.buildResult = 'restored'
+        else:
+            self.buildResult = 'success'
 
         # log some bs stuff
         self.log.info('')
         self.log.info('%s' % 'SUCCESS' if success else 'FAILED')
         self.log.info('')
 
+        # step boundary: write the pending (async) log records
+        flushLogs()
+
         if not success:
             raise RuntimeError('Build step failed')
 
@@ -206,7 +311,9 @@ class BuildStep(object):
 
         resultStr = 'SUCCESS'
         try:
-            self.cleanup()
+            with profiling.measure(self.name, 'cleanup',
+                                   chain=getattr(self.chain, 'name', None)):
+                self.cleanup()
             self.wasRun = False
         except Exception as exc:
             resultStr = 'FAILED'
@@ -217,7 +324,70 @@ class BuildStep(object):
             self.log.info('')
             self.log.info('%s' % resultStr)
             self.log.info('')
+            flushLogs()
+
+
+    def _buildAttempts(self):
+        '''
+        Restore the step's result from the cache or run it (with retries).
+        Returns whether the step succeeded.
+        '''
+        cacheKey = self._determineCacheKey()
+        success = cacheKey is not None and self._restoreFromCache(cacheKey)
+
+        for i in range(0, 0 if success else self.retries +1):
+            self.buildAttempts = i + 1
+            try:
+                # execute actual build actions
+                with profiling.measure('%s #%d' % (self.name, i + 1),
+                                       'attempt', attempt=i + 1):
+                    self.run()
+                self.wasRun = True
+                for step in self.coalesced:
+                    step.wasRun = True
+                success = True
+                break
+            except Exception as exc:
+                self.log.exception(exc)
+
+                # handle retries
+                if self.retries > i:
+                    self.log.warn('Failed; Retry %s/%s' % (i+1, self.retries))
+
+        if success and cacheKey is not None and not self.wasRestored:
+            self._storeToCache(cacheKey)
+
+        return success
 
+    def journalEntry(self):
+        '''
+        The state of the (built) step for the build journal: class,
+        resolved parameters, outparameters and whether its leftovers
+        still need a cleanup.
+        '''
+        cls = type(self)
+        params = {}
+        for name in self.parameters:
+            params[name] = getattr(self, name)
+
+        return {
+            'class' : '%s.%s' % (cls.__module__, cls.__name__),
+            'params' : params,
+            'outparams' : self._outparams(),
+            'wasRun' : self.wasRun,
+        }
+
+    def restoreJournalEntry(self, entry):
+        '''
+        Restore the state of a step built by a former (resumed) build.
+        '''
+        self._params.update(entry['outparams'])
+        self._resolved.clear()
+        self._paramsChanged()
+        # (False if already cleaned up, e.g. by generic.TriggerCleanup)
+        self.wasRun = entry.get('wasRun', True)
+        self.buildResult = 'resumed'
+        self.log.info('Result restored from build journal')
 
     def cleanup(self):
         '''
@@ -242,6 +412,56 @@ class BuildStep(object):
         level = self.log.getEffectiveLevel()
         return INVLOGLEVELS[level]
 
+    def cacheInputs(self):
+        '''
+        Input files/directories the result of this step depends on.
+        May be extended by the specific build steps.
+        '''
+        return list(self.cacheinputs)
+
+    def canCoalesce(self, other):
+        '''
+        Whether the given (adjacent, following) step can be built together
+        with this one (in chains with coalesce = True).
+        May be overwritten by the specific build steps.
+        '''
+        return False
+
+    def coalesce(self, other):
+        '''
+        Build the given step together with this one.
+        '''
+        self.coalesced.append(other)
+        other.coalescedInto = self
+
+    @property
+    def chrootSessions(self):
+        '''
+        The chain's chroot session manager (if any).
+        '''
+        return getattr(self.chain, 'chroots', None)
+
+    def implicitDependencies(self):
+        '''
+        Names of the chain's steps this step depends on, in addition to the
+        referenced ones and the after/before hints.
+        May be overwritten by the specific build steps.
+        '''
+        return []
+
+    def _applyReferencedHooks(self):
+        '''
+        Pass the resolved values of referencing parameters to their
+        doWrite<Param> hooks (references can't be resolved before the
+        referenced steps are built).
+        '''
+        for name, value in self._referencedHooks.items():
+            setattr(self, name, value.evaluate(self.chain))
+
+    def _paramsChanged(self):
+        if self.chain is not None:
+            self.chain.paramsChanged()
+
     def _initLogger(self):
         if self.chain is not None:
             self.log = self.chain.log.getChild(self.name)
@@ -258,6 +478,84 @@ class BuildStep(object):
                 raise RuntimeError('%s: Mandatory parameter %s is missing'
                                    % (self.name, name))
 
+    def _determineCacheKey(self):
+        '''
+        Determine the step's cache key (None if the step shall not be
+        cached).
+        '''
+        stepCache = conduct.app.stepcache
+
+        if stepCache is None or not self.cacheable or not self.cache \
+            or self.coalesced or not (self.pure or self.cacheoutputs):
+            return None
+
+        cls = type(self)
+        params = {}
+        for name in self.parameters:
+            if name not in CACHE_NEUTRAL_PARAMS:
+                params[name] = getattr(self, name)
+
+        try:
+            key = stepCache.computeKey('%s.%s' % (cls.__module__,
+                                                  cls.__name__),
+                                       params,
+                                       self.cacheInputs())
+        except Exception as e:
+            self.log.warning('Could not determine cache key: %s' % e)
+            return None
+
+        self.log.debug('Cache key: %s' % key)
+        return key
+
+    def _restoreFromCache(self, key):
+        try:
+            outparams = conduct.app.stepcache.restore(key, self.cacheoutputs)
+        except Exception as e:
+            self.log.warning('Could not restore result from cache: %s' % e)
+            return False
+
+        if outparams is None:
+            return False
+
+        self._params.update(outparams)
+        self._resolved.clear()
+        self._paramsChanged()
+        self.wasRun = True
+        self.wasRestored = True
+        self.log.info('Result restored from cache')
+        return True
+
+    def _storeToCache(self, key):
+        try:
+            conduct.app.stepcache.store(key, self._outparams(),
+                                        self.cacheoutputs)
+        except Exception as e:
+            self.log.warning('Could not store result to cache: %s' % e)
+
+    def _outparams(self):
+        outparams = {}
+        for name in self.outparameters:
+            if name in self._params:
+                outparams[name] = self._params[name]
+        return outparams
+
+    def _rawParam(self, name):
+        '''
+        Unresolved parameter value (the format string for references).
+        '''
+        value = self._params.get(name, self.parameters[name].default)
+        if isinstance(value, Referencer):
+            return value.fmt
+        return value
+
+    def _releaseChroots(self, dirpath):
+        '''
+        Unmount the pseudo file systems of all chroots inside the given
+        directory (necessary before removing or unmounting it).
+        '''
+        if self.chrootSessions is not None:
+            self.chrootSessions.teardown(dirpath, self.log)
+
     def _isConditionFulfilled(self):
         if not self.condition:
             return True
@@ -20,22 +20,37 @@
 #
 # *****************************************************************************
 
+import re
 import shutil
 import time
 import hashlib
+import tempfile
 
 import os
 from os import path
+from collections import OrderedDict
 
 import conduct
 
 from conduct.buildsteps.base import BuildStep
-from conduct.util import systemCall, chrootedSystemCall
+from conduct.util import systemCall, chrootedSystemCall, getCacheDir
 from conduct.param import Parameter, oneof, listof
 
+# patterns to find the culprits of failed apt transactions
+APT_FAILURE_PATTERNS = [
+    r'^E: Unable to locate package (\S+)',
+    r"^E: Package '(\S+)' has no installation candidate",
+    r'^ (\S+) : (?:Pre-)?Depends: ',
+    r'^dpkg: error processing (?:package |archive )?(\S+?):?\s',
+]
+
 class Debootstrap(BuildStep):
     '''
     This build step bootstraps a basic debian system to the given directory.
+
+    The downloaded packages are cached as debootstrap tarballs (keyed by
+    distribution, architecture, includes and mirror), so subsequent
+    builds only need to unpack them.
     '''
 
     parameters = {
@@ -49,19 +64,35 @@ class Debootstrap(BuildStep):
         'includes' : Parameter(type=listof(str),
                                  description='Packages to include',
                                  default=[]),
+        'mirror' : Parameter(type=str,
+                                 description='Mirror to bootstrap from '
+                                 '(debootstrap\'s default if empty)',
+                                 default=''),
+        'tarballcache' : Parameter(type=bool,
+                                 description='Use (and maintain) the cache '
+                                 'of package tarballs',
+                                 default=True),
+        'tarballmaxage' : Parameter(type=float,
+                                 description='Max age of cached package '
+                                 'tarballs (in hours)',
+                                 default=168.0),
     }
 
     def run(self):
-        cmd = 'debootstrap --verbose --arch=%s ' % self.arch
+        tarball = None
+        if self.tarballcache:
+            tarball = self._prepareTarball()
 
-        if self.includes:
-            cmd += '--include %s ' % ','.join(self.includes)
+        cmd = self._createCmd()
+
+        if tarball is not None:
+            cmd += '--unpack-tarball=%s ' % tarball
 
         if self._isForeignArch():
             # separate first and second stage
             cmd += '--foreign '
 
-        cmd += '%s %s' % (self.distribution, self.destdir)
+        cmd += '%s %s %s' % (self.distribution, self.destdir, self.mirror)
 
         self.log.info('Bootstrapping ...')
         systemCall(cmd, log=self.log)
@@ -69,6 +100,57 @@ class Debootstrap(BuildStep):
         if self._isForeignArch():
             self._strapSecondStage()
 
+    def _createCmd(self):
+        cmd = 'debootstrap --verbose --arch=%s ' % self.arch
+
+        if self.includes:
+            cmd += '--include %s ' % ','.join(self.includes)
+
+        return cmd
+
+    def _prepareTarball(self):
+        '''
+        Determine the cached package tarball for the current configuration
+        and (re)create it if necessary.
+        Returns None if no tarball is available.
+        '''
+        cacheDir = getCacheDir('debootstrap')
+        key = hashlib.sha1(repr((self.distribution,
+                                 self.arch,
+                                 sorted(self.includes),
+                                 self.mirror))).hexdigest()
+        tarball = path.join(cacheDir, '%s-%s-%s.tgz'
+                            % (self.distribution, self.arch, key[:16]))
+
+        if path.isfile(tarball):
+            age = (time.time() - path.getmtime(tarball)) / 3600.0
+            if age <= self.tarballmaxage:
+                self.log.info('Use cached package tarball: %s' % tarball)
+                return tarball
+            self.log.info('Cached package tarball expired (%.1f h)' % age)
+
+        self.log.info('Create package tarball ...')
+
+        workDir = tempfile.mkdtemp(dir=cacheDir)
+        tmpTarball = '%s.%d.tmp' % (tarball, os.getpid())
+        try:
+            cmd = self._createCmd()
+            cmd += '--make-tarball=%s ' % tmpTarball
+            cmd += '%s %s %s' % (self.distribution, workDir, self.mirror)
+            systemCall(cmd, log=self.log)
+
+            os.rename(tmpTarball, tarball)
+        except Exception as e:
+            self.log.warning('Could not create package tarball: %s' % e)
+            self.log.warning('Therefore: Bootstrap without tarball')
+            return None
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+            if path.exists(tmpTarball):
+                os.remove(tmpTarball)
+
+        return tarball
+
     def _isForeignArch(self):
         return self.arch != conduct.app.sysinfo['arch']
 
@@ -85,9 +167,21 @@ class Debootstrap(BuildStep):
                            log=self.log)
 
 class InstallDebPkg(BuildStep):
+    '''
+    This build step installs the given debian packages (or only their
+    dependencies) in one apt transaction.
+
+    Chains with coalesce = True build adjacent InstallDebPkg steps that
+    target the same chroot directory in one transaction as well.
+    '''
+
     parameters = {
         'pkg' : Parameter(type=str,
-                                 description='Package to install'),
+                                 description='Package to install',
+                                 default=''),
+        'pkgs' : Parameter(type=listof(str),
+                                 description='Packages to install',
+                                 default=[]),
         'chrootdir' : Parameter(type=str,
                                  description='Chroot directory (if desired)',
                                  default=''),
@@ -97,7 +191,8 @@ class InstallDebPkg(BuildStep):
     }
 
     def run(self):
-        self._syscall = lambda cmd: (chrootedSystemCall(self.chrootdir, cmd, log=self.log) \
+        self._syscall = lambda cmd: (chrootedSystemCall(self.chrootdir, cmd,
+            log=self.log, sessions=self.chrootSessions) \
             if self.chrootdir else systemCall(cmd, log=self.log))
         self._installCmd = 'env DEBIAN_FRONTEND=noninteractive ' \
                 'apt-get install --yes --force-yes ' \
@@ -106,27 +201,120 @@ class InstallDebPkg(BuildStep):
                 '-o Dpkg::Options::="--force-confnew" ' \
                 '%s'
 
+        # pkg -> origin (for failure attribution)
+        pkgs = self._collectPackages()
+
+        if not pkgs:
+            raise RuntimeError('No package given')
+
         if self.depsonly:
-            deps = self._determineDependencies()
+            pkgs = self._determineDependencies(pkgs)
+
+            if not pkgs:
+                self.log.info('No dependencies to install')
+                return
+
+        self._install(pkgs)
+
+    def canCoalesce(self, other):
+        if type(other) is not type(self) or self.condition or other.condition:
+            return False
+
+        for name in ('chrootdir', 'depsonly'):
+            if self._rawParam(name) != other._rawParam(name):
+                return False
+        return True
+
+    def _collectPackages(self):
+        result = OrderedDict()
 
-            for pkg in deps:
-                self._syscall(self._installCmd % pkg)
-        else:
-            # install actual pkg
-            self._syscall(self._installCmd % self.pkg)
+        for step in [self] + self.coalesced:
+            for pkg in ([step.pkg] if step.pkg else []) + step.pkgs:
+                result.setdefault(pkg, 'step %s' % step.name)
+
+        return result
+
+    def _install(self, pkgs):
+        self.log.info('Install: %s' % ' '.join(pkgs))
 
-    def _determineDependencies(self):
         try:
-            out = self._syscall('apt-cache show %s | grep Depends:' % self.pkg)
+            self._syscall(self._installCmd % ' '.join(pkgs))
+        except RuntimeError as e:
+            error = e.args[0]
+            self._attributeFailure(pkgs, '\n'.join([
+                getattr(error, 'output', ''), getattr(error, 'stderr', '')]))
+            raise
+
+    def _attributeFailure(self, pkgs, output):
+        '''
+        Determine the packages that caused a failed transaction
+        by analyzing apt's output.
+        '''
+        culprits = set()
+
+        for pattern in APT_FAILURE_PATTERNS:
+            culprits.update(re.findall(pattern, output, re.MULTILINE))
+
+        # summary of dpkg
+        match = re.search(r'^Errors were encountered while processing:\n'
+                          r'((?: .*(?:\n|$))+)', output, re.MULTILINE)
+        if match:
+            culprits.update(match.group(1).split())
+
+        # archives: /var/cache/apt/archives/pkg_version_arch.deb
+        culprits = set(path.basename(entry).split('_')[0]
+                       for entry in culprits)
+
+        failed = [pkg for pkg in pkgs if pkg in culprits]
+        others = sorted(culprits - set(failed))
+
+        for pkg in failed:
+            self.log.error('Failed package: %s (%s)' % (pkg, pkgs[pkg]))
+        if others:
+            self.log.error('Failed (indirectly installed) package(s): %s'
+                           % ', '.join(others))
+        if not culprits:
+            self.log.error('Transaction failed for: %s'
+                           % ', '.join('%s (%s)' % entry
+                                       for entry in pkgs.items()))
+
+    def _determineDependencies(self, pkgs):
+        '''
+        Determine the dependencies of all given packages at once.
+        Returns an ordered dict: dependency -> origin
+        '''
+        cmd = 'apt-cache show --no-all-versions %s' % ' '.join(pkgs)
+        try:
+            out = self._syscall(cmd)
         except RuntimeError as e:
             self.log.exception(e)
-            self.log.warn('Therefore: Assume that there are no dependencies!')
-            return [] # no deps
+            self.log.warn('Therefore: Assume that there are no dependencies '
+                          'for packages without information!')
+            out = getattr(e.args[0], 'output', '')
+
+        deps = OrderedDict()
+        for record in re.split(r'\n\s*\n', out):
+            fields = dict(re.findall(r'^([\w-]+): (.*)$', record, re.MULTILINE))
+            pkg = fields.get('Package')
 
-        out = out[9:] # strip 'Depends: '
-        depStrs = [entry.strip() for entry in out.split(',')]
+            if pkg not in pkgs:
+                continue
 
-        return [entry.split(' ')[0] for entry in depStrs]
+            depStrs = []
+            for field in ('Pre-Depends', 'Depends'):
+                if fields.get(field):
+                    depStrs += [entry.strip()
+                                for entry in fields[field].split(',')]
+
+            for entry in depStrs:
+                # first alternative, no version and arch qualifiers
+                dep = entry.split(' ')[0].split(':')[0]
+                if dep not in pkgs:
+                    deps.setdefault(dep, 'dependency of %s (%s)'
+                                    % (pkg, pkgs[pkg]))
+
+        self.log.debug('Dependencies: %s' % ', '.join(deps))
+        return deps
 
 
 class Pdebuild(BuildStep):
@@ -143,13 +331,8 @@ class Pdebuild(BuildStep):
     }
 
     def run(self):
-        cwd = os.getcwd()
-        try:
-            os.chdir(self.sourcedir)
-            cmd = 'pdebuild --configfile %s' % self.config
-            systemCall(cmd, log=self.log)
-        finally:
-            os.chdir(cwd)
+        cmd = 'pdebuild --configfile %s' % self.config
+        systemCall(cmd, log=self.log, cwd=self.sourcedir)
 
 class PBuilderExecCmds(BuildStep):
     '''
@@ -25,13 +25,13 @@ from os import path
 
 from conduct.buildsteps.base import BuildStep
 from conduct.util import systemCall
-from conduct.param import Parameter, listof, referencer_or, Referencer
+from conduct.param import Parameter, listof
 
 class Partitioning(BuildStep):
     parameters = {
         'dev' : Parameter(type=str,
                                  description='Path to the device file'),
-        'partitions' : Parameter(type=listof(referencer_or(int)),
+        'partitions' : Parameter(type=listof(float),
                                  description='List of partition sizes (in MB)')
     }
 
@@ -51,10 +51,6 @@ class Partitioning(BuildStep):
         systemCall(shCmd, log=self.log)
 
     def _createPartitionCmds(self, index, size):
-        # TODO: better referencer handling: give step instead of chain
-        if isinstance(size, Referencer):
-            size = size.evaluate(self.chain, float)
-
         cmds = [
             'n' # new partition
         ]
@@ -76,6 +72,8 @@ class DevMapper(BuildStep):
     This build step uses kpartx (devmapper) to map the partitions of the given
     device to own device files.
     '''
+    cacheable = False
+
     parameters = {
         'dev' : Parameter(type=str,
                                  description='Path to the device file'),
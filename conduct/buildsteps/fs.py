@@ -21,16 +21,24 @@
 # *****************************************************************************
 
 import os
+import stat
+import errno
 import time
 import hashlib
 import shutil
 import glob
+import fnmatch
+import threading
 
 from os import path
+from multiprocessing.pool import ThreadPool
 
 from conduct.buildsteps.base import BuildStep
-from conduct.util import systemCall, ensureDirectory, mount, umount
-from conduct.param import Parameter, oneof, listof, Referencer
+from conduct.util import systemCall, ensureDirectory, mount, umount, fileio
+from conduct.param import Parameter, oneof, listof
+
+IMAGE_CHUNK_SIZE = 4 * 1024 * 1024
+BYPASS_SYNC_SIZE = 64 * 1024 * 1024
 
 
 class WriteFile(BuildStep):
@@ -56,6 +64,8 @@ class WriteFile(BuildStep):
 
 
 class TmpDir(BuildStep):
+    cacheable = False
+
     parameters = {
         'parentdir' : Parameter(type=str,
                                  description='Path to parent directory',
@@ -80,6 +90,7 @@ class TmpDir(BuildStep):
         self.tmpdir = dest
 
     def cleanup(self):
+        self._releaseChroots(self.tmpdir)
         shutil.rmtree(self.tmpdir)
 
 
@@ -96,6 +107,9 @@ class RmPath(BuildStep):
     def run(self):
         self.log.info('Remove path: %s' % self.path)
 
+        if path.isdir(self.path):
+            self._releaseChroots(self.path)
+
         if path.isfile(self.path):
             os.remove(self.path)
         elif path.isdir(self.path):
@@ -107,6 +121,72 @@ class RmPath(BuildStep):
         if path.exists(self.path):
             raise RuntimeError('Could not remove path')
 
+def copyFile(source, dest, mode='copy'):
+    '''
+    Copy a single file (or symlink) including its metadata, with the
+    content copied inside the kernel if possible.
+    Modes: copy, reflink (copy on write clone) or hardlink. The latter two
+    fall back to a copy if not supported by the file system.
+    '''
+    if path.islink(source):
+        os.symlink(os.readlink(source), dest)
+        _copyOwner(source, dest)
+        return
+
+    if mode == 'hardlink':
+        try:
+            os.link(source, dest)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+
+    with open(source, 'rb') as fIn:
+        with open(dest, 'wb') as fOut:
+            cloned = False
+            if mode == 'reflink':
+                try:
+                    fileio.reflink(fIn.fileno(), fOut.fileno())
+                    cloned = True
+                except (IOError, OSError) as e:
+                    if e.errno not in fileio.COPY_FALLBACK_ERRORS:
+                        raise
+            if not cloned:
+                fileio.copyFileData(fIn.fileno(), fOut.fileno())
+    shutil.copystat(source, dest)
+
+    _copyOwner(source, dest)
+
+
+def copyTree(source, dest):
+    '''
+    Copy a directory tree (see copyFile).
+    '''
+    os.mkdir(dest)
+
+    for name in os.listdir(source):
+        sourceEntry = path.join(source, name)
+        destEntry = path.join(dest, name)
+
+        if path.isdir(sourceEntry) and not path.islink(sourceEntry):
+            copyTree(sourceEntry, destEntry)
+        else:
+            copyFile(sourceEntry, destEntry)
+
+    shutil.copystat(source, dest)
+    _copyOwner(source, dest)
+
+
+def _copyOwner(source, dest):
+    st = os.lstat(source)
+    try:
+        os.lchown(dest, st.st_uid, st.st_gid)
+    except OSError as e:
+        # only possible as root
+        if e.errno != errno.EPERM:
+            raise
+
+
 class CreateFileSystem(BuildStep):
     '''
     This build step creates the desired file system on the given device.
@@ -131,10 +211,246 @@ class CreateFileSystem(BuildStep):
         systemCall('mkfs -t %s %s' % (self.fstype, self.dev), log=self.log)
 
 
+class CreateImageFile(BuildStep):
+    '''
+    This build step creates an (empty) image file of the given size.
+    The file is either sparse (nothing allocated) or preallocated.
+    '''
+
+    parameters = {
+        'path' : Parameter(type=str,
+                                 description='Path to the image file'),
+        'size' : Parameter(type=int,
+                                 description='Size of the image file (in MiB)'),
+        'preallocate' : Parameter(type=bool,
+                                 description='Preallocate the disk space '
+                                 'instead of creating a sparse file',
+                                 default=False),
+    }
+
+    outparameters = {
+        'apparentsize' : Parameter(type=int,
+                                description='Apparent size of the image file '
+                                '(in bytes)',),
+        'allocatedsize' : Parameter(type=int,
+                                description='Allocated disk space of the '
+                                'image file (in bytes)',),
+    }
+
+    def run(self):
+        size = self.size * 1024 * 1024
+
+        self.log.info('Create %s image file %s (%d MiB) ...'
+                      % ('preallocated' if self.preallocate else 'sparse',
+                         self.path, self.size))
+
+        ensureDirectory(path.dirname(path.abspath(self.path)))
+
+        with open(self.path, 'wb') as f:
+            f.truncate(size)
+
+            if self.preallocate:
+                self._preallocate(f, size)
+
+        self.apparentsize = path.getsize(self.path)
+        self.allocatedsize = fileio.allocatedSize(self.path)
+
+        self.log.info('Apparent size: %d bytes, allocated: %d bytes'
+                      % (self.apparentsize, self.allocatedsize))
+
+    def _preallocate(self, f, size):
+        try:
+            fileio.fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            # not supported by all file systems (e.g. tmpfs on old kernels)
+            self.log.warning('Could not preallocate: %s' % e)
+            self.log.warning('Therefore: Write zeros')
+
+            chunk = '\0' * IMAGE_CHUNK_SIZE
+            f.seek(0)
+            for _ in range(size // IMAGE_CHUNK_SIZE):
+                f.write(chunk)
+            f.write(chunk[:size % IMAGE_CHUNK_SIZE])
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class BlockCopy(BuildStep):
+    '''
+    This build step copies the content of a file or block device to another
+    file or block device in large chunks. Holes and all-zero blocks
+    of the source are not copied, but left (or punched) as holes
+    in the destination.
+    '''
+
+    parameters = {
+        'source' : Parameter(type=str,
+                                 description='Source file or device'),
+        'destination' : Parameter(type=str,
+                                 description='Destination file or device'),
+        'blocksize' : Parameter(type=int,
+                                 description='Size of the copied chunks '
+                                 '(in bytes)',
+                                 default=4 * 1024 * 1024),
+        'skipzeros' : Parameter(type=bool,
+                                 description='Skip all-zero blocks',
+                                 default=True),
+        'bypasscache' : Parameter(type=bool,
+                                 description='Drop the copied data from the '
+                                 'page cache',
+                                 default=False),
+    }
+
+    outparameters = {
+        'copiedbytes' : Parameter(type=int,
+                                description='Number of copied bytes',),
+        'skippedbytes' : Parameter(type=int,
+                                description='Number of skipped bytes (holes '
+                                'and zero blocks)',),
+    }
+
+    def run(self):
+        self.log.info('Copy %s to %s ...' % (self.source, self.destination))
+
+        self.copiedbytes = 0
+        self.skippedbytes = 0
+        self._zeros = '\0' * self.blocksize
+        self._unsynced = 0
+        startTime = time.time()
+
+        src = os.open(self.source, os.O_RDONLY)
+        try:
+            # block devices already exist and must not be truncated
+            self._dstIsFile = not path.exists(self.destination) \
+                or stat.S_ISREG(os.stat(self.destination).st_mode)
+            flags = os.O_WRONLY | os.O_CREAT
+            if self._dstIsFile:
+                flags |= os.O_TRUNC
+
+            dst = os.open(self.destination, flags, 0o644)
+            try:
+                size = os.lseek(src, 0, os.SEEK_END)
+
+                if self._dstIsFile:
+                    os.ftruncate(dst, size)
+                self._punchHoles = not self._dstIsFile
+
+                if self.bypasscache:
+                    fileio.fadvise(src, 0, 0, fileio.POSIX_FADV_SEQUENTIAL)
+
+                self._copy(src, dst, size)
+
+                os.fsync(dst)
+                if self.bypasscache:
+                    fileio.fadvise(dst, 0, 0, fileio.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(dst)
+        finally:
+            os.close(src)
+
+        duration = max(time.time() - startTime, 1e-6)
+        self.log.info('Copied %.1f MiB, skipped %.1f MiB (holes/zeros) '
+                      'in %.1f s (%.1f MiB/s)'
+                      % (self.copiedbytes / 1048576.0,
+                         self.skippedbytes / 1048576.0,
+                         duration,
+                         (self.copiedbytes + self.skippedbytes)
+                         / 1048576.0 / duration))
+
+    def _copy(self, src, dst, size):
+        detectHoles = True
+        offset = 0
+
+        while offset < size:
+            end = size
+
+            if detectHoles:
+                try:
+                    dataStart = fileio.seekData(src, offset)
+                    if dataStart is None:
+                        dataStart = size
+                    if dataStart > offset:
+                        self._skip(dst, offset, dataStart - offset)
+                        offset = dataStart
+                        continue
+                    end = min(fileio.seekHole(src, offset), size)
+                except OSError:
+                    # not supported by the source (e.g. block devices)
+                    detectHoles = False
+
+            self._copyRange(src, dst, offset, end)
+            offset = end
+
+    def _copyRange(self, src, dst, offset, end):
+        os.lseek(src, offset, os.SEEK_SET)
+
+        while offset < end:
+            # keep the chunks aligned to the block size
+            length = min(end, (offset // self.blocksize + 1) * self.blocksize) \
+                - offset
+            data = os.read(src, length)
+
+            if not data:
+                break
+
+            if self.skipzeros and data == self._zeros[:len(data)]:
+                self._skip(dst, offset, len(data))
+            else:
+                self._write(dst, offset, data)
+
+            if self.bypasscache:
+                fileio.fadvise(src, offset, len(data),
+                               fileio.POSIX_FADV_DONTNEED)
+
+            offset += len(data)
+
+    def _write(self, dst, offset, data):
+        os.lseek(dst, offset, os.SEEK_SET)
+
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst, view):]
+
+        self.copiedbytes += len(data)
+
+        if self.bypasscache:
+            self._unsynced += len(data)
+            if self._unsynced >= BYPASS_SYNC_SIZE:
+                # written pages can only be dropped after write back
+                os.fdatasync(dst)
+                fileio.fadvise(dst, 0, 0, fileio.POSIX_FADV_DONTNEED)
+                self._unsynced = 0
+
+    def _skip(self, dst, offset, length):
+        if self._dstIsFile:
+            # fresh (truncated) files are holes anyway
+            self.skippedbytes += length
+            return
+
+        if self._punchHoles:
+            try:
+                fileio.punchHole(dst, offset, length)
+                self.skippedbytes += length
+                return
+            except OSError as e:
+                self.log.debug('Could not punch holes: %s' % e)
+                self.log.debug('Therefore: Write zeros')
+                self._punchHoles = False
+
+        # the device content is unknown, so the zeros have to be written
+        while length:
+            chunk = min(length, self.blocksize)
+            self._write(dst, offset, self._zeros[:chunk])
+            offset += chunk
+            length -= chunk
+
+
 class Mount(BuildStep):
     '''
     This build step mounts given device to given mount point.
     '''
+    cacheable = False
+
     parameters = {
         'dev' : Parameter(type=str,
                                  description='Path to the device file'),
@@ -146,6 +462,7 @@ class Mount(BuildStep):
         mount(self.dev, self.mountpoint, log=self.log)
 
     def cleanup(self):
+        self._releaseChroots(self.mountpoint)
         umount(self.mountpoint, log=self.log)
 
 
@@ -164,21 +481,21 @@ class MakeDirs(BuildStep):
 
     def run(self):
         for entry in self.dirs:
-            # TODO: Referencer support for nested types
-            entry = Referencer(entry).evaluate(self.chain)
             self.log.debug('Create directory: %s ...' % entry)
             ensureDirectory(entry)
 
     def cleanup(self):
         if self.removeoncleanup:
             for entry in self.dirs:
-                entry = Referencer(entry).evaluate(self.chain)
                 shutil.rmtree(entry)
 
 class MovePath(BuildStep):
     '''
     This build step moves/renames a path to a given destination path.
     Shell wildcards are supported!
+    If the destination is an existing directory, the matches are moved
+    into it. Moves across file systems are done by copying to a temporary
+    path next to the destination, which is renamed afterwards.
     '''
 
     parameters = {
@@ -192,24 +509,62 @@ class MovePath(BuildStep):
     def run(self):
         self.log.info('Move %s to %s' % (self.source, self.destination))
 
-        for entry in glob.glob(self.source):
-            self.log.debug('Copy %s to %s' % (entry, self.destination))
-            if os.path.isfile(entry):
-                shutil.copy(entry, self.destination)
-            else:
-                shutil.copytree(entry, self.destination)
+        entries = glob.glob(self.source)
+
+        if len(entries) > 1 and not path.isdir(self.destination):
+            raise RuntimeError('Cannot move multiple paths to non directory: '
+                               '%s' % self.destination)
+
+        for entry in entries:
+            dest = self.destination
+            if path.isdir(dest):
+                dest = path.join(dest, path.basename(entry.rstrip('/')))
 
-            self.log.debug('Remove %s ...' % entry)
-            if os.path.isfile(entry):
-                os.remove(entry)
+            self.log.debug('Move %s to %s' % (entry, dest))
+
+            try:
+                os.rename(entry, dest)
+                continue
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+            self.log.debug('Cross device move, therefore: Copy')
+            self._moveAcrossDevices(entry, dest)
+
+    def _moveAcrossDevices(self, entry, dest):
+        tmpDest = path.join(path.dirname(path.abspath(dest)),
+                            '.%s.tmp.%d' % (path.basename(dest), os.getpid()))
+
+        try:
+            if path.isdir(entry) and not path.islink(entry):
+                copyTree(entry, tmpDest)
             else:
-                shutil.rmtree(entry)
+                copyFile(entry, tmpDest)
+
+            # the rename replaces files atomically, but fails for
+            # non empty directories (like mv does)
+            os.rename(tmpDest, dest)
+        except Exception:
+            if path.isdir(tmpDest) and not path.islink(tmpDest):
+                shutil.rmtree(tmpDest)
+            elif path.lexists(tmpDest):
+                os.remove(tmpDest)
+            raise
+
+        self.log.debug('Remove %s ...' % entry)
+        if path.isdir(entry) and not path.islink(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
 
 
 class CopyPath(BuildStep):
     '''
     This build step copies a path to a given destination path.
     Shell wildcards are supported!
+    The files of directory trees are copied by a pool of threads,
+    optionally as reflinks or hardlinks.
     '''
 
     parameters = {
@@ -218,10 +573,132 @@ class CopyPath(BuildStep):
         'destination' : Parameter(type=str,
                                  description='Destination path',
                                  ),
+        'mode' : Parameter(type=oneof('copy', 'reflink', 'hardlink'),
+                                 description='Copy mode (reflink and '
+                                 'hardlink fall back to copy if not possible)',
+                                 default='copy'),
+        'threads' : Parameter(type=int,
+                                 description='Number of copy threads',
+                                 default=4),
+        'include' : Parameter(type=listof(str),
+                                 description='Patterns of (relative) file '
+                                 'paths to copy (all if empty)',
+                                 default=[]),
+        'exclude' : Parameter(type=listof(str),
+                                 description='Patterns of (relative) paths '
+                                 'to skip',
+                                 default=[]),
+        'symlinks' : Parameter(type=bool,
+                                 description='Copy symbolic links as links '
+                                 '(instead of the files and directories '
+                                 'they point to)',
+                                 default=False),
     }
 
     def run(self):
         self.log.info('Copy %s to %s' % (self.source, self.destination))
 
-        for entry in glob.glob(self.source):
-            shutil.copytree(entry, self.destination)
+        self._files = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        startTime = time.time()
+
+        pool = ThreadPool(max(self.threads, 1))
+        try:
+            for entry in glob.glob(self.source):
+                if path.isdir(entry) \
+                    and not (self.symlinks and path.islink(entry)):
+                    self._copyTree(pool, entry, self.destination)
+                else:
+                    dest = self.destination
+                    if path.isdir(dest):
+                        dest = path.join(dest, path.basename(entry))
+                    self._copyFile(entry, dest)
+        finally:
+            pool.close()
+            pool.join()
+
+        duration = max(time.time() - startTime, 1e-6)
+        self.log.info('Copied %d files (%.1f MiB) in %.1f s '
+                      '(%.0f files/s, %.1f MiB/s)'
+                      % (self._files, self._bytes / 1048576.0, duration,
+                         self._files / duration,
+                         self._bytes / 1048576.0 / duration))
+
+    def _copyTree(self, pool, source, dest):
+        dirs = []
+        results = []
+        errors = [] # (source, destination, reason) like shutil.copytree
+
+        def walkError(error):
+            # unreadable directories: copy the rest, fail afterwards
+            errors.append((error.filename,
+                           path.normpath(path.join(
+                               dest, path.relpath(error.filename, source))),
+                           str(error)))
+
+        for root, dirNames, fileNames in os.walk(
+                source, onerror=walkError, followlinks=not self.symlinks):
+            relRoot = path.relpath(root, source)
+            destRoot = path.normpath(path.join(dest, relRoot))
+
+            ensureDirectory(destRoot)
+            dirs.append((root, destRoot))
+
+            # prune excluded directories
+            dirNames[:] = [entry for entry in dirNames
+                           if not self._isExcluded(
+                               path.normpath(path.join(relRoot, entry)))]
+
+            if self.symlinks:
+                for entry in list(dirNames):
+                    if path.islink(path.join(root, entry)):
+                        # symlinks to directories are copied as symlinks
+                        dirNames.remove(entry)
+                        fileNames.append(entry)
+
+            for entry in fileNames:
+                relPath = path.normpath(path.join(relRoot, entry))
+                if self._isExcluded(relPath) or not self._isIncluded(relPath):
+                    continue
+
+                results.append(pool.apply_async(self._copyFile,
+                                                (path.join(root, entry),
+                                                 path.join(destRoot, entry))))
+
+        for result in results:
+            # raises the errors of the copy threads
+            result.get()
+
+        # directory metadata after the content, to keep the mtimes
+        for sourceDir, destDir in reversed(dirs):
+            shutil.copystat(sourceDir, destDir)
+            _copyOwner(sourceDir, destDir)
+
+        if errors:
+            raise shutil.Error(errors)
+
+    def _copyFile(self, source, dest):
+        if path.lexists(dest):
+            os.remove(dest)
+
+        if not self.symlinks and path.islink(source):
+            # copy the file the link points to
+            source = path.realpath(source)
+
+        copyFile(source, dest, self.mode)
+
+        size = os.lstat(source).st_size
+        with self._lock:
+            self._files += 1
+            self._bytes += size
+
+    def _isIncluded(self, relPath):
+        if not self.include:
+            return True
+        return any(fnmatch.fnmatch(relPath, pattern)
+                   for pattern in self.include)
+
+    def _isExcluded(self, relPath):
+        return any(fnmatch.fnmatch(relPath, pattern)
+                   for pattern in self.exclude)
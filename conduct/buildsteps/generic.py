@@ -33,6 +33,8 @@ class Config(BuildStep):
     '''
     Build step to read given configuration file.
     '''
+    pure = True
+
     parameters = {
         'path' : Parameter(type=str,
                                  description='Path to the configuration file',
@@ -72,6 +74,9 @@ class Config(BuildStep):
 
         self.log.debug('Parsed config: %r' % self.config)
 
+    def cacheInputs(self):
+        return [self.path] + BuildStep.cacheInputs(self)
+
     def _parseIni(self, path):
         cfg = {}
 
@@ -102,6 +107,8 @@ class Calculation(BuildStep):
     '''
     Build step to do some calculation.
     '''
+    pure = True
+
     parameters = {
         'formula' : Parameter(type=str,
                                  description='Formula to calculate'),
@@ -119,11 +126,16 @@ class TriggerCleanup(BuildStep):
     '''
     Build step that triggers the cleanup of another step.
     '''
+    cacheable = False
+
     parameters = {
         'step' : Parameter(type=str,
                                  description='Step to clean up'),
     }
 
+    def implicitDependencies(self):
+        return [self.step]
+
     def run(self):
         self.log.info('Trigger cleanup of %s ...' % self.step)
         if(self.step not in self.chain.steps):
@@ -138,6 +150,8 @@ class Map(BuildStep):
     Maps a value to another one.
     Supports regex matching and priority matching by order.
     '''
+    pure = True
+
     parameters = {
         'input' : Parameter(type=str,
                                  description='Input to map'),
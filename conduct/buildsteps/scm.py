@@ -20,17 +20,28 @@
 #
 # *****************************************************************************
 
+import os
+import re
+import fcntl
 import shutil
+import hashlib
+from os import path
+from contextlib import contextmanager
 from distutils.version import LooseVersion
 
 from conduct.buildsteps.base import BuildStep
-from conduct.param import Parameter
-from conduct.util import systemCall
+from conduct.param import Parameter, listof
+from conduct.util import systemCall, getCacheDir, ensureDirectory
 
 
 class GitClone(BuildStep):
     '''
     Clones a git project.
+
+    By default, a bare mirror of each url is kept in the cache directory
+    and refreshed via git fetch, so the actual working copy is a local
+    (hardlinked) clone. An existing clone of the same url in the
+    destination directory is fetched and reset instead of cloned again.
     '''
     parameters = {
         'url' : Parameter(type=str,
@@ -51,13 +62,51 @@ class GitClone(BuildStep):
                                  description='Checkout the desired target as '
                                  'given branch',
                                  default=''),
+        'usemirror' : Parameter(type=bool,
+                                 description='Clone via a local bare mirror '
+                                 'of the url',
+                                 default=True),
+        'mirrordir' : Parameter(type=str,
+                                 description='Directory for the bare mirrors '
+                                 '(<cachedir>/git if empty)',
+                                 default=''),
+        'keepclone' : Parameter(type=bool,
+                                 description='Keep the clone during cleanup '
+                                 '(to update it next time)',
+                                 default=False),
+        'shallow' : Parameter(type=bool,
+                                 description='Determine the last release '
+                                 'version remotely and clone only this tag '
+                                 '(uselastversion only, no mirror)',
+                                 default=False),
+        'filter' : Parameter(type=str,
+                                 description='Partial clone filter for '
+                                 'shallow clones (e.g. blob:none)',
+                                 default=''),
+        'sparsepaths' : Parameter(type=listof(str),
+                                 description='Paths to check out (sparse '
+                                 'checkout)',
+                                 default=[]),
     }
 
     def run(self):
-        systemCall('git clone %s %s' % (self.url, self.destdir), log=self.log)
+        if self.uselastversion and self.shallow:
+            self.target = self._determineLastRemoteVersion()
+            self._shallowClone(self.target)
+        else:
+            mirror = None
+            if self.usemirror:
+                mirror = self._updateMirror()
 
-        if self.uselastversion:
-            self.target = self._determineLastVersion()
+            reused = self._isCloneOf(self.url)
+            if reused:
+                self._updateClone(mirror)
+            else:
+                self._clone(mirror)
+            self._applySparseCheckout(reused)
+
+            if self.uselastversion:
+                self.target = self._determineLastVersion()
 
         if self.target:
             checkoutCmd = 'git --git-dir=%s/.git --work-tree=%s checkout %s' % (
@@ -65,12 +114,14 @@ class GitClone(BuildStep):
                 )
 
             if self.asbranch:
-                checkoutCmd += ' -b %s' % self.asbranch
+                # -B: the branch may exist already in a reused clone
+                checkoutCmd += ' -B %s' % self.asbranch
 
             systemCall(checkoutCmd, log=self.log)
 
     def cleanup(self):
-        shutil.rmtree(self.destdir)
+        if not self.keepclone:
+            shutil.rmtree(self.destdir)
 
     def _determineLastVersion(self):
         self.log.debug('Determine last version ...')
@@ -85,3 +136,152 @@ class GitClone(BuildStep):
         self.log.debug('Last version: %s' % result)
         return result
 
+    def _determineLastRemoteVersion(self):
+        self.log.debug('Determine last version (remotely) ...')
+        # find last tag without cloning anything
+        tags = set()
+        for line in systemCall('git ls-remote --tags %s' % self.url,
+                               log=self.log).splitlines():
+            ref = line.split('\t')[-1].strip()
+            if ref.startswith('refs/tags/'):
+                # strip annotated tag dereferences (^{})
+                tags.add(ref[len('refs/tags/'):].split('^{}')[0])
+
+        if not tags:
+            raise RuntimeError('No tags found: %s' % self.url)
+
+        tags = sorted([LooseVersion(entry) for entry in tags])
+        result = tags[-1].vstring
+        self.log.debug('Last version: %s' % result)
+        return result
+
+    def _shallowClone(self, tag):
+        if self._isCloneOf(self.url):
+            self.log.info('Update existing clone: %s' % self.destdir)
+            systemCall('git fetch --depth 1 origin '
+                       '"+refs/tags/%s:refs/tags/%s"' % (tag, tag),
+                       log=self.log, cwd=self.destdir)
+            self._applySparseCheckout(True)
+            systemCall('git reset --hard', log=self.log, cwd=self.destdir)
+            systemCall('git clean -fdx', log=self.log, cwd=self.destdir)
+            return
+
+        cmd = 'git clone --depth 1 --single-branch --branch %s ' % tag
+
+        if self.filter:
+            cmd += '--filter=%s ' % self.filter
+        if self.sparsepaths:
+            # populated by the checkout of the target
+            cmd += '--no-checkout '
+
+        systemCall(cmd + '%s %s' % (self.url, self.destdir), log=self.log)
+        self._applySparseCheckout(False)
+
+    def _applySparseCheckout(self, reused):
+        '''
+        Restrict the working tree to the sparsepaths. The scope of a
+        reused clone is redefined (or removed without sparsepaths).
+        '''
+        if self.sparsepaths:
+            systemCall('git sparse-checkout set %s'
+                       % ' '.join(self.sparsepaths),
+                       log=self.log, cwd=self.destdir)
+        elif reused and self._isSparse():
+            systemCall('git sparse-checkout disable',
+                       log=self.log, cwd=self.destdir)
+
+    def _isSparse(self):
+        try:
+            value = systemCall('git config --get core.sparseCheckout',
+                               log=self.log, cwd=self.destdir)
+        except RuntimeError:
+            return False
+
+        return value.strip() == 'true'
+
+    def _mirrorPath(self):
+        mirrorDir = self.mirrordir or getCacheDir('git')
+        name = re.sub(r'[^\w.-]', '_', self.url.rstrip('/').split('/')[-1])
+        key = hashlib.sha1(self.url).hexdigest()[:16]
+        return path.join(mirrorDir, '%s-%s.git' % (name, key))
+
+    def _updateMirror(self):
+        '''
+        Create or refresh the bare mirror of the url.
+        Returns the mirror path or None if the mirror is not usable.
+        '''
+        mirror = self._mirrorPath()
+
+        try:
+            # (a configured mirrordir may not exist yet)
+            ensureDirectory(path.dirname(mirror))
+            with _fileLock(mirror + '.lock'):
+                if path.isdir(mirror):
+                    self.log.info('Update mirror: %s' % mirror)
+                    systemCall('git --git-dir=%s fetch --prune --tags origin'
+                               % mirror, log=self.log)
+                else:
+                    self.log.info('Create mirror: %s' % mirror)
+                    tmpMirror = '%s.tmp.%d' % (mirror, os.getpid())
+                    try:
+                        systemCall('git clone --mirror %s %s'
+                                   % (self.url, tmpMirror), log=self.log)
+                        os.rename(tmpMirror, mirror)
+                    finally:
+                        if path.isdir(tmpMirror):
+                            shutil.rmtree(tmpMirror)
+        except Exception as e:
+            self.log.warning('Could not update mirror: %s' % e)
+            self.log.warning('Therefore: Clone directly from %s' % self.url)
+            return None
+
+        return mirror
+
+    def _isCloneOf(self, url):
+        if not path.isdir(path.join(self.destdir, '.git')):
+            return False
+
+        try:
+            origin = systemCall('git config --get remote.origin.url',
+                                log=self.log, cwd=self.destdir)
+        except RuntimeError:
+            return False
+
+        return origin.strip() == url
+
+    def _clone(self, mirror):
+        if mirror is None:
+            systemCall('git clone %s %s' % (self.url, self.destdir),
+                       log=self.log)
+            return
+
+        # local clone (hardlinked objects), but keep the real origin
+        systemCall('git clone %s %s' % (mirror, self.destdir), log=self.log)
+        systemCall('git remote set-url origin %s' % self.url,
+                   log=self.log, cwd=self.destdir)
+
+    def _updateClone(self, mirror):
+        self.log.info('Update existing clone: %s' % self.destdir)
+
+        source = mirror or 'origin'
+        systemCall('git fetch --prune --tags %s '
+                   '"+refs/heads/*:refs/remotes/origin/*"' % source,
+                   log=self.log, cwd=self.destdir)
+
+        # discard all local modifications
+        systemCall('git reset --hard origin/HEAD', log=self.log,
+                   cwd=self.destdir)
+        systemCall('git clean -fdx', log=self.log, cwd=self.destdir)
+
+
+@contextmanager
+def _fileLock(lockFile):
+    '''
+    Exclusive lock (between threads and processes) via the given file.
+    '''
+    with open(lockFile, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -20,8 +20,6 @@
 #
 # *****************************************************************************
 
-import os
-
 from conduct.buildsteps.base import BuildStep
 from conduct.util import systemCall, chrootedSystemCall
 from conduct.param import Parameter, none_or
@@ -45,13 +43,8 @@ class SystemCall(BuildStep):
     }
 
     def run(self):
-        cwd = os.getcwd()
-
-        try:
-            os.chdir(self.workingdir)
-            self.commandoutput = systemCall(self.command, log=self.log)
-        finally:
-            os.chdir(cwd)
+        self.commandoutput = systemCall(self.command, log=self.log,
+                                        cwd=self.workingdir)
 
 class ChrootedSystemCall(BuildStep):
     '''
@@ -74,4 +67,5 @@ class ChrootedSystemCall(BuildStep):
     def run(self):
         self.commandoutput = chrootedSystemCall(self.chrootdir,
                                                 self.command,
-                                                log=self.log)
\ No newline at end of file
+                                                log=self.log,
+                                                sessions=self.chrootSessions)
\ No newline at end of file
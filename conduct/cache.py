@@ -0,0 +1,249 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Content addressed cache for build step results.
+'''
+
+import os
+import time
+import shutil
+import hashlib
+import cPickle as pickle
+import threading
+
+from os import path
+from collections import OrderedDict
+
+from conduct.util import ensureDirectory
+
+META_FILE = 'meta.pickle'
+ARTIFACT_DIR = 'artifacts'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class StepCache(object):
+    '''
+    Stores the outparameters and output artifacts of build steps by a key
+    computed from the step class, its resolved parameters and its input
+    files. The least recently used entries are evicted as soon as the
+    cache exceeds its maximum size.
+    '''
+
+    def __init__(self, directory, maxsize, log):
+        self.directory = path.abspath(directory)
+        self.maxsize = maxsize # bytes
+        self.log = log
+
+        self._lock = threading.Lock()
+
+        ensureDirectory(self.directory)
+
+    def computeKey(self, clsPath, params, inputs):
+        '''
+        Compute the cache key for the given step class path,
+        resolved parameter values (dict) and input paths.
+        '''
+        keyHash = hashlib.sha1()
+        keyHash.update(clsPath)
+
+        for name in sorted(params):
+            keyHash.update('\0%s=%s' % (name, canonicalRepr(params[name])))
+
+        for entry in inputs:
+            keyHash.update('\0input:%s:' % entry)
+            hashPath(entry, keyHash)
+
+        return keyHash.hexdigest()
+
+    def restore(self, key, outputs):
+        '''
+        Restore the output artifacts of the entry with the given key
+        to their original locations. Returns the stored outparameters or
+        None if the entry does not exist.
+        '''
+        entryDir = path.join(self.directory, key)
+        metaFile = path.join(entryDir, META_FILE)
+
+        if not path.isfile(metaFile):
+            return None
+
+        with open(metaFile, 'rb') as f:
+            meta = pickle.load(f)
+
+        if meta['outputs'] != list(outputs):
+            return None
+
+        for index, dest in enumerate(outputs):
+            self.log.debug('Restore artifact: %s' % dest)
+            removePath(dest)
+            ensureDirectory(path.dirname(path.abspath(dest)))
+            copyPath(path.join(entryDir, ARTIFACT_DIR, str(index)), dest)
+
+        # mark as recently used
+        os.utime(entryDir, None)
+
+        return meta['outparams']
+
+    def store(self, key, outparams, outputs):
+        '''
+        Store the given outparameters (dict) and output artifacts.
+        '''
+        entryDir = path.join(self.directory, key)
+        tmpDir = '%s.tmp.%d.%d' % (entryDir, os.getpid(),
+                                   threading.current_thread().ident)
+
+        removePath(tmpDir)
+        ensureDirectory(path.join(tmpDir, ARTIFACT_DIR))
+
+        try:
+            for index, source in enumerate(outputs):
+                copyPath(source, path.join(tmpDir, ARTIFACT_DIR, str(index)))
+
+            meta = {
+                'outparams' : outparams,
+                'outputs' : list(outputs),
+                'size' : pathSize(tmpDir),
+                'created' : time.time(),
+            }
+
+            with open(path.join(tmpDir, META_FILE), 'wb') as f:
+                pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+
+            with self._lock:
+                removePath(entryDir)
+                os.rename(tmpDir, entryDir)
+        finally:
+            removePath(tmpDir)
+
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache size
+        is within its limit.
+        '''
+        with self._lock:
+            entries = []
+            total = 0
+
+            for entry in os.listdir(self.directory):
+                entryDir = path.join(self.directory, entry)
+                metaFile = path.join(entryDir, META_FILE)
+
+                if not path.isfile(metaFile):
+                    continue
+
+                try:
+                    with open(metaFile, 'rb') as f:
+                        size = pickle.load(f)['size']
+                except Exception:
+                    # broken entry
+                    removePath(entryDir)
+                    continue
+
+                entries.append((path.getmtime(entryDir), size, entryDir))
+                total += size
+
+            for _, size, entryDir in sorted(entries):
+                if total <= self.maxsize:
+                    break
+                self.log.debug('Evict step cache entry: %s'
+                               % path.basename(entryDir))
+                removePath(entryDir)
+                total -= size
+
+    def clear(self):
+        with self._lock:
+            for entry in os.listdir(self.directory):
+                removePath(path.join(self.directory, entry))
+
+
+def canonicalRepr(value):
+    '''
+    Representation of the given value that does not depend on
+    the (arbitrary) order of dicts and sets.
+    '''
+    if isinstance(value, OrderedDict):
+        return 'OrderedDict(%s)' % canonicalRepr(list(value.items()))
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (canonicalRepr(key),
+                                              canonicalRepr(val))
+                                  for key, val in sorted(value.items()))
+    if isinstance(value, (set, frozenset)):
+        return 'set(%s)' % ', '.join(sorted(canonicalRepr(entry)
+                                            for entry in value))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(canonicalRepr(entry) for entry in value)
+    return repr(value)
+
+
+def hashPath(entry, keyHash):
+    '''
+    Update the given hash by the content of the given file or directory
+    tree (including the relative file names).
+    '''
+    if path.isdir(entry):
+        for root, dirs, files in os.walk(entry):
+            dirs.sort()
+            for name in sorted(files):
+                filePath = path.join(root, name)
+                keyHash.update('\0%s:' % path.relpath(filePath, entry))
+                hashPath(filePath, keyHash)
+    elif path.islink(entry) and not path.exists(entry):
+        keyHash.update('link:%s' % os.readlink(entry))
+    elif path.isfile(entry):
+        with open(entry, 'rb') as f:
+            while True:
+                block = f.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                keyHash.update(block)
+    else:
+        keyHash.update('<missing>')
+
+
+def copyPath(source, dest):
+    if path.isdir(source):
+        shutil.copytree(source, dest, symlinks=True)
+    else:
+        shutil.copy2(source, dest)
+
+
+def removePath(entry):
+    if path.isdir(entry) and not path.islink(entry):
+        shutil.rmtree(entry)
+    elif path.lexists(entry):
+        os.remove(entry)
+
+
+def pathSize(entry):
+    if not path.isdir(entry):
+        return path.getsize(entry)
+
+    size = 0
+    for root, _, files in os.walk(entry):
+        for name in files:
+            filePath = path.join(root, name)
+            if not path.islink(filePath):
+                size += path.getsize(filePath)
+    return size
@@ -0,0 +1,293 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Persistent index of all available chains (description and parameters),
+extracted from the chain definition files without executing them.
+'''
+
+import os
+import ast
+import cPickle as pickle
+from os import path
+from collections import OrderedDict
+
+from conduct import param
+from conduct.util import chainPathToName, chainNameToPath, ensureDirectory, \
+    loadChainDefinition
+
+# increment on changes of the index format
+INDEX_VERSION = 2
+
+
+class ChainCatalog(object):
+    '''
+    Index of the chains below the given chain definition directory.
+    Only the chain files that changed (mtime, size) since the last update
+    are analyzed again.
+
+    Chains that can't be analyzed completely (e.g. parameters created by
+    code, or syntax errors) are loaded on demand (see get).
+    '''
+
+    def __init__(self, chainDir, indexFile):
+        self.chainDir = path.abspath(chainDir)
+        self.indexFile = indexFile
+        self.chains = OrderedDict()
+
+        self._loaded = {} # chain name -> info of loaded chains
+
+        self._load()
+
+    def update(self):
+        '''
+        Bring the index up to date (and store it if anything changed).
+        '''
+        chains = OrderedDict()
+        changed = False
+
+        for chainFile in sorted(self._findChainFiles()):
+            name = chainPathToName(
+                path.relpath(chainFile, self.chainDir)[:-len('.py')])
+            st = os.stat(chainFile)
+            entry = self.chains.get(name)
+
+            if entry is None or entry['mtime'] != st.st_mtime \
+                or entry['size'] != st.st_size:
+                try:
+                    entry = extractChainInfo(chainFile)
+                except (SyntaxError, ValueError, TypeError, IOError) as e:
+                    # (reported as soon as the chain is used)
+                    entry = _emptyInfo(static=False)
+                    entry['error'] = str(e)
+                entry['mtime'] = st.st_mtime
+                entry['size'] = st.st_size
+                changed = True
+
+            chains[name] = entry
+
+        if changed or list(chains) != list(self.chains):
+            self.chains = chains
+            self._store()
+
+        return self.chains
+
+    def get(self, chainName):
+        if chainName not in self.chains:
+            chainFile = path.join(self.chainDir,
+                                  '%s.py' % chainNameToPath(chainName))
+            raise IOError('Chain file for \'%s\' not found (Should be: %s)'
+                          % (chainName, chainFile))
+
+        entry = self.chains[chainName]
+        if not entry['static']:
+            entry = self._loadChainInfo(chainName)
+        return entry
+
+    def _loadChainInfo(self, chainName):
+        '''
+        Determine the info of the given chain by loading its definition.
+        '''
+        if chainName not in self._loaded:
+            chainDef = loadChainDefinition(chainName)
+
+            info = _emptyInfo(static=False)
+            info['doc'] = self.chains[chainName]['doc']
+            info['description'] = chainDef['description']
+            for name, definition in sorted(chainDef['parameters'].items()):
+                info['parameters'][name] = {
+                    'type' : definition.type,
+                    'description' : definition.description,
+                    'default' : definition.default,
+                }
+
+            self._loaded[chainName] = info
+
+        return self._loaded[chainName]
+
+    def _findChainFiles(self):
+        for root, dirs, files in os.walk(self.chainDir):
+            dirs.sort()
+            for name in files:
+                if name.endswith('.py'):
+                    yield path.join(root, name)
+
+    def _load(self):
+        try:
+            with open(self.indexFile, 'rb') as f:
+                index = pickle.load(f)
+        except Exception:
+            # missing or broken: rebuild
+            return
+
+        if index.get('version') == INDEX_VERSION \
+            and index.get('chaindir') == self.chainDir:
+            self.chains = index['chains']
+
+    def _store(self):
+        index = {
+            'version' : INDEX_VERSION,
+            'chaindir' : self.chainDir,
+            'chains' : self.chains,
+        }
+
+        ensureDirectory(path.dirname(path.abspath(self.indexFile)))
+        tmpFile = '%s.%d.tmp' % (self.indexFile, os.getpid())
+
+        try:
+            with open(tmpFile, 'wb') as f:
+                pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmpFile, self.indexFile)
+        except (IOError, OSError):
+            # the index is rebuilt next time
+            if path.exists(tmpFile):
+                os.remove(tmpFile)
+
+
+def extractChainInfo(chainFile):
+    '''
+    Extract the description and the parameters (type expression,
+    description, default) of the given chain file by analyzing its
+    syntax tree. The info is only marked as static if all of them are
+    literals (a literal parameters dict of Parameter calls).
+
+    Raises SyntaxError (or ValueError, TypeError) for broken files.
+    '''
+    with open(chainFile) as f:
+        tree = ast.parse(f.read(), chainFile)
+
+    info = _emptyInfo(static=True)
+    info['doc'] = ast.get_docstring(tree) or ''
+
+    # parameters extended or replaced by code
+    if sum(1 for node in ast.walk(tree) if isinstance(node, ast.Name)
+           and node.id == 'parameters') != 1:
+        info['static'] = False
+
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1 \
+            or not isinstance(node.targets[0], ast.Name):
+            continue
+
+        target = node.targets[0].id
+
+        try:
+            if target == 'description':
+                info['description'] = _literal(node.value)
+            elif target == 'parameters':
+                if not isinstance(node.value, ast.Dict):
+                    raise _NotStatic()
+                for key, value in zip(node.value.keys, node.value.values):
+                    if not isinstance(key, ast.Str):
+                        raise _NotStatic()
+                    info['parameters'][key.s] = _extractParameter(value)
+        except _NotStatic:
+            info['static'] = False
+
+    return info
+
+
+def parameterType(paramInfo):
+    '''
+    Create the type (validator) of an extracted parameter.
+    '''
+    if not isinstance(paramInfo['type'], basestring):
+        # loaded chain
+        return paramInfo['type']
+
+    try:
+        return eval(paramInfo['type'], vars(param))
+    except Exception:
+        return str
+
+
+class _NotStatic(Exception):
+    '''
+    The chain info can't be extracted without executing the chain file.
+    '''
+
+
+def _emptyInfo(static):
+    return {
+        'doc' : '',
+        'description' : '',
+        'parameters' : OrderedDict(),
+        'static' : static,
+    }
+
+
+def _extractParameter(node):
+    result = {
+        'type' : 'str',
+        'description' : 'Undescribed',
+        'default' : None,
+    }
+
+    if not isinstance(node, ast.Call) or _source(node.func) != 'Parameter':
+        raise _NotStatic()
+
+    # Parameter(type=str, description='Undescribed', default=None)
+    args = dict(zip(('type', 'description', 'default'), node.args))
+    args.update((keyword.arg, keyword.value) for keyword in node.keywords)
+
+    if node.starargs is not None or node.kwargs is not None \
+        or set(args) - set(result):
+        raise _NotStatic()
+
+    if 'type' in args:
+        result['type'] = _source(args['type'])
+        if result['type'] is None:
+            raise _NotStatic()
+    if 'description' in args:
+        result['description'] = _literal(args['description'])
+    if 'default' in args:
+        result['default'] = _literal(args['default'])
+
+    return result
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise _NotStatic()
+
+
+def _source(node):
+    '''
+    Source of simple expressions (names, attributes, calls and literals),
+    as used for parameter types. None for anything else.
+    '''
+    if isinstance(node, ast.Name):
+        return node.id
+    elif isinstance(node, ast.Attribute):
+        value = _source(node.value)
+        return None if value is None else '%s.%s' % (value, node.attr)
+    elif isinstance(node, (ast.Str, ast.Num)):
+        return repr(ast.literal_eval(node))
+    elif isinstance(node, ast.Call):
+        parts = [_source(node.func)]
+        parts += [_source(entry) for entry in node.args]
+        if None in parts or node.keywords:
+            return None
+        return '%s(%s)' % (parts[0], ', '.join(parts[1:]))
+    return None
@@ -20,13 +20,17 @@
 #
 # *****************************************************************************
 
-import re
+import sys
+import Queue
+import itertools
 from os import path
+from fnmatch import fnmatch
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import conduct
-from conduct.param import Referencer
-from conduct.util import loadChainDefinition, importFromPath
+from conduct.param import Referencer, createReferencer
+from conduct.util import loadChainDefinition, importFromPath, ChrootSessions
 
 
 class Chain(object):
@@ -34,28 +38,196 @@ class Chain(object):
         self.name = name
         self.steps = OrderedDict()
         self.params = {}
+        self.referenceContext = None # shared format context of referencers
+        # changed on each parameter change of any step (invalidates the
+        # memoized results of the referencers)
+        self.paramsVersion = 0
+        self._versions = itertools.count(1)
 
         self._chainDef = {}
+        self._dependencies = OrderedDict() # step name -> set of step names
+        self._references = {} # step name -> names of the referenced steps
+        self._order = [] # topological order of the steps
 
         self._initLogger()
+
+        # pseudo fs mounts of chroot dirs, shared by all steps
+        self.chroots = ChrootSessions(log=self.log)
+
         self._loadChainDefinition()
         self._applyParamValues(paramValues)
 
 
-    def build(self):
+    def build(self, journal=None, resume=False, selection=None,
+              resumable=False):
+        '''
+        Build all steps (or only the given selected ones, see selectSteps).
+        Completed steps are recorded in the given build journal (if any);
+        if resume is set, the steps recorded by the former build are
+        restored instead of built again.
+
+        If a journaled build fails and is resumable (or only a selection
+        is built), the cleanup is deferred: the build can be resumed. The
+        cleanup happens as soon as the chain is built completely (or by
+        the next build that neither resumes nor selects steps).
+        '''
+        jobs = self.jobs
+        done = set()
+        failed = True # (also on interrupts)
+
+        if resume:
+            done.update(journal.resume(self))
+            self.log.info('Resume build; %d step(s) already built'
+                          % len(done))
+        elif selection is not None:
+            done.update(self._prepareSelection(selection, journal))
+
         try:
-            for step in self.steps.values():
-                step.build()
-        except Exception:
+            if jobs > 1:
+                self._buildParallel(jobs, done, journal)
+            else:
+                for index, name in enumerate(self._order):
+                    if name not in done:
+                        self.steps[name].build()
+                        if journal is not None:
+                            journal.complete(self.steps[name])
+                    self._releaseUnusedChroots(self._order[index + 1:])
+            failed = False
+        except Exception as exc:
+            self.log.exception(exc)
             self.log.error('CHAIN BUILD FAILED')
             raise RuntimeError('Chain failed: %s' % self.name)
         finally:
-            for step in reversed(self.steps.values()):
-                try:
-                    step.cleanupBuild()
-                except Exception:
-                    self.log.warn('Cleanup of buildstep failed;'
-                                 ' Continue with next one')
+            # pseudo fs have to be gone before cleaning up the chroot dirs
+            try:
+                self.chroots.teardown()
+            except Exception:
+                self.log.warn('Could not unmount chroot pseudo file systems')
+
+            if journal is not None and journal.steps \
+                and ((failed and resumable) or selection is not None):
+                self.log.info('Cleanup deferred; Continue the build with '
+                              '--resume')
+            else:
+                if journal is not None:
+                    journal.remove()
+                self._cleanupSteps()
+
+    def selectSteps(self, only=None, fromStep=None, untilStep=None):
+        '''
+        Names of the steps (in build order) matching any of the given
+        names/glob patterns (only), starting with the first step matching
+        fromStep and ending with the last step matching untilStep.
+        '''
+        order = self._order
+
+        if fromStep:
+            order = order[self._matchSteps(fromStep)[0]:]
+        if untilStep:
+            order = order[:self._matchSteps(untilStep, order)[-1] + 1]
+        if only:
+            for pattern in only:
+                self._matchSteps(pattern)
+            order = [name for name in order
+                     if any(fnmatch(name, pattern) for pattern in only)]
+
+        return order
+
+    def paramsChanged(self):
+        # (unique values: concurrent changes never end up with a value a
+        # result was memoized for)
+        self.paramsVersion = next(self._versions)
+
+    def requiredSteps(self, names):
+        '''
+        The given steps and all the steps they depend on (transitively,
+        by references and implicit dependencies; not by the after/before
+        hints or the definition order).
+        '''
+        result = set()
+        pending = list(names)
+
+        while pending:
+            name = pending.pop()
+            if name in result:
+                continue
+            result.add(name)
+            pending.extend(self._references[name])
+            if hasattr(self.steps[name], 'implicitDependencies'):
+                pending.extend(self.steps[name].implicitDependencies())
+
+        return result
+
+    def _matchSteps(self, pattern, order=None):
+        '''
+        Positions (in the given or the build order) of the steps matching
+        the given name/glob pattern.
+        '''
+        order = self._order if order is None else order
+        result = [index for index, name in enumerate(order)
+                  if fnmatch(name, pattern)]
+        if not result:
+            self.log.error('No step matches: %s' % pattern)
+            raise RuntimeError('No step matches: %s' % pattern)
+        return result
+
+    def _prepareSelection(self, selection, journal):
+        '''
+        Prepare the build of the given selected steps: The steps they
+        require are restored from the journal if they were recorded with
+        the same parameters (and built otherwise), the remaining steps are
+        left out. Returns the names of the steps not to build.
+        '''
+        required = self.requiredSteps(selection)
+        self.log.info('Build selected step(s): %s' % ', '.join(selection))
+
+        # coalesced groups must not span selected and other steps
+        for name, step in self.steps.items():
+            leader = getattr(step, 'coalescedInto', None)
+            if leader is not None \
+                and (name in selection) != (leader.name in selection):
+                leader.coalesced.remove(step)
+                step.coalescedInto = None
+
+        restored = set()
+        if journal is not None:
+            # the former state of the selected steps is replaced
+            journal.discard(selection, self.log)
+
+            for name in self._order:
+                if name not in required or name in selection:
+                    continue
+                # only if all its prerequisites are restored as well
+                if self.requiredSteps([name]) - set([name]) <= restored \
+                    and journal.restoreStep(self.steps[name]):
+                    restored.add(name)
+
+        rebuilt = required - restored - set(selection)
+        if rebuilt:
+            self.log.info('Build required step(s): %s'
+                          % ', '.join(name for name in self._order
+                                      if name in rebuilt))
+
+        return (set(self.steps) - required) | restored
+
+    def _cleanupSteps(self):
+        for name in reversed(self._order):
+            try:
+                self.steps[name].cleanupBuild()
+            except Exception:
+                self.log.warn('Cleanup of buildstep failed;'
+                             ' Continue with next one')
+
+    @property
+    def jobs(self):
+        '''
+        Number of steps that may be built concurrently.
+        '''
+        return max(int(conduct.app.cfg.get('jobs', 1)), 1)
+
+    @property
+    def dependencies(self):
+        return self._dependencies
 
 
     @property
@@ -79,12 +251,17 @@ class Chain(object):
 
         # create build steps
         self._createSteps()
+        self._createDependencyGraph()
 
     def _createSteps(self):
         for name, definition in self._chainDef['steps'].items():
             # name should be step:name or chain:name
             entryType, entryName = definition[0].split(':')
 
+            params = self._createReferencers(definition[1])
+            self._references[name] = self._findStepReferences(params)
+            self._dependencies[name] = set(self._references[name])
+
             if entryType == 'step':
                 cls = importFromPath(entryName, ('conduct.buildsteps.',))
                 # for steps, the entryName should be a full path (mod.class)
@@ -92,20 +269,192 @@ class Chain(object):
                 #mod = __import__(clsMod)
                 #cls = getattr(mod, clsName)
 
-                params = self._createReferencers(definition[1])
                 self.steps[name] = cls(name, params, self)
             else:
                 # TODO parameter forwarding
                 self.steps[name] = Chain(entryName)
 
-    def _createReferencers(self, paramValues):
-        for paramName, paramValue in paramValues.items():
-            if isinstance(paramValue, str) \
-                and re.findall('\{(.*?)\}', paramValue):
-                    paramValues[paramName] = Referencer(paramValue)
+    def _createDependencyGraph(self):
+        '''
+        Complete the dependencies (determined by the references) by the
+        explicit after/before hints and determine the build order.
 
-        return paramValues
+        Chains that are not marked as parallel keep their definition order
+        (each step depends on its predecessor).
+        '''
+        names = list(self._dependencies.keys())
+
+        for index, name in enumerate(names):
+            definition = self._chainDef['steps'][name]
+            step = self.steps[name]
+            deps = self._dependencies[name]
 
+            deps.update(definition[1].get('after', []))
+            if hasattr(step, 'implicitDependencies'):
+                deps.update(step.implicitDependencies())
 
+            if not self._chainDef['parallel'] and index > 0:
+                deps.add(names[index - 1])
 
+            for successor in definition[1].get('before', []):
+                if successor not in self._dependencies:
+                    raise RuntimeError('%s: Unknown step in before hint: %s'
+                                       % (name, successor))
+                self._dependencies[successor].add(name)
 
+        for name, deps in self._dependencies.items():
+            unknown = deps - set(names)
+            if unknown:
+                raise RuntimeError('%s: Depends on unknown step(s): %s'
+                                   % (name, ', '.join(sorted(unknown))))
+            deps.discard(name)
+
+        if self._chainDef['coalesce']:
+            self._coalesceSteps()
+
+        self._order = self._sortTopologically()
+
+        for name in self._order:
+            self.log.debug('Step %s depends on: %s'
+                           % (name, ', '.join(sorted(
+                               self._dependencies[name])) or '-'))
+
+    def _coalesceSteps(self):
+        '''
+        Let adjacent steps that support it be built together by the first
+        one of each group. The group leader inherits the dependencies of
+        the others which depend on the leader in turn.
+        '''
+        leader = None
+
+        for name, step in self.steps.items():
+            canCoalesce = getattr(leader, 'canCoalesce', None)
+            if canCoalesce is not None and canCoalesce(step):
+                self.log.debug('Build %s together with %s'
+                               % (name, leader.name))
+                leader.coalesce(step)
+                group = set([leader.name] + [entry.name
+                                             for entry in leader.coalesced])
+                self._dependencies[leader.name].update(
+                    self._dependencies[name] - group)
+                self._dependencies[name].add(leader.name)
+            else:
+                leader = step
+
+    def _sortTopologically(self):
+        '''
+        Sort the steps topologically. Steps without mutual dependencies
+        keep their definition order.
+        '''
+        order = []
+        done = set()
+        pending = list(self._dependencies.keys())
+
+        while pending:
+            for name in pending:
+                if self._dependencies[name] <= done:
+                    break
+            else:
+                raise RuntimeError('Cyclic step dependencies: %s'
+                                   % ', '.join(pending))
+
+            pending.remove(name)
+            done.add(name)
+            order.append(name)
+
+        return order
+
+    def _buildParallel(self, jobs, done, journal):
+        '''
+        Build the steps (except the given done ones) on a pool of the
+        given number of worker threads. Each step is started as soon as
+        all its dependencies are built. On the first failure no further
+        steps are started.
+        '''
+        self.log.info('Build with up to %d concurrent steps' % jobs)
+
+        pool = ThreadPool(jobs)
+        results = Queue.Queue()
+        pending = [name for name in self._order if name not in done]
+        running = set()
+        error = None
+
+        def buildStep(name):
+            try:
+                self.steps[name].build()
+                results.put((name, None))
+            except Exception:
+                results.put((name, sys.exc_info()))
+
+        try:
+            while True:
+                if error is None:
+                    for name in list(pending):
+                        if len(running) >= jobs:
+                            break
+                        if self._dependencies[name] <= done:
+                            pending.remove(name)
+                            running.add(name)
+                            pool.apply_async(buildStep, (name,))
+
+                if not running:
+                    break
+
+                # a timeout keeps the wait interruptible
+                name, excInfo = results.get(True, 3600 * 24 * 365)
+                running.remove(name)
+
+                if excInfo is None:
+                    done.add(name)
+                    if journal is not None:
+                        journal.complete(self.steps[name])
+                    self._releaseUnusedChroots(pending + list(running))
+                elif error is None:
+                    error = excInfo
+                    if pending:
+                        self.log.error('Step %s failed; Cancel %d pending '
+                                       'step(s): %s' % (name, len(pending),
+                                                        ', '.join(pending)))
+        finally:
+            pool.close()
+            pool.join()
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def _releaseUnusedChroots(self, remaining):
+        '''
+        Unmount the chroot pseudo file systems as soon as none of the
+        remaining steps uses a chroot anymore.
+        '''
+        if not self.chroots.active:
+            return
+
+        for name in remaining:
+            if 'chrootdir' in getattr(self.steps[name], 'parameters', {}):
+                return
+
+        self.log.debug('No chrooted steps left; Release chroots')
+        self.chroots.teardown()
+
+    def _findStepReferences(self, paramValues):
+        '''
+        Determine the steps referenced ({steps.NAME...}) by the given
+        parameter values (with referencers already created).
+        '''
+        result = set()
+
+        for value in paramValues.values():
+            if isinstance(value, Referencer):
+                result.update(value.referencedSteps)
+
+        return result
+
+    def _createReferencers(self, paramValues):
+        # (the referencers and their memos belong to this chain, not to
+        # the cached chain definition)
+        paramValues = dict(paramValues)
+        for paramName, paramValue in paramValues.items():
+            paramValues[paramName] = createReferencer(paramValue)
+
+        return paramValues
@@ -27,6 +27,9 @@
 
 _codes = {}
 
+# incremented on changes of the codes (for users caching colored strings)
+generation = 0
+
 _attrs = {
     'reset':     '39;49;00m',
     'bold':      '01m',
@@ -64,5 +67,7 @@ def colorcode(name):
 
 
 def nocolor():
+    global generation
     for key in list(_codes):
         _codes[key] = ''
+    generation += 1
@@ -0,0 +1,181 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Persistent history of the builds (SQLite): chain, parameters, buildinfo
+and the duration, attempts and result of each step.
+'''
+
+import json
+import time
+import sqlite3
+from os import path
+
+from conduct.util import ensureDirectory
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chain TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    result TEXT NOT NULL,
+    params TEXT NOT NULL,
+    buildinfo TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_chain ON runs (chain, started);
+CREATE TABLE IF NOT EXISTS steps (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    class TEXT NOT NULL,
+    duration REAL,
+    attempts INTEGER NOT NULL,
+    result TEXT,
+    PRIMARY KEY (run, seq)
+);
+'''
+
+# seconds a writer waits for a locked database (concurrent builds)
+LOCK_TIMEOUT = 30.0
+
+
+class BuildHistory(object):
+    '''
+    Build runs stored in the given database file. Only the newest maxruns
+    runs per chain, none older than maxage days, are kept.
+    '''
+
+    def __init__(self, dbFile, maxruns=200, maxage=90.0):
+        self.dbFile = path.abspath(dbFile)
+        self.maxruns = maxruns
+        self.maxage = maxage
+
+        ensureDirectory(path.dirname(self.dbFile))
+        self._db = sqlite3.connect(self.dbFile, timeout=LOCK_TIMEOUT)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA foreign_keys = ON')
+        # free pages of removed runs are given back (before any table exists)
+        self._db.execute('PRAGMA auto_vacuum = FULL')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def record(self, chain, params, buildinfo, started, duration, failed,
+               steps):
+        '''
+        Store a finished run; steps is a list of dicts (name, class,
+        duration, attempts, result). Returns the id of the new run.
+        '''
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT INTO runs (chain, started, duration, result, params, '
+                'buildinfo) VALUES (?, ?, ?, ?, ?, ?)',
+                (chain, started, duration, 'failed' if failed else 'success',
+                 _toJson(params), _toJson(buildinfo)))
+            runId = cursor.lastrowid
+
+            self._db.executemany(
+                'INSERT INTO steps (run, seq, name, class, duration, '
+                'attempts, result) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(runId, seq, step['name'], step['class'], step['duration'],
+                  step['attempts'], step['result'])
+                 for seq, step in enumerate(steps)])
+
+        self.prune()
+        return runId
+
+    def prune(self):
+        '''
+        Remove the runs beyond the retention limits.
+        '''
+        with self._db:
+            if self.maxage:
+                self._db.execute('DELETE FROM runs WHERE started < ?',
+                                 (time.time() - self.maxage * 86400,))
+            if self.maxruns:
+                self._db.execute(
+                    'DELETE FROM runs WHERE id IN (SELECT id FROM runs AS r '
+                    'WHERE (SELECT COUNT(*) FROM runs WHERE chain = r.chain '
+                    'AND id > r.id) >= ?)', (self.maxruns,))
+
+    def runs(self, chain=None, limit=20):
+        '''
+        The newest runs (of the given chain), newest first.
+        '''
+        if chain is None:
+            return self._db.execute('SELECT * FROM runs ORDER BY id DESC '
+                                    'LIMIT ?', (limit,)).fetchall()
+        return self._db.execute('SELECT * FROM runs WHERE chain = ? '
+                                'ORDER BY id DESC LIMIT ?',
+                                (chain, limit)).fetchall()
+
+    def run(self, runId):
+        row = self._db.execute('SELECT * FROM runs WHERE id = ?',
+                               (runId,)).fetchone()
+        if row is None:
+            raise RuntimeError('Unknown build run: %s' % runId)
+        return row
+
+    def steps(self, runId):
+        return self._db.execute('SELECT * FROM steps WHERE run = ? '
+                                'ORDER BY seq', (runId,)).fetchall()
+
+    def compare(self, oldRunId, newRunId, threshold=20.0, minDelta=1.0):
+        '''
+        Compare the steps of two runs. Returns a list of dicts (name,
+        old, new, delta, regressed); a step regressed if it took more than
+        threshold percent and more than minDelta seconds longer.
+        '''
+        oldSteps = dict((row['name'], row) for row in self.steps(oldRunId))
+        result = []
+
+        for row in self.steps(newRunId):
+            old = oldSteps.pop(row['name'], None)
+            entry = {
+                'name' : row['name'],
+                'old' : old,
+                'new' : row,
+                'delta' : None,
+                'regressed' : False,
+            }
+
+            if old is not None and old['duration'] is not None \
+                and row['duration'] is not None:
+                delta = row['duration'] - old['duration']
+                entry['delta'] = delta
+                entry['regressed'] = delta > minDelta \
+                    and delta > old['duration'] * threshold / 100.0
+
+            result.append(entry)
+
+        # steps that only exist in the old run
+        for name, old in oldSteps.items():
+            result.append({'name' : name, 'old' : old, 'new' : None,
+                           'delta' : None, 'regressed' : False})
+
+        return result
+
+
+def _toJson(value):
+    return json.dumps(value, sort_keys=True, default=repr)
@@ -0,0 +1,223 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Journal of the completed steps of a chain build, used to resume a failed
+build (and to clean up after it later).
+'''
+
+import os
+import hashlib
+import cPickle as pickle
+from os import path
+from collections import OrderedDict
+
+from conduct.cache import canonicalRepr
+from conduct.util import ensureDirectory, importFromPath
+
+# increment on changes of the journal format
+JOURNAL_VERSION = 1
+
+
+class BuildJournal(object):
+    '''
+    The completed steps (class, resolved parameters and outparameters) of
+    the build of one chain, written after each completed step.
+    '''
+
+    def __init__(self, journalFile, chainName, fingerprint):
+        self.journalFile = journalFile
+        self.chainName = chainName
+        self.fingerprint = fingerprint
+
+        # fingerprint of the chain the stored steps belong to
+        self.storedFingerprint = None
+        self.steps = OrderedDict() # step name -> entry
+        # cleared as soon as a step can't be recorded
+        self.enabled = True
+
+        self._load()
+
+    @property
+    def valid(self):
+        '''
+        Whether the stored steps belong to the same chain definition and
+        parameters.
+        '''
+        return self.storedFingerprint == self.fingerprint
+
+    def complete(self, step):
+        '''
+        Record the given (successfully built) step.
+        If its state can't be stored, journaling is disabled for the rest
+        of the build (which can't be resumed then).
+        '''
+        if not self.enabled:
+            return
+
+        # steps of a changed chain never make the journal valid for
+        # resuming (see restoreStep for selective builds)
+        if not self.steps:
+            self.storedFingerprint = self.fingerprint
+
+        # recorded steps cleaned up meanwhile (generic.TriggerCleanup)
+        # must not be cleaned up again after a resume
+        chainSteps = getattr(step.chain, 'steps', {})
+        for name, entry in self.steps.items():
+            if name in chainSteps and not chainSteps[name].wasRun:
+                entry['wasRun'] = False
+
+        self.steps[step.name] = step.journalEntry()
+        try:
+            self._store()
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            step.log.warning('Cannot record the step in the build journal '
+                             '(%s); The build cannot be resumed' % e)
+            self.enabled = False
+            self.remove()
+
+    def resume(self, chain):
+        '''
+        Restore the recorded steps of the given chain.
+        Returns the names of the restored steps.
+        '''
+        if not self.valid:
+            raise RuntimeError('Chain definition or parameters changed '
+                               'since the build to resume')
+
+        for name, entry in self.steps.items():
+            chain.steps[name].restoreJournalEntry(entry)
+
+        return list(self.steps)
+
+    def restoreStep(self, step):
+        '''
+        Restore the given step if it was recorded with the same class and
+        the same (resolved) parameters, regardless of other changes of
+        the chain. Returns whether the step was restored.
+        '''
+        entry = self.steps.get(step.name)
+        if entry is None:
+            return False
+
+        try:
+            current = step.journalEntry()
+        except Exception:
+            # parameters can't be resolved (yet)
+            return False
+
+        if current['class'] != entry['class'] \
+            or current['params'] != entry['params']:
+            return False
+
+        step.restoreJournalEntry(entry)
+        return True
+
+    def discard(self, names, log):
+        '''
+        Clean up and forget the recorded state of the given steps.
+        '''
+        names = [name for name in self.steps if name in names]
+        if not names:
+            return
+
+        for name in reversed(names):
+            self._cleanupStep(name, log)
+            del self.steps[name]
+        self._store()
+
+    def cleanup(self, log):
+        '''
+        Clean up the recorded steps (of a former build that was not
+        resumed), by their stored parameters. Removes the journal.
+        '''
+        for name in reversed(self.steps.keys()):
+            self._cleanupStep(name, log)
+
+        self.remove()
+
+    def remove(self):
+        self.steps.clear()
+        self.storedFingerprint = None
+        if path.exists(self.journalFile):
+            os.remove(self.journalFile)
+
+    def _cleanupStep(self, name, log):
+        entry = self.steps[name]
+        try:
+            cls = importFromPath(entry['class'], log=log)
+            step = cls(name, dict(entry['params']))
+            step.restoreJournalEntry(entry)
+            step.cleanupBuild()
+        except Exception as e:
+            log.warning('Deferred cleanup of step %s failed: %s'
+                        % (name, e))
+
+    def _load(self):
+        try:
+            with open(self.journalFile, 'rb') as f:
+                journal = pickle.load(f)
+        except Exception:
+            # missing or broken: nothing to resume
+            return
+
+        if journal.get('version') == JOURNAL_VERSION \
+            and journal.get('chain') == self.chainName:
+            self.storedFingerprint = journal['fingerprint']
+            self.steps = journal['steps']
+
+    def _store(self):
+        journal = {
+            'version' : JOURNAL_VERSION,
+            'chain' : self.chainName,
+            'fingerprint' : self.storedFingerprint,
+            'steps' : self.steps,
+        }
+
+        ensureDirectory(path.dirname(path.abspath(self.journalFile)))
+        tmpFile = '%s.%d.tmp' % (self.journalFile, os.getpid())
+
+        try:
+            with open(tmpFile, 'wb') as f:
+                pickle.dump(journal, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            os.remove(tmpFile)
+            raise
+        os.rename(tmpFile, self.journalFile)
+
+
+def chainFingerprint(chainFile, params):
+    '''
+    Fingerprint of a chain build: the chain definition file and the
+    chain parameter values.
+    '''
+    fingerprint = hashlib.sha1()
+
+    with open(chainFile, 'rb') as f:
+        fingerprint.update(f.read())
+
+    fingerprint.update('\0')
+    fingerprint.update(canonicalRepr(params))
+
+    return fingerprint.hexdigest()
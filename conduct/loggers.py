@@ -25,6 +25,9 @@
 import os
 import sys
 import time
+import fcntl
+import atexit
+import threading
 import linecache
 import traceback
 import logging
@@ -39,6 +42,11 @@ DATEFMT = '%H:%M:%S'
 DATESTAMP_FMT = '%Y-%m-%d'
 SECONDS_PER_DAY = 60 * 60 * 24
 
+# default interval (s) of the background writer (async logging)
+FLUSH_INTERVAL = 0.2
+# buffered amount of data that triggers an immediate flush
+FLUSH_THRESHOLD = 256 * 1024
+
 LOGLEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
 INVLOGLEVELS = {value : key for key, value in LOGLEVELS.items()}
 
@@ -86,6 +94,10 @@ class ConsoleFormatter(Formatter):
     """
     A lightweight formatter for the interactive console, with optional
     colored output.
+
+    The (colorized) format templates are cached per level, logger name
+    width and exception type (until the colors are switched off), the
+    timestamp string per second.
     """
 
     def __init__(self, fmt=None, datefmt=None, colorize=None):
@@ -95,45 +107,75 @@ class ConsoleFormatter(Formatter):
         else:
             self.colorize = lambda c, s: s
 
+        self._templates = {}
+        self._colorGeneration = colors.generation
+        self._timeCache = (None, None, '') # (second, datefmt, string)
+
     def formatException(self, exc_info):
         return traceback.format_exception_only(*exc_info[0:2])[-1]
 
     def formatTime(self, record, datefmt=None):
-        return time.strftime(datefmt or DATEFMT,
-                             self.converter(record.created))
+        second = int(record.created)
+        cachedSecond, cachedFmt, result = self._timeCache
+
+        if second != cachedSecond or datefmt != cachedFmt:
+            result = time.strftime(datefmt or DATEFMT,
+                                   self.converter(record.created))
+            self._timeCache = (second, datefmt, result)
+
+        return result
 
     def format(self, record):
         record.message = record.getMessage()
         levelno = record.levelno
-        datefmt = self.colorize('lightgray', '[%(asctime)s] ')
-        namefmt = '%(name)-' + str(ConductLogger.maxLogNameLength) + 's: '
+
+        excName = None
+        if levelno > WARNING and record.exc_info:
+            excName = record.exc_info[0].__name__
+        nonl = getattr(record, 'nonl', False)
+
+        if self._colorGeneration != colors.generation:
+            # colors.nocolor() called meanwhile
+            self._templates = {}
+            self._colorGeneration = colors.generation
+
+        key = (levelno, ConductLogger.maxLogNameLength, excName, nonl)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._createTemplate(*key)
+            self._templates[key] = template
+
+        record.asctime = self.formatTime(record, self.datefmt)
+        # never output more exception info -- the exception message is already
+        # part of the log message because of our special logger behavior
+        return template % (record.asctime, record.name, record.levelname,
+                           record.message)
+
+    def _createTemplate(self, levelno, nameLength, excName, nonl):
+        '''
+        Create the format template (positional: asctime, name, levelname,
+        message) for the given record properties.
+        '''
+        datefmt = self.colorize('lightgray', '[%s] ')
+        namefmt = '%-' + str(nameLength) + 's: '
         if levelno <= DEBUG:
-            fmtstr = self.colorize('darkgray', '%s%%(message)s' % namefmt)
+            fmtstr = self.colorize('darkgray', '%s%%.0s%%s' % namefmt)
         elif levelno <= INFO:
-            fmtstr = '%s%%(message)s' % namefmt
+            fmtstr = '%s%%.0s%%s' % namefmt
         elif levelno <= WARNING:
-            fmtstr = self.colorize('fuchsia', '%s%%(levelname)s: %%(message)s'
-                                   % namefmt)
+            fmtstr = self.colorize('fuchsia', '%s%%s: %%s' % namefmt)
         else:
             # Add exception type to error (if caused by exception)
             msgPrefix = ''
-            if record.exc_info:
-                msgPrefix = '%s: ' % record.exc_info[0].__name__
+            if excName:
+                msgPrefix = '%s: ' % excName.replace('%', '%%')
 
-            fmtstr = self.colorize('red', '%s%%(levelname)s: %s%%(message)s'
+            fmtstr = self.colorize('red', '%s%%s: %s%%s'
                                    % (namefmt, msgPrefix))
         fmtstr = datefmt + fmtstr
-        if not getattr(record, 'nonl', False):
+        if not nonl:
             fmtstr += '\n'
-        record.asctime = self.formatTime(record, self.datefmt)
-        s = fmtstr % record.__dict__
-        # never output more exception info -- the exception message is already
-        # part of the log message because of our special logger behavior
-        # if record.exc_info:
-        #    # *not* caching exception text on the record, since it's
-        #    # only a short version
-        #    s += self.formatException(record.exc_info)
-        return s
+        return fmtstr
 
 
 def format_extended_frame(frame):
@@ -191,6 +233,135 @@ class LogfileFormatter(Formatter):
         return res
 
 
+class AsyncWriter(object):
+    """
+    Collects the formatted log records of all handlers and writes them
+    in batches by a background thread: on a timer, if enough data is
+    buffered, on errors and on demand (e.g. at step boundaries).
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, threshold=FLUSH_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+
+        self._buffers = {} # stream -> list of strings
+        self._streams = [] # in order of first use
+        self._size = 0
+        self._lock = threading.Lock() # protects the buffers
+        self._writeLock = threading.Lock() # serializes the actual writes
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='log writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, stream, data, flush=False):
+        with self._lock:
+            if stream not in self._buffers:
+                self._buffers[stream] = []
+                self._streams.append(stream)
+            self._buffers[stream].append(data)
+            self._size += len(data)
+            full = self._size >= self.threshold
+
+        if flush or self._stopped:
+            self.flush()
+        elif full:
+            self._wakeup.set()
+
+    def flush(self, stream=None):
+        """
+        Write the buffered data (of all streams or the given one).
+        """
+        with self._writeLock:
+            with self._lock:
+                if stream is None:
+                    batches = [(entry, self._buffers.pop(entry))
+                               for entry in self._streams]
+                    self._streams = []
+                    self._size = 0
+                elif stream in self._buffers:
+                    batches = [(stream, self._buffers.pop(stream))]
+                    self._streams.remove(stream)
+                    self._size -= sum(len(entry) for entry in batches[0][1])
+                else:
+                    batches = []
+
+            for entry, data in batches:
+                _writeStream(entry, ''.join(data))
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # never let the writer die (e.g. on closed streams)
+                pass
+
+
+_asyncWriter = None
+
+
+def enableAsyncLogging(interval=FLUSH_INTERVAL):
+    """
+    Let all conduct handlers write by a background writer (batched).
+    All records are written at exit at the latest.
+    """
+    global _asyncWriter
+
+    if _asyncWriter is None:
+        _asyncWriter = AsyncWriter(interval)
+        atexit.register(disableAsyncLogging)
+
+
+def disableAsyncLogging():
+    global _asyncWriter
+
+    if _asyncWriter is not None:
+        writer, _asyncWriter = _asyncWriter, None
+        writer.stop()
+
+
+def reinitAfterFork():
+    """
+    Drop the logging state inherited by a forked process: the background
+    writer (its thread only exists in the parent) and the shared log
+    file writers (their locks may be held by threads of the parent).
+    """
+    global _asyncWriter, _logfileWriters, _logfileWritersLock
+
+    _asyncWriter = None
+    _logfileWriters = {}
+    _logfileWritersLock = threading.Lock()
+
+
+def flushLogs(stream=None):
+    """
+    Write all pending records (of the given stream or all streams).
+    """
+    writer = _asyncWriter
+    if writer is not None:
+        writer.flush(stream)
+
+
+def _writeStream(stream, data):
+    try:
+        stream.write(data)
+    except UnicodeEncodeError:
+        stream.write(data.encode('utf-8'))
+    stream.flush()
+
+
 class StreamHandler(Handler):
     """Reimplemented from logging: remove cruft, remove bare excepts."""
 
@@ -201,6 +372,7 @@ class StreamHandler(Handler):
         self.stream = stream
 
     def flush(self):
+        flushLogs(self.stream)
         self.acquire()
         try:
             if self.stream and hasattr(self.stream, 'flush'):
@@ -210,64 +382,203 @@ class StreamHandler(Handler):
 
     def emit(self, record):
         try:
-            msg = self.format(record)
-            try:
-                self.stream.write('%s\n' % msg)
-            except UnicodeEncodeError:
-                self.stream.write('%s\n' % msg.encode('utf-8'))
-            self.flush()
+            self._write('%s\n' % self.format(record), record)
         except Exception:
             self.handleError(record)
 
+    def _write(self, msg, record):
+        writer = _asyncWriter
+        if writer is not None:
+            # errors are written immediately
+            writer.write(self.stream, msg, record.levelno >= ERROR)
+            return
 
-class LogfileHandler(StreamHandler):
+        try:
+            self.stream.write(msg)
+        except UnicodeEncodeError:
+            self.stream.write(msg.encode('utf-8'))
+        self.flush()
+
+
+class LogfileWriter(object):
     """
-    Logs to log files with a date stamp appended, and rollover on midnight.
+    The (single) writer of a log file series with a date stamp appended,
+    shared by all handlers of the same file (see getLogfileWriter) and
+    responsible for the rollover on midnight.
+
+    Each write is appended as a whole (O_APPEND, under an exclusive
+    flock), so several conduct processes can log to the same file.
     """
 
     def __init__(self, directory, filenameprefix, dayfmt=DATESTAMP_FMT):
-        self._directory = path.join(directory, filenameprefix)
-        if not path.isdir(self._directory):
-            os.makedirs(self._directory)
-        self._currentsymlink = path.join(self._directory, 'current')
-        self._filenameprefix = filenameprefix
-        self._pathnameprefix = path.join(self._directory, filenameprefix)
+        self.directory = directory
+        if not path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._currentsymlink = path.join(self.directory, 'current')
+        self._pathnameprefix = path.join(self.directory, filenameprefix)
         self._dayfmt = dayfmt
-        # today's logfile name
-        basefn = self._pathnameprefix + '-' + time.strftime(dayfmt) + '.log'
-        self.baseFilename = path.abspath(basefn)
-        self.mode = 'a'
-        StreamHandler.__init__(self, self._open())
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+        self.users = 0
+        self.baseFilename = None
+        self.rollover_at = None
+        self._open()
+
+    def write(self, data):
+        with self._lock:
+            if time.time() >= self.rollover_at or self._pid != os.getpid():
+                # a forked process needs its own file description (the
+                # flock is shared with the parent otherwise)
+                self._close()
+            if self._fd is None:
+                self._open()
+
+            if isinstance(data, unicode):
+                data = data.encode('ascii')
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(self._fd, view):]
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def flush(self):
+        # all writes are unbuffered
+        pass
+
+    def reopen(self):
+        with self._lock:
+            self._close()
+            self._open()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _open(self):
         # determine time of first midnight from now on
         t = time.localtime()
         self.rollover_at = time.mktime((t[0], t[1], t[2], 0, 0, 0,
                                         t[6], t[7], t[8])) + SECONDS_PER_DAY
+        # today's logfile name
+        self.baseFilename = path.abspath(self._pathnameprefix + '-'
+                                         + time.strftime(self._dayfmt, t)
+                                         + '.log')
+        self._fd = os.open(self.baseFilename,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._pid = os.getpid()
+        self._updateSymlink()
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _updateSymlink(self):
+        # update 'current' symlink only if it does not point to today's
+        # logfile yet (replaced atomically)
+        if not hasattr(os, 'symlink'):
+            return
+
+        target = path.basename(self.baseFilename)
+        try:
+            if os.readlink(self._currentsymlink) == target:
+                return
+        except OSError:
+            # does not (yet) exist: should happen at most once per installation
+            pass
+
+        tmpLink = '%s.%d.tmp' % (self._currentsymlink, os.getpid())
+        try:
+            os.symlink(target, tmpLink)
+            os.rename(tmpLink, self._currentsymlink)
+        except OSError:
+            # another process did the same
+            if path.islink(tmpLink):
+                os.remove(tmpLink)
+
+
+_logfileWriters = {} # directory + prefix -> LogfileWriter
+_logfileWritersLock = threading.Lock()
+
+
+def getLogfileWriter(directory, filenameprefix, dayfmt=DATESTAMP_FMT):
+    """
+    The shared writer of the given log file series (created on first use).
+    Has to be released by releaseLogfileWriter.
+    """
+    key = path.join(path.abspath(directory), filenameprefix)
+
+    with _logfileWritersLock:
+        writer = _logfileWriters.get(key)
+        if writer is None:
+            writer = LogfileWriter(directory, filenameprefix, dayfmt)
+            _logfileWriters[key] = writer
+        writer.users += 1
+
+    return writer
+
+
+def releaseLogfileWriter(writer):
+    """
+    Release the given writer, close it if it is not used anymore.
+    """
+    with _logfileWritersLock:
+        writer.users -= 1
+        if writer.users > 0:
+            return
+
+        for key, entry in list(_logfileWriters.items()):
+            if entry is writer:
+                del _logfileWriters[key]
+
+    flushLogs(writer)
+    writer.close()
+
+
+class LogfileHandler(StreamHandler):
+    """
+    Logs to log files with a date stamp appended, and rollover on midnight.
+    All handlers of the same log file share one writer.
+    """
+
+    def __init__(self, directory, filenameprefix, dayfmt=DATESTAMP_FMT):
+        self._directory = path.join(directory, filenameprefix)
+        self._filenameprefix = filenameprefix
+        self._dayfmt = dayfmt
+        StreamHandler.__init__(self, getLogfileWriter(self._directory,
+                                                      filenameprefix, dayfmt))
         self.setFormatter(LogfileFormatter(LOGFMT, DATEFMT))
         self.disabled = False
+        self._children = {}
 
-    def getChild(self, name):
-        return LogfileHandler(self._directory, name)
+    @property
+    def baseFilename(self):
+        return self.stream.baseFilename
 
+    def getChild(self, name):
+        # reused (e.g. for nested chains of the same name)
+        child = self._children.get(name)
+        if child is None or child.stream is None:
+            child = LogfileHandler(self._directory, name, self._dayfmt)
+            self._children[name] = child
+        return child
 
     def filter(self, record):
         return not self.disabled
 
     def emit(self, record):
-        try:
-            t = int(time.time())
-            if t >= self.rollover_at:
-                self.doRollover()
-            if self.stream is None:
-                self.stream = self._open()
-            StreamHandler.emit(self, record)
-        except Exception:
-            self.handleError(record)
+        if self.stream is None:
+            return
+        StreamHandler.emit(self, record)
 
     def enable(self, enabled):
         if enabled:
             self.disabled = False
-            self.stream.close()
-            self.stream = self._open()
+            flushLogs(self.stream)
+            self.stream.reopen()
         else:
             self.disabled = True
 
@@ -275,34 +586,12 @@ class LogfileHandler(StreamHandler):
         self.acquire()
         try:
             if self.stream:
-                self.flush()
-                if hasattr(self.stream, 'close'):
-                    self.stream.close()
-                StreamHandler.close(self)
+                releaseLogfileWriter(self.stream)
                 self.stream = None
+            StreamHandler.close(self)
         finally:
             self.release()
 
-    def doRollover(self):
-        self.stream.close()
-        self.baseFilename = self._pathnameprefix + '-' + \
-            time.strftime(self._dayfmt) + '.log'
-        self.stream = self._open()
-        self.rollover_at += SECONDS_PER_DAY
-
-    def _open(self):
-        # update 'current' symlink upon open
-        try:
-            os.remove(self._currentsymlink)
-        except OSError:
-            # if the symlink does not (yet) exist, OSError is raised.
-            # should happen at most once per installation....
-            pass
-        if hasattr(os, 'symlink'):
-            os.symlink(path.basename(self.baseFilename), self._currentsymlink)
-        # finally open the new logfile....
-        return open(self.baseFilename, self.mode)
-
 
 class ColoredConsoleHandler(StreamHandler):
     """
@@ -315,9 +604,7 @@ class ColoredConsoleHandler(StreamHandler):
                                            colorize=colors.colorize))
 
     def emit(self, record):
-        msg = self.format(record)
         try:
-            self.stream.write(msg)
-        except UnicodeEncodeError:
-            self.stream.write(msg.encode('utf-8'))
-        self.stream.flush()
+            self._write(self.format(record), record)
+        except Exception:
+            self.handleError(record)
@@ -22,6 +22,7 @@
 # *****************************************************************************
 
 import re
+import string
 
 from os import path
 from collections import Iterable
@@ -49,21 +50,242 @@ class Parameter(object):
         self.type(value)
 
 
+# root names that may be referenced by parameter values
+REFERENCE_ROOTS = ('chain', 'steps', 'app', 'cfg', 'sysinfo', 'buildinfo')
+
+
 class Referencer(object):
+    '''
+    Parameter value that references other values (format string syntax,
+    e.g. '{steps.tmpdir.tmpdir}/mount').
+
+    The format string is parsed once into field accessors. Results are
+    memoized until the parameters of any step of the chain change (a
+    referenced value may itself reference other steps).
+    '''
+
+    _formatter = string.Formatter()
+
     def __init__(self, fmt):
         self.fmt = fmt
 
+        self._parts = [] # (literal text, field accessor, conversion, spec)
+        self._steps = set() # referenced step names
+        self._memoizable = True
+        self._memo = None # (memo key, result)
+
+        self._compile()
+
+    @classmethod
+    def containsReferences(cls, fmt):
+        '''
+        Check if the given string references any of the known roots
+        (other format fields, e.g. the ones of generic.Map, are ignored).
+        '''
+        try:
+            for _, fieldName, _, _ in cls._formatter.parse(fmt):
+                if fieldName is not None \
+                    and _splitField(fieldName)[0] in REFERENCE_ROOTS:
+                    return True
+        except ValueError:
+            # no valid format string at all
+            pass
+        return False
+
+    @property
+    def referencedSteps(self):
+        return frozenset(self._steps)
+
     def evaluate(self, chain, valType=str):
-        result = self.fmt.format(chain=Dataholder(chain.params),
-                            steps=Dataholder(chain.steps),
-                            app=conduct.app,
-                            cfg=OrderedAttrDict(conduct.app.cfg),
-                            sysinfo=OrderedAttrDict(conduct.app.sysinfo),
-                            buildinfo=OrderedAttrDict(conduct.app.buildinfo),
-                            )
+        key = self.memoKey(chain)
+
+        memo = self._memo
+        if key is not None and memo is not None and memo[0] == key:
+            result = memo[1]
+        else:
+            result = self._format(getReferenceContext(chain))
+            if key is not None:
+                self._memo = (key, result)
+
+        return valType(result)
+
+    def _compile(self):
+        for literal, fieldName, spec, conv in self._formatter.parse(self.fmt):
+            if fieldName is None:
+                self._parts.append((literal, None, None, None))
+                continue
+
+            if '{' in spec:
+                # nested fields in the format spec: evaluate the whole
+                # format string (no memoization of such rare cases)
+                self._parts = None
+                self._memoizable = False
+                return
+
+            first, rest = _splitField(fieldName)
+
+            if first == 'steps' and rest and rest[0][0]:
+                self._steps.add(rest[0][1])
+            elif first == 'app':
+                # arbitrary (mutable) application state
+                self._memoizable = False
+
+            self._parts.append((literal, (first, rest), conv, spec))
+
+    def memoKey(self, chain):
+        '''
+        Key that changes as soon as the result may change
+        (None if the result can't be memoized).
+        '''
+        if not self._memoizable:
+            return None
+
+        return (id(chain), chain.paramsVersion)
+
+    def _format(self, context):
+        if self._parts is None:
+            return self.fmt.format(**context)
+
+        result = []
+        for literal, field, conv, spec in self._parts:
+            result.append(literal)
+
+            if field is None:
+                continue
+
+            first, rest = field
+            obj = context[first]
+            for isAttr, key in rest:
+                obj = getattr(obj, key) if isAttr else obj[key]
+
+            if conv == 'r':
+                obj = repr(obj)
+            elif conv == 's':
+                obj = str(obj)
+
+            result.append(format(obj, spec))
+
+        return ''.join(result)
+
+
+class NestedReferencer(Referencer):
+    '''
+    Container (list, tuple, dict) parameter value that contains references.
+    '''
+
+    def __init__(self, container):
+        self.fmt = container
+
+        self._memo = None
+
+        self._entries = _createNestedReferencers(container)
+        self._referencers = []
+        self._collectReferencers(self._entries)
+
+        self._memoizable = all(entry._memoizable
+                               for entry in self._referencers)
+        self._steps = set()
+        for entry in self._referencers:
+            self._steps.update(entry._steps)
+
+    def evaluate(self, chain, valType=lambda value: value):
+        key = self.memoKey(chain)
+
+        memo = self._memo
+        if key is not None and memo is not None and memo[0] == key:
+            result = memo[1]
+        else:
+            result = self._resolve(self._entries, chain)
+            if key is not None:
+                self._memo = (key, result)
 
         return valType(result)
 
+    def _collectReferencers(self, value):
+        if isinstance(value, Referencer):
+            self._referencers.append(value)
+        elif isinstance(value, dict):
+            for entry in value.values():
+                self._collectReferencers(entry)
+        elif isinstance(value, (list, tuple)):
+            for entry in value:
+                self._collectReferencers(entry)
+
+    def _resolve(self, value, chain):
+        if isinstance(value, Referencer):
+            return value.evaluate(chain)
+        elif isinstance(value, dict):
+            return type(value)((key, self._resolve(entry, chain))
+                               for key, entry in value.items())
+        elif isinstance(value, (list, tuple)):
+            return type(value)(self._resolve(entry, chain)
+                               for entry in value)
+        return value
+
+
+def createReferencer(value):
+    '''
+    Create the appropriate referencer for the given parameter value,
+    or return the value itself if it does not contain any references.
+    '''
+    if isinstance(value, str):
+        if Referencer.containsReferences(value):
+            return Referencer(value)
+    elif isinstance(value, (list, tuple, dict)):
+        if _containsReferences(value):
+            return NestedReferencer(value)
+    return value
+
+
+def _containsReferences(value):
+    if isinstance(value, str):
+        return Referencer.containsReferences(value)
+    elif isinstance(value, dict):
+        return any(_containsReferences(entry) for entry in value.values())
+    elif isinstance(value, (list, tuple)):
+        return any(_containsReferences(entry) for entry in value)
+    return False
+
+
+def _createNestedReferencers(value):
+    if isinstance(value, str):
+        return createReferencer(value)
+    elif isinstance(value, dict):
+        return type(value)((key, _createNestedReferencers(entry))
+                           for key, entry in value.items())
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_createNestedReferencers(entry) for entry in value)
+    return value
+
+
+def _splitField(fieldName):
+    '''
+    Split a format field name into the first name and a list of
+    (is attribute, name or index) accessors.
+    '''
+    first, rest = fieldName._formatter_field_name_split()
+    return first, list(rest)
+
+
+def getReferenceContext(chain):
+    '''
+    The (read only) format context for references, shared per chain.
+    '''
+    context = getattr(chain, 'referenceContext', None)
+
+    if context is None:
+        context = {
+            'chain' : Dataholder(chain.params),
+            'steps' : Dataholder(chain.steps),
+            'app' : conduct.app,
+            'cfg' : AttrView(conduct.app.cfg),
+            'sysinfo' : AttrView(conduct.app.sysinfo),
+            'buildinfo' : AttrView(conduct.app.buildinfo),
+        }
+        chain.referenceContext = context
+
+    return context
+
 
 class Dataholder(object):
     def __init__(self, modelDict):
@@ -74,6 +296,23 @@ class Dataholder(object):
             return self._modelDict[name]
 
 
+class AttrView(object):
+    '''
+    Read only attribute and item access to the given dict (without copying).
+    '''
+    def __init__(self, modelDict):
+        self._modelDict = modelDict
+
+    def __getattr__(self, name):
+        try:
+            return self._modelDict[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return self._modelDict[name]
+
+
 # validators for parameter's type
 
 def convdoc(conv):
@@ -315,6 +554,18 @@ def subdir(val=''):
     return val
 
 
+def boolean(val=False):
+    """a boolean (strings like yes/no, on/off, true/false and 1/0 are accepted)"""
+    if isinstance(val, str):
+        lowered = val.strip().lower()
+        if lowered in ('yes', 'on', 'true', '1'):
+            return True
+        if lowered in ('no', 'off', 'false', '0', ''):
+            return False
+        raise ValueError('%r is not a valid boolean' % val)
+    return bool(val)
+
+
 def anytype(val=None):
     """any value"""
     return val
@@ -0,0 +1,286 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Timing and resource usage of chains, build steps (attempts, cleanups) and
+system calls, exported as JSON and as Chrome trace events (Perfetto,
+chrome://tracing).
+'''
+
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+# usage of the calling thread only (linux)
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+# ru_inblock/ru_oublock are counted in blocks of 512 bytes
+RUSAGE_BLOCK_SIZE = 512
+
+
+class Span(object):
+    '''
+    One measured section (inclusive of its nested sections and of the
+    child processes it waited for).
+
+    The memory of the conduct process itself can't be attributed to a
+    span: peakgrowth is only how much the process's peak RSS rose during
+    the span (by any thread). childmaxrss is the largest peak RSS of the
+    child processes the span waited for.
+    '''
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.wall = 0.0
+        self.utime = 0.0 # s
+        self.stime = 0.0 # s
+        self.readbytes = 0 # block I/O
+        self.writtenbytes = 0
+        self.childmaxrss = 0 # bytes
+        self.peakgrowth = 0 # bytes
+        self.failed = False
+
+    def addUsage(self, before, after):
+        self.utime += after.ru_utime - before.ru_utime
+        self.stime += after.ru_stime - before.ru_stime
+        self.readbytes += (after.ru_inblock - before.ru_inblock) \
+            * RUSAGE_BLOCK_SIZE
+        self.writtenbytes += (after.ru_oublock - before.ru_oublock) \
+            * RUSAGE_BLOCK_SIZE
+
+    def addChildUsage(self, usage):
+        self.utime += usage.ru_utime
+        self.stime += usage.ru_stime
+        self.readbytes += usage.ru_inblock * RUSAGE_BLOCK_SIZE
+        self.writtenbytes += usage.ru_oublock * RUSAGE_BLOCK_SIZE
+        self.childmaxrss = max(self.childmaxrss, usage.ru_maxrss * 1024)
+
+    def toDict(self):
+        return {
+            'name' : self.name,
+            'category' : self.category,
+            'thread' : self.thread,
+            'start' : self.start,
+            'wall' : self.wall,
+            'utime' : self.utime,
+            'stime' : self.stime,
+            'readbytes' : self.readbytes,
+            'writtenbytes' : self.writtenbytes,
+            'childmaxrss' : self.childmaxrss,
+            'peakgrowth' : self.peakgrowth,
+            'failed' : self.failed,
+            'args' : self.args,
+        }
+
+
+class Profiler(object):
+    '''
+    Collects the spans of one build (from all threads).
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.spans = []
+
+        self._lock = threading.Lock()
+        self._local = threading.local() # stack of the open spans per thread
+
+    @contextmanager
+    def measure(self, name, category, **args):
+        span = Span(name, category, args)
+        stack = self._stack()
+        before = _threadUsage()
+        peakBefore = _processPeak()
+
+        stack.append(span)
+        try:
+            yield span
+        except BaseException:
+            span.failed = True
+            raise
+        finally:
+            stack.pop()
+            span.wall = time.time() - span.start
+            span.addUsage(before, _threadUsage())
+            span.peakgrowth = _processPeak() - peakBefore
+            with self._lock:
+                self.spans.append(span)
+
+    def addChildUsage(self, usage):
+        '''
+        Account the resource usage (os.wait4) of a finished child process
+        to all open spans of the calling thread.
+        '''
+        for span in self._stack():
+            span.addChildUsage(usage)
+
+    def toDict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {
+            'start' : self.start,
+            'pid' : os.getpid(),
+            'spans' : [span.toDict() for span in spans],
+        }
+
+    def toTraceEvents(self):
+        '''
+        The spans as Chrome trace event format (complete events).
+        '''
+        pid = os.getpid()
+        threads = {}
+        events = []
+
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+
+        for span in spans:
+            if span.thread not in threads:
+                threads[span.thread] = len(threads) + 1
+                events.append({'name' : 'thread_name', 'ph' : 'M',
+                               'pid' : pid, 'tid' : threads[span.thread],
+                               'args' : {'name' : span.thread}})
+
+            args = dict(span.args)
+            args.update({
+                'utime_s' : round(span.utime, 3),
+                'stime_s' : round(span.stime, 3),
+                'read_bytes' : span.readbytes,
+                'written_bytes' : span.writtenbytes,
+                'child_max_rss_bytes' : span.childmaxrss,
+                'peak_rss_growth_bytes' : span.peakgrowth,
+                'failed' : span.failed,
+            })
+            events.append({
+                'name' : span.name,
+                'cat' : span.category,
+                'ph' : 'X',
+                'ts' : int((span.start - self.start) * 1e6),
+                'dur' : int(span.wall * 1e6),
+                'pid' : pid,
+                'tid' : threads[span.thread],
+                'args' : args,
+            })
+
+        return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+    def export(self, filePathPrefix):
+        '''
+        Write <prefix>.json and <prefix>.trace.json (Chrome trace events).
+        Returns the written file paths.
+        '''
+        result = []
+        for suffix, data in (('.json', self.toDict()),
+                             ('.trace.json', self.toTraceEvents())):
+            filePath = filePathPrefix + suffix
+            with open(filePath, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            result.append(filePath)
+        return result
+
+    def summary(self, category='step', limit=10):
+        '''
+        Lines describing the most time consuming spans of the given
+        category.
+        '''
+        with self._lock:
+            spans = [span for span in self.spans
+                     if span.category == category]
+        spans.sort(key=lambda span: span.wall, reverse=True)
+
+        lines = ['%-30s %10s %10s %10s %10s %10s %15s'
+                 % ('', 'wall (s)', 'user (s)', 'sys (s)', 'read (MiB)',
+                    'write (MiB)', 'child rss (MiB)')]
+        for span in spans[:limit]:
+            lines.append('%-30s %10.1f %10.1f %10.1f %10.1f %10.1f %15.1f'
+                         % (span.name[:30], span.wall, span.utime,
+                            span.stime, span.readbytes / 1048576.0,
+                            span.writtenbytes / 1048576.0,
+                            span.childmaxrss / 1048576.0))
+        return lines
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+
+def _threadUsage():
+    try:
+        return resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        return resource.getrusage(resource.RUSAGE_SELF)
+
+
+def _processPeak():
+    '''
+    Peak RSS of the conduct process so far (bytes).
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+_profiler = None
+
+
+def startProfiling():
+    '''
+    Start collecting the spans of a new build.
+    '''
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def stopProfiling():
+    '''
+    Stop collecting; returns the profiler of the finished build (if any).
+    '''
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+@contextmanager
+def measure(name, category, **args):
+    '''
+    Measure the enclosed section (if profiling is active).
+    '''
+    profiler = _profiler
+    if profiler is None:
+        yield None
+    else:
+        with profiler.measure(name, category, **args) as span:
+            yield span
+
+
+def addChildUsage(usage):
+    profiler = _profiler
+    if profiler is not None:
+        profiler.addChildUsage(usage)
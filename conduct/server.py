@@ -0,0 +1,549 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Build server: a long-lived process that keeps the chain definitions and
+the system info loaded and builds the requests of its clients (Unix
+socket), each in a process forked from the server.
+
+Protocol: one JSON object per line. The client sends one request
+
+    {"action": "build", "chain": "frm2:debpkg",
+     "params": {"project": "nicos"}, "priority": 0}
+
+and receives the events of its build until "finished" (or "error"):
+
+    {"event": "queued", "request": 12, "coalesced": false, "pending": 3}
+    {"event": "started", "request": 12, "workdir": "..."}
+    {"event": "log", "line": "..."}
+    {"event": "finished", "request": 12, "failed": false, "duration": 42.0}
+'''
+
+import os
+import sys
+import json
+import time
+import fcntl
+import heapq
+import Queue
+import signal
+import socket
+import threading
+import traceback
+import itertools
+import multiprocessing
+import SocketServer
+from os import path
+
+import conduct
+from conduct import loggers
+from conduct.cache import canonicalRepr
+from conduct.util import loadChainDefinition, loadChainConfig, \
+    ensureDirectory, chainPathToName, chainDefinitionFile, chainNameToPath
+
+
+class BuildRequest(object):
+    '''
+    A requested build (chain, parameter overrides) and the queues of the
+    clients waiting for its events.
+    '''
+
+    def __init__(self, number, chainName, overrides, priority):
+        self.number = number
+        self.chainName = chainName
+        self.overrides = overrides
+        self.priority = priority
+        self.key = requestKey(chainName, overrides)
+        self.subscribers = []
+
+    def publish(self, event):
+        # (clients may disconnect meanwhile)
+        for subscriber in list(self.subscribers):
+            subscriber.put(event)
+
+
+class BuildQueue(object):
+    '''
+    The pending build requests, highest priority first (in order of
+    arrival within a priority). A request for the same chain and
+    parameters as a pending one is coalesced into it.
+    '''
+
+    def __init__(self):
+        self._heap = [] # (-priority, number, request)
+        self._pending = {} # key -> request
+        self._numbers = itertools.count(1)
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, chainName, overrides, priority, subscriber):
+        '''
+        Queue a build for the given subscriber (a Queue.Queue receiving
+        the events). Returns the request and whether it was coalesced
+        into a pending one.
+        '''
+        key = requestKey(chainName, overrides)
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Server is shutting down')
+
+            request = self._pending.get(key)
+            coalesced = request is not None
+
+            if request is None:
+                request = BuildRequest(next(self._numbers), chainName,
+                                       overrides, priority)
+                self._pending[key] = request
+                self._push(request)
+            elif priority > request.priority:
+                # the former heap entry is skipped by get
+                request.priority = priority
+                self._push(request)
+
+            request.subscribers.append(subscriber)
+            self._cond.notify()
+
+        return request, coalesced
+
+    def get(self):
+        '''
+        Take the next request (blocks). Returns None once the queue is
+        closed.
+        '''
+        with self._cond:
+            while True:
+                while self._heap:
+                    priority, _, request = heapq.heappop(self._heap)
+                    if self._pending.get(request.key) is request \
+                        and -priority == request.priority:
+                        del self._pending[request.key]
+                        return request
+
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+    def close(self):
+        '''
+        Stop accepting requests. Returns the pending (cancelled) requests.
+        '''
+        with self._cond:
+            self._closed = True
+            cancelled = sorted(self._pending.values(),
+                               key=lambda request: request.number)
+            self._pending = {}
+            self._heap = []
+            self._cond.notify_all()
+
+        return cancelled
+
+    def _push(self, request):
+        heapq.heappush(self._heap,
+                       (-request.priority, request.number, request))
+
+
+class BuildServer(object):
+    '''
+    Serves build requests on the given Unix socket with the given number
+    of concurrent builds. Each build gets its own log and working
+    directory below serveDir.
+    '''
+
+    def __init__(self, app, socketPath, workers, serveDir):
+        self.app = app
+        self.socketPath = path.abspath(socketPath)
+        self.workers = max(workers, 1)
+        self.serveDir = path.abspath(serveDir)
+
+        self._queue = BuildQueue()
+        self._lock = threading.Lock() # chain definitions, forks
+        self._signatures = {} # chain name -> signature of the loaded files
+        self._server = None
+        self._dispatchers = []
+
+    def run(self):
+        '''
+        Serve until interrupted (SIGINT, SIGTERM). Pending requests are
+        cancelled, running builds are finished.
+        '''
+        log = self.app.log
+        self.app.makePathsAbsolute()
+        self.app._analyzeSystem()
+        # (index of the chains, to validate the requests)
+        self.app.catalog
+        ensureDirectory(self.serveDir)
+
+        self._server = _UnixServer(self.socketPath, self)
+        previousHandler = signal.signal(signal.SIGTERM, _terminate)
+
+        try:
+            for i in range(self.workers):
+                dispatcher = threading.Thread(target=self._dispatch,
+                                              name='dispatcher-%d' % (i + 1))
+                dispatcher.daemon = True
+                dispatcher.start()
+                self._dispatchers.append(dispatcher)
+
+            log.info('Serving on %s (%d concurrent build(s))'
+                     % (self.socketPath, self.workers))
+            log.info('Build directory: %s' % self.serveDir)
+            loggers.flushLogs()
+
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previousHandler)
+            self._shutdown()
+
+    def submit(self, chainName, overrides, priority, subscriber):
+        '''
+        Validate and queue a build request (see BuildQueue.submit).
+        '''
+        with self._lock:
+            catalog = self.app.catalog
+            catalog.update()
+            unknown = set(overrides) - set(catalog.get(chainName)['parameters'])
+            if unknown:
+                raise RuntimeError('%s: Unknown parameter(s): %s'
+                                   % (chainName, ', '.join(sorted(unknown))))
+
+        request, coalesced = self._queue.submit(chainName, overrides,
+                                                priority, subscriber)
+        params = _formatOverrides(overrides)
+        self.app.log.info('Request %d: %s%s (priority %d)%s'
+                          % (request.number, chainName,
+                             ' ' + params if params else '', priority,
+                             ' coalesced' if coalesced else ''))
+        return request, coalesced
+
+    def pendingCount(self):
+        return len(self._queue)
+
+    def _dispatch(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            try:
+                self._build(request)
+            except Exception as e:
+                self.app.log.error('Build of request %d failed: %s'
+                                   % (request.number, e))
+                request.publish({'event' : 'error', 'message' : str(e)})
+            request.publish(None)
+
+    def _build(self, request):
+        '''
+        Build the given request in a forked process, publish its log.
+        '''
+        log = self.app.log
+        workDir = path.join(self.serveDir, '%s-%04d-%s'
+                            % (time.strftime('%Y%m%d-%H%M%S'), request.number,
+                               request.chainName.replace(':', '-')))
+
+        # one fork at a time: no other build inherits the write end of the
+        # log pipe (the end of the log is detected by EOF)
+        with self._lock:
+            self._loadChain(request.chainName)
+            readFd, writeFd = os.pipe()
+            for fd in (readFd, writeFd):
+                _setCloseOnExec(fd)
+
+            process = multiprocessing.Process(
+                target=_buildWorker,
+                args=(request.chainName, request.overrides, workDir,
+                      readFd, writeFd))
+            try:
+                process.start()
+            finally:
+                os.close(writeFd)
+
+        start = time.time()
+        log.info('Request %d: build started (%s)' % (request.number, workDir))
+        request.publish({'event' : 'started', 'request' : request.number,
+                         'workdir' : workDir})
+
+        with os.fdopen(readFd, 'r') as logPipe:
+            for line in iter(logPipe.readline, ''):
+                request.publish({'event' : 'log',
+                                 'line' : line.rstrip('\n')})
+        process.join()
+
+        failed = process.exitcode != 0
+        duration = time.time() - start
+        log.info('Request %d: %s (%.1f s)' % (request.number,
+                                             'FAILED' if failed else 'SUCCESS',
+                                             duration))
+        request.publish({'event' : 'finished', 'request' : request.number,
+                         'failed' : failed, 'duration' : duration})
+
+    def _loadChain(self, chainName):
+        '''
+        Load the definition and config of the given chain (inherited by
+        the build processes). Cached chains whose files changed are
+        loaded again.
+        '''
+        cfg = self.app.cfg
+        for name, signature in self._signatures.items():
+            if _chainSignature(name, self.app) != signature:
+                self.app.log.info('Chain %s changed, reload it' % name)
+                cfg.get('chains', {}).pop(name, None)
+                cfg.get('chaincfgs', {}).pop(name, None)
+                del self._signatures[name]
+
+        if chainName not in self._signatures:
+            signature = _chainSignature(chainName, self.app)
+            loadChainDefinition(chainName)
+            loadChainConfig(chainName)
+            self._signatures[chainName] = signature
+
+    def _shutdown(self):
+        log = self.app.log
+
+        if self._server is not None:
+            self._server.server_close()
+            if path.exists(self.socketPath):
+                os.remove(self.socketPath)
+
+        for request in self._queue.close():
+            request.publish({'event' : 'error',
+                             'message' : 'Server shut down before the build '
+                             'started'})
+            request.publish(None)
+
+        log.info('Shutting down: waiting for the running builds ...')
+        loggers.flushLogs()
+        for dispatcher in self._dispatchers:
+            # (join with timeout: interruptible)
+            while dispatcher.is_alive():
+                dispatcher.join(1.0)
+        log.info('Server stopped')
+        loggers.flushLogs()
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    '''
+    Queues the request of one client and streams the events of its build.
+    '''
+
+    def handle(self):
+        try:
+            self._handleRequest()
+        except socket.error:
+            # client gone (a started build goes on)
+            pass
+
+    def _handleRequest(self):
+        buildServer = self.server.buildServer
+
+        try:
+            message = json.loads(self.rfile.readline())
+            if message.get('action') != 'build':
+                raise ValueError('Unknown action: %s' % message.get('action'))
+            chainName = chainPathToName(_fromJson(message['chain']))
+            overrides = dict(_fromJson(message.get('params', {})))
+            priority = int(message.get('priority', 0))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send({'event' : 'error',
+                        'message' : 'Invalid request: %s' % e})
+            return
+
+        subscriber = Queue.Queue()
+        try:
+            request, coalesced = buildServer.submit(chainName, overrides,
+                                                    priority, subscriber)
+        except Exception as e:
+            self._send({'event' : 'error', 'message' : str(e)})
+            return
+
+        try:
+            self._send({'event' : 'queued', 'request' : request.number,
+                        'coalesced' : coalesced,
+                        'pending' : buildServer.pendingCount()})
+
+            for event in iter(subscriber.get, None):
+                self._send(event)
+        finally:
+            request.subscribers.remove(subscriber)
+
+    def _send(self, event):
+        self.wfile.write(json.dumps(event) + '\n')
+        self.wfile.flush()
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            # client gone
+            pass
+
+
+class _UnixServer(SocketServer.ThreadingMixIn,
+                  SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, buildServer):
+        self.buildServer = buildServer
+
+        if path.exists(socketPath):
+            if _serverRunning(socketPath):
+                raise RuntimeError('A server is already running on %s'
+                                   % socketPath)
+            # left over by a killed server
+            os.remove(socketPath)
+
+        ensureDirectory(path.dirname(socketPath))
+        SocketServer.UnixStreamServer.__init__(self, socketPath,
+                                               _RequestHandler)
+
+
+def submitBuild(socketPath, chainName, overrides, priority=0, output=None):
+    '''
+    Request a build from the server on the given socket and write its log
+    to output (default: stdout). Returns True if the build failed.
+    '''
+    if output is None:
+        output = sys.stdout
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketPath)
+    except socket.error as e:
+        raise RuntimeError('No server on %s: %s' % (socketPath, e))
+
+    try:
+        conn.sendall(json.dumps({'action' : 'build', 'chain' : chainName,
+                                 'params' : overrides,
+                                 'priority' : priority}) + '\n')
+
+        for line in iter(conn.makefile('r').readline, ''):
+            event = json.loads(line)
+            kind = event['event']
+
+            if kind == 'log':
+                output.write(event['line'] + '\n')
+            elif kind == 'queued':
+                output.write('Request %d %s (%d pending)\n'
+                             % (event['request'],
+                                'coalesced with a pending request'
+                                if event['coalesced'] else 'queued',
+                                event['pending']))
+            elif kind == 'started':
+                output.write('Build started: %s\n' % event['workdir'])
+            elif kind == 'finished':
+                return event['failed']
+            elif kind == 'error':
+                raise RuntimeError(event['message'])
+    finally:
+        conn.close()
+
+    raise RuntimeError('Connection to the server lost')
+
+
+def requestKey(chainName, overrides):
+    return (chainName, canonicalRepr(overrides))
+
+
+def _fromJson(value):
+    '''
+    Decoded JSON value with byte strings (as given on the command line).
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_fromJson(entry) for entry in value]
+    if isinstance(value, dict):
+        return dict((_fromJson(key), _fromJson(entry))
+                    for key, entry in value.items())
+    return value
+
+
+def _buildWorker(chainName, overrides, workDir, readFd, logFd):
+    '''
+    Build one chain (in a forked process), log to the given pipe.
+    '''
+    os.close(readFd)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    app = conduct.app
+    failed = True
+    try:
+        app.initWorker(workDir, os.fdopen(logFd, 'w', 0))
+        failed = app.build(chainName, overrides)
+    except Exception:
+        try:
+            app.log.error(traceback.format_exc())
+        except Exception:
+            pass
+    finally:
+        loggers.disableAsyncLogging()
+
+    sys.exit(1 if failed else 0)
+
+
+def _chainSignature(chainName, app):
+    '''
+    Modification time and size of the definition and config file of the
+    given chain.
+    '''
+    result = []
+    for filePath in (chainDefinitionFile(chainName, app),
+                     path.join(app.cfg['chaincfgdir'],
+                               '%s.py' % chainNameToPath(chainName))):
+        try:
+            st = os.stat(filePath)
+            result.append((st.st_mtime, st.st_size))
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+
+def _serverRunning(socketPath):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketPath)
+        return True
+    except socket.error:
+        return False
+    finally:
+        conn.close()
+
+
+def _setCloseOnExec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def _formatOverrides(overrides):
+    return ', '.join('%s=%s' % (key, overrides[key])
+                     for key in sorted(overrides))
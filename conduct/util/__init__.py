@@ -21,11 +21,17 @@
 # *****************************************************************************
 
 import os
+import sys
+import imp
+import errno
+import marshal
+import hashlib
 import logging
 import platform
 import select
 import fcntl
 import time
+import threading
 
 
 from collections import OrderedDict
@@ -34,7 +40,15 @@ from os import path
 from subprocess import Popen, PIPE, CalledProcessError
 
 import conduct
-from conduct.param import Parameter, OrderedAttrDict
+from conduct import profiling
+from conduct.param import Parameter, OrderedAttrDict, boolean
+
+# read size for subprocess pipes (systemCall)
+SYSCALL_CHUNK_SIZE = 65536
+# max. time (ms) systemCall blocks without checking if the child has exited
+SYSCALL_EXIT_CHECK_INTERVAL = 1000
+# cached code objects are only valid for the same interpreter version
+BYTECODE_MAGIC = imp.get_magic() + sys.version
 
 ## Utils classes
 
@@ -48,12 +62,12 @@ class OrderedAttrDict(OrderedDict):
         self._init = True
 
     def __setattr__(self, name, value):
-        if not hasattr(self, '_init'):
+        if '_init' not in self.__dict__:
             return OrderedDict.__setattr__(self, name, value)
         return OrderedDict.__setitem__(self, name, value)
 
     def __getattr__(self, name):
-        if not hasattr(self, '_init'):
+        if '_init' not in self.__dict__:
             return OrderedDict.__getattr__(self, name)
         return OrderedDict.__getitem__(self, name)
 
@@ -146,108 +160,282 @@ def umount(mountpoint, flags='', log=None):
     systemCall('umount %s %s' % (flags, mountpoint),
                log=log)
 
-def systemCall(cmd, sh=True, log=None):
+class _PipeReader(object):
+    '''
+    Collects the output of one pipe of a child process.
+
+    Data is read in large chunks into a bytearray and split into lines once
+    per chunk; only the trailing partial line is kept for the next read.
+    '''
+
+    def __init__(self, pipe, logFunc, store=None):
+        self.fd = pipe.fileno()
+        self._logFunc = logFunc
+        self._store = store
+        self._buf = bytearray()
+
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def read(self):
+        '''
+        Read all currently available data.
+        Returns False if the pipe reached EOF.
+        '''
+        while True:
+            try:
+                chunk = os.read(self.fd, SYSCALL_CHUNK_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if not chunk:
+                self.flush()
+                return False
+
+            self._buf.extend(chunk)
+            self._consumeLines()
+
+            if len(chunk) < SYSCALL_CHUNK_SIZE:
+                # pipe drained; go back to poll
+                return True
+
+    def flush(self):
+        '''
+        Emit the remaining partial line (if any).
+        '''
+        if self._buf:
+            line = str(self._buf)
+            del self._buf[:]
+            if self._store is not None:
+                self._store.append(line)
+            if self._logFunc is not None:
+                self._logFunc(line)
+
+    def _consumeLines(self):
+        end = self._buf.rfind('\n')
+        if end < 0:
+            return
+
+        lines = str(self._buf[:end]).split('\n')
+        del self._buf[:end + 1]
+        self._emit(lines)
+
+    def _emit(self, lines):
+        if self._store is not None:
+            self._store.extend(line + '\n' for line in lines)
+        if self._logFunc is not None:
+            for line in lines:
+                self._logFunc(line)
+
+
+def systemCall(cmd, sh=True, log=None, cwd=None):
     if log is None:
         log = conduct.app.log
 
     log.debug('System call [sh:%s]: %s' \
               % (sh, cmd))
 
+    cmdStr = cmd if isinstance(cmd, basestring) else ' '.join(cmd)
+    with profiling.measure(cmdStr[:80], 'syscall', command=cmdStr):
+        return _systemCall(cmd, sh, log, cwd)
+
+def _systemCall(cmd, sh, log, cwd):
     out = []
-    proc = None
-    poller = None
-    outBuf = ['']
-    errBuf = ['']
+    err = []
+
+    # create and start process
+    # (use cwd instead of chdir: steps may be built in parallel)
+    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=sh,
+                 cwd=cwd)
+
+    # avoid building debug records nobody will see
+    outLog = log.debug if log.isEnabledFor(logging.DEBUG) else None
+    readers = {}
+    for reader in (_PipeReader(proc.stdout, outLog, out),
+                   _PipeReader(proc.stderr, log.warning, err)):
+        readers[reader.fd] = reader
 
-    def pollOutput():
+    poller = select.poll()
+    for fd in readers:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    while readers:
+        try:
+            # block until there is output, a pipe is closed or the timeout
+            # is reached (catches children that leave the pipes open
+            # for some detached grandchild)
+            events = poller.poll(SYSCALL_EXIT_CHECK_INTERVAL)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if not events:
+            if _waitChild(proc, os.WNOHANG):
+                # proc finished; collect the missing output and stop
+                for reader in readers.values():
+                    reader.read()
+                    reader.flush()
+                break
+            continue
+
+        for fd, _ in events:
+            if not readers[fd].read():
+                poller.unregister(fd)
+                del readers[fd]
+
+    # all pipes are closed (or the proc is already gone): wait for exit
+    if proc.returncode is None:
+        _waitChild(proc)
+
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        pipe.close()
+
+    # check return code
+    if proc.returncode != 0:
+        error = CalledProcessError(proc.returncode, cmd, ''.join(out))
+        # (stderr is logged as warnings, kept for failure analysis)
+        error.stderr = ''.join(err)
+        raise RuntimeError(error)
+
+    return ''.join(out)
+
+def _waitChild(proc, options=0):
+    '''
+    Wait for the given child process (like Popen.poll/wait), account its
+    resource usage to the current profiling spans.
+    Returns True if the process has exited.
+    '''
+    while True:
+        try:
+            pid, status, usage = os.wait4(proc.pid, options)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # already reaped elsewhere
+                proc.wait()
+                return True
+            raise
+
+    if pid == 0:
+        return False
+
+    proc._handle_exitstatus(status)
+    profiling.addChildUsage(usage)
+    return True
+
+class ChrootSessions(object):
+    '''
+    Manages the pseudo file systems (proc, sys, dev) of chroot directories.
+
+    The pseudo file systems are mounted once per chroot directory on first
+    use and shared by all (concurrent) users. Persistent sessions stay
+    mounted until they are torn down explicitly (e.g. by the chain's
+    cleanup), non persistent ones are unmounted as soon as the last user
+    releases them.
+    '''
+
+    def __init__(self, persistent=True, log=None):
+        self.persistent = persistent
+        self.mounts = 0
+        self.umounts = 0
+
+        self._log = log
+        self._users = {} # chroot dir -> number of active users
+        self._lock = threading.RLock()
+
+    @property
+    def active(self):
+        return list(self._users.keys())
+
+    def acquire(self, chrootDir, log=None):
+        log = log or self._log or conduct.app.log
+        chrootDir = path.realpath(chrootDir)
+
+        with self._lock:
+            if chrootDir not in self._users:
+                self._mountPseudoFs(chrootDir, log)
+                self._users[chrootDir] = 0
+            self._users[chrootDir] += 1
+
+    def release(self, chrootDir, log=None):
+        log = log or self._log or conduct.app.log
+        chrootDir = path.realpath(chrootDir)
+
+        with self._lock:
+            self._users[chrootDir] -= 1
+            if not self._users[chrootDir] and not self.persistent:
+                self._umountPseudoFs(chrootDir, log)
+                del self._users[chrootDir]
+
+    def teardown(self, below=None, log=None):
         '''
-        Read, log and store output (if any) from processes pipes.
+        Unmount the pseudo file systems of all sessions
+        (or just the ones inside the given directory).
         '''
-        removeChars = '\r\n'
-
-         # collect fds with new output
-        fds = [entry[0] for entry in poller.poll()]
-
-        if proc.stdout.fileno() in fds:
-            while True:
-                try:
-                    tmp = proc.stdout.read(100)
-                except IOError:
-                    break
-                outBuf[0] += tmp
-
-                while '\n' in outBuf[0]:
-                    line, _, outBuf[0] = outBuf[0].partition('\n')
-                    log.debug(line)
-                    out.append(line + '\n')
-
-                if not tmp:
-                    break
-        if proc.stderr.fileno() in fds:
-            while True:
-                try:
-                    tmp = proc.stderr.read(100)
-                except IOError:
-                    break
-                errBuf[0] += tmp
-
-                while '\n' in errBuf[0]:
-                    line, _, errBuf[0] = errBuf[0].partition('\n')
-                    log.warning(line)
-
-                if not tmp:
-                    break
+        log = log or self._log or conduct.app.log
 
+        if below is not None:
+            below = path.realpath(below)
 
-    while True:
-        if proc is None:
-            # create and start process
-            proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=sh)
+        with self._lock:
+            for chrootDir in sorted(self._users, reverse=True):
+                if below is not None and chrootDir != below \
+                    and not chrootDir.startswith(below + os.sep):
+                    continue
 
-            # create poll select
-            poller = select.poll()
+                if self._users[chrootDir]:
+                    log.warning('Chroot %s is still in use by %d user(s)'
+                                % (chrootDir, self._users[chrootDir]))
 
-            flags = fcntl.fcntl(proc.stdout, fcntl.F_GETFL)
-            fcntl.fcntl(proc.stdout, fcntl.F_SETFL, flags| os.O_NONBLOCK)
+                self._umountPseudoFs(chrootDir, log)
+                del self._users[chrootDir]
 
-            flags = fcntl.fcntl(proc.stderr, fcntl.F_GETFL)
-            fcntl.fcntl(proc.stderr, fcntl.F_SETFL, flags| os.O_NONBLOCK)
+        if self.mounts:
+            log.debug('Chroot pseudo fs: %d mount(s), %d umount(s)'
+                      % (self.mounts, self.umounts))
 
-            # register pipes to polling
-            poller.register(proc.stdout, select.POLLIN)
-            poller.register(proc.stderr, select.POLLIN)
+    def _mountPseudoFs(self, chrootDir, log):
+        log.debug('Mount pseudo file systems for chroot: %s' % chrootDir)
 
-        pollOutput()
+        mount('proc', path.join(chrootDir, 'proc'), '-t proc', log=log)
+        mount('/sys', path.join(chrootDir, 'sys'), '--rbind', log=log)
+        mount('/dev', path.join(chrootDir, 'dev'), '--rbind', log=log)
+        self.mounts += 3
 
-        if proc.poll() is not None: # proc finished
-            break
+    def _umountPseudoFs(self, chrootDir, log):
+        log.debug('Unmount pseudo file systems of chroot: %s' % chrootDir)
 
-    # poll once after the process ended to collect all the missing output
-    pollOutput()
+        # handle devpts
+        devpts = path.join(chrootDir, 'dev', 'pts')
+        if path.exists(devpts):
+            umount(devpts, '-lf', log=log)
+            self.umounts += 1
 
-    # check return code
-    if proc.returncode != 0:
-        raise RuntimeError(
-            CalledProcessError(proc.returncode, cmd, ''.join(out))
-            )
+        # lazy is ok for pseudo fs
+        for entry in ('dev', 'sys', 'proc'):
+            umount(path.join(chrootDir, entry), '-lf', log=log)
+            self.umounts += 1
 
-    return ''.join(out)
 
-def chrootedSystemCall(chrootDir, cmd, sh=True, mountPseudoFs=True, log=None):
+def chrootedSystemCall(chrootDir, cmd, sh=True, mountPseudoFs=True, log=None,
+                       sessions=None):
     if log is None:
         log = conduct.app.log
 
-    # determine mount points for pseudo fs
-    proc = path.join(chrootDir, 'proc')
-    sys = path.join(chrootDir, 'sys')
-    dev = path.join(chrootDir, 'dev')
-    devpts = path.join(chrootDir, 'dev', 'pts')
+    # without a (chain's) session manager: mount for this call only
+    if sessions is None:
+        sessions = ChrootSessions(persistent=False)
 
     # mount pseudo fs
     if mountPseudoFs:
-        mount('proc', proc, '-t proc')
-        mount('/sys', sys, '--rbind')
-        mount('/dev', dev, '--rbind')
+        sessions.acquire(chrootDir, log)
 
     try:
         # exec chrooted cmd
@@ -255,15 +443,9 @@ def chrootedSystemCall(chrootDir, cmd, sh=True, mountPseudoFs=True, log=None):
         cmd = 'chroot %s %s' % (chrootDir, cmd)
         return systemCall(cmd, sh, log)
     finally:
-        # umount if pseudo fs was mounted
+        # release (and umount if not in use anymore) pseudo fs
         if mountPseudoFs:
-            # handle devpts
-            if path.exists(devpts):
-                umount(devpts, '-lf')
-            # lazy is ok for pseudo fs
-            umount(dev, '-lf')
-            umount(sys, '-lf')
-            umount(proc, '-lf')
+            sessions.release(chrootDir, log)
 
 
 def chainPathToName(path):
@@ -278,12 +460,65 @@ def loadPyFile(path, ns=None):
 
     ns['__file__'] = path
 
-    exec open(path).read() in ns
+    exec compilePyFile(path) in ns
 
     del ns['__builtins__']
 
     return ns
 
+def compilePyFile(filePath, app=None):
+    '''
+    Compile the given python file. The code objects are cached (in the
+    bytecode cache dir) by path, mtime, size and interpreter version.
+    '''
+    if app is None:
+        app = conduct.app
+
+    st = os.stat(filePath)
+    header = (BYTECODE_MAGIC, st.st_mtime, st.st_size)
+
+    cacheFile = None
+    if app is not None and boolean(app.cfg.get('bytecodecache', 'on')):
+        cacheFile = path.join(getCacheDir('bytecode', app), '%s.pyc'
+                              % hashlib.sha1(path.abspath(filePath))
+                              .hexdigest())
+
+        try:
+            with open(cacheFile, 'rb') as f:
+                if marshal.load(f) == header:
+                    return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            # missing or broken: compile again
+            pass
+
+    with open(filePath) as f:
+        code = compile(f.read(), filePath, 'exec')
+
+    if cacheFile is not None:
+        tmpFile = '%s.%d.%d.tmp' % (cacheFile, os.getpid(),
+                                    threading.current_thread().ident)
+        try:
+            with open(tmpFile, 'wb') as f:
+                marshal.dump(header, f)
+                marshal.dump(code, f)
+            os.rename(tmpFile, cacheFile)
+        except (IOError, OSError):
+            # the cache is optional
+            if path.exists(tmpFile):
+                os.remove(tmpFile)
+
+    return code
+
+def chainDefinitionFile(chainName, app=None):
+    '''
+    Location of the definition file of the given chain.
+    '''
+    if app is None:
+        app = conduct.app
+
+    return path.join(app.cfg['chaindefdir'],
+                     '%s.py' % chainNameToPath(chainName))
+
 def loadChainDefinition(chainName, app=None):
     if app is None:
         app = conduct.app
@@ -296,9 +531,7 @@ def loadChainDefinition(chainName, app=None):
         return app.cfg['chains'][chainName]
 
 
-    # determine chain file location
-    chainDir = app.cfg['chaindefdir']
-    chainFile = path.join(chainDir, '%s.py' % chainNameToPath(chainName))
+    chainFile = chainDefinitionFile(chainName, app)
 
     if not path.exists(chainFile):
         raise IOError('Chain file for \'%s\' not found (Should be: %s)'
@@ -321,6 +554,10 @@ def loadChainDefinition(chainName, app=None):
         chainDef[entry] = ns[entry]
 
     chainDef['steps'] = ns['steps']
+    # independent steps may be built concurrently (ordered by dependencies)
+    chainDef['parallel'] = ns.get('parallel', False)
+    # adjacent steps that support it are built together
+    chainDef['coalesce'] = ns.get('coalesce', False)
 
     # cache
     app.cfg['chains'][chainName] = chainDef
@@ -328,16 +565,42 @@ def loadChainDefinition(chainName, app=None):
     return chainDef
 
 def loadChainConfig(chainName):
-    # determine chain file location
-    cfgDir = conduct.app.cfg['chaincfgdir']
-    cfgFile = path.join(cfgDir, '%s.py' % chainNameToPath(chainName))
+    # caching
+    if 'chaincfgs' not in conduct.app.cfg:
+        conduct.app.cfg['chaincfgs'] = {}
+
+    if chainName not in conduct.app.cfg['chaincfgs']:
+        # determine chain file location
+        cfgDir = conduct.app.cfg['chaincfgdir']
+        cfgFile = path.join(cfgDir, '%s.py' % chainNameToPath(chainName))
+
+        chainCfg = {}
+        if path.exists(cfgFile):
+            chainCfg = loadPyFile(cfgFile)
 
-    if path.exists(cfgFile):
-        return loadPyFile(cfgFile)
-    return {}
+        conduct.app.cfg['chaincfgs'][chainName] = chainCfg
+
+    # copy, as the callers apply their overrides
+    return dict(conduct.app.cfg['chaincfgs'][chainName])
 
 def ensureDirectory(dirpath):
     if not path.isdir(dirpath):
-        os.makedirs(dirpath)
+        try:
+            os.makedirs(dirpath)
+        except OSError:
+            # may be created concurrently
+            if not path.isdir(dirpath):
+                raise
+
+def getCacheDir(name, app=None):
+    '''
+    Determine (and create) the cache directory with the given name.
+    '''
+    if app is None:
+        app = conduct.app
+
+    cacheDir = path.abspath(path.join(app.cfg.get('cachedir', 'cache'), name))
+    ensureDirectory(cacheDir)
+    return cacheDir
 
 
@@ -32,11 +32,11 @@ class OrderedAttrDict(OrderedDict):
         self._init = True
 
     def __setattr__(self, name, value):
-        if not hasattr(self, '_init'):
+        if '_init' not in self.__dict__:
             return OrderedDict.__setattr__(self, name, value)
         return OrderedDict.__setitem__(self, name, value)
 
     def __getattr__(self, name):
-        if not hasattr(self, '_init'):
+        if '_init' not in self.__dict__:
             return OrderedDict.__getattr__(self, name)
         return OrderedDict.__getitem__(self, name)
\ No newline at end of file
@@ -0,0 +1,189 @@
+# *****************************************************************************
+# conduct - CONvenient Construction Tool
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Alexander Lenz <alexander.lenz@posteo.de>
+#
+# *****************************************************************************
+
+'''
+Low level file operations (linux specific system calls via ctypes).
+'''
+
+import os
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+FICLONE = 0x40049409
+
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# errors of the kernel side copy functions that demand a fallback
+COPY_FALLBACK_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EBADF, errno.ENOTTY)
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def _checkResult(result):
+    if result != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def fallocate(fd, offset, length, mode=0):
+    '''
+    Allocate (or with FALLOC_FL_PUNCH_HOLE: deallocate) disk space for the
+    given range of the file.
+    '''
+    _checkResult(_libc.fallocate64(ctypes.c_int(fd),
+                                   ctypes.c_int(mode),
+                                   ctypes.c_longlong(offset),
+                                   ctypes.c_longlong(length)))
+
+
+def punchHole(fd, offset, length):
+    '''
+    Deallocate the given range of the file (keeping the file size).
+    '''
+    fallocate(fd, offset, length,
+              FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE)
+
+
+def fadvise(fd, offset, length, advice):
+    # posix_fadvise returns the error number instead of setting errno
+    result = _libc.posix_fadvise64(ctypes.c_int(fd),
+                                   ctypes.c_longlong(offset),
+                                   ctypes.c_longlong(length),
+                                   ctypes.c_int(advice))
+    if result != 0:
+        raise OSError(result, os.strerror(result))
+
+
+def seekData(fd, offset):
+    '''
+    Offset of the next data region starting at the given offset
+    (None if there is no more data).
+    '''
+    return _seek(fd, offset, SEEK_DATA)
+
+
+def seekHole(fd, offset):
+    '''
+    Offset of the next hole starting at the given offset
+    (the end of the file counts as a hole).
+    '''
+    return _seek(fd, offset, SEEK_HOLE)
+
+
+def _seek(fd, offset, whence):
+    try:
+        return os.lseek(fd, offset, whence)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            return None
+        raise
+
+
+def copyFileRange(fdIn, fdOut, count):
+    '''
+    Copy up to count bytes between the current positions of the given
+    files inside the kernel. Returns the number of copied bytes.
+    '''
+    func = _libc.copy_file_range
+    func.restype = ctypes.c_ssize_t
+    result = func(ctypes.c_int(fdIn), None, ctypes.c_int(fdOut), None,
+                  ctypes.c_size_t(count), ctypes.c_uint(0))
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def sendfile(fdOut, fdIn, count):
+    '''
+    Copy up to count bytes from the current position of fdIn to fdOut
+    inside the kernel. Returns the number of copied bytes.
+    '''
+    func = _libc.sendfile64
+    func.restype = ctypes.c_ssize_t
+    result = func(ctypes.c_int(fdOut), ctypes.c_int(fdIn), None,
+                  ctypes.c_size_t(count))
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def reflink(fdIn, fdOut):
+    '''
+    Share the data blocks of fdIn with fdOut (copy on write clone),
+    if supported by the file system.
+    '''
+    fcntl.ioctl(fdOut, FICLONE, fdIn)
+
+
+def copyFileData(fdIn, fdOut):
+    '''
+    Copy the whole (remaining) content of fdIn to fdOut, using the
+    fastest available mechanism (copy_file_range, sendfile, read/write).
+    Returns the number of copied bytes.
+    '''
+    total = 0
+
+    for func in (lambda: copyFileRange(fdIn, fdOut, COPY_CHUNK_SIZE),
+                 lambda: sendfile(fdOut, fdIn, COPY_CHUNK_SIZE)):
+        try:
+            while True:
+                copied = func()
+                if not copied:
+                    return total
+                total += copied
+        except AttributeError:
+            # not provided by the libc
+            pass
+        except OSError as e:
+            if total or e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+
+    while True:
+        data = os.read(fdIn, COPY_CHUNK_SIZE)
+        if not data:
+            return total
+
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fdOut, view):]
+        total += len(data)
+
+
+def allocatedSize(filePath):
+    '''
+    Size of the disk space actually allocated for the given file.
+    '''
+    return os.stat(filePath).st_blocks * 512
@@ -91,6 +91,13 @@ parameters = {
                             default='/tmp'),
 }
 
+# Independent steps may be built concurrently (see -j). The build order is
+# determined by the step references and the after= hints.
+parallel = True
+
+# Install adjacent packages into the chroot in one apt transaction.
+coalesce = True
+
 # Build steps
 steps.imgdef   = Step('generic.Config',
                         description='Read image definition file',
@@ -105,19 +112,20 @@ steps.tmpdir   = Step('fs.TmpDir',
                         description='Generate build dir',
                         parentdir='{chain.builddir}')
 
-steps.imgfile   = Step('syscall.SystemCall',
+steps.imgfile   = Step('fs.CreateImageFile',
                         description='Create empty image file',
-                        command='dcfldd if=/dev/zero '
-                        'of=%s '
-                        'bs=1048576 count={steps.imgdef.config[SIZE]}' % IMGFILE_FULL)
+                        path=IMGFILE_FULL,
+                        size='{steps.imgdef.config[SIZE]}')
 
 steps.partition   = Step('dev.Partitioning',
                         description='Partition image file',
+                        after=['imgfile'],
                         dev=IMGFILE_FULL,
                         partitions=['{steps.partsize.result}','{steps.partsize.result}'])
 
 steps.devmap   = Step('dev.DevMapper',
                         description='Map new image partitions to device files',
+                        after=['partition'],
                         dev=IMGFILE_FULL)
 
 steps.mkfs1   = Step('fs.CreateFileSystem',
@@ -127,6 +135,7 @@ steps.mkfs1   = Step('fs.CreateFileSystem',
 
 steps.mount   = Step('fs.Mount',
                         description='Mount first image partition',
+                        after=['mkfs1'],
                         dev='{steps.devmap.mapped[0]}',
                         mountpoint='{steps.tmpdir.tmpdir}/mount')
 
@@ -139,6 +148,7 @@ steps.mkchrootdirs   = Step('fs.MakeDirs',
 
 steps.debootstrap   = Step('deb.Debootstrap',
                         description='Boostrap basic system',
+                        after=['mkchrootdirs'],
                         distribution='{chain.distribution}',
                         arch='{steps.imgdef.config[ARCH]}',
                         destdir='{steps.tmpdir.tmpdir}/mount',
@@ -146,32 +156,38 @@ steps.debootstrap   = Step('deb.Debootstrap',
 
 steps.srclst   = Step('fs.WriteFile',
                         description='Create source list',
+                        after=['debootstrap'],
                         path='{steps.mount.mountpoint}/etc/apt/sources.list',
                         append=True,
                         content=SOURCES_LIST)
 
 steps.aptupdate   = Step('syscall.ChrootedSystemCall',
                         description='Update package lists',
+                        after=['srclst'],
                         command='apt-get update',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.kernel   = Step('deb.InstallDebPkg',
                         description='Install kernel image',
+                        after=['aptupdate'],
                         pkg='linux-image-{steps.imgdef.config[KERNEL]}',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.grub   = Step('deb.InstallDebPkg',
                         description='Install bootloader (grub2)',
+                        after=['kernel'],
                         pkg='grub2',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.grubdevmap   = Step('fs.WriteFile',
                         description='Create source list',
+                        after=['grub'],
                         path='{steps.mount.mountpoint}/boot/device.map',
                         content=GRUB_DEV_MAP)
 
 steps.mbr   = Step('syscall.SystemCall',
                         description='Install grub2 to mbr',
+                        after=['grubdevmap'],
                         command='grub-install --no-floppy --grub-mkdevicemap='
                             '{steps.mount.mountpoint}/boot/device.map '
                             '--root-directory={steps.mount.mountpoint} '
@@ -179,6 +195,7 @@ steps.mbr   = Step('syscall.SystemCall',
 
 steps.pinbp   = Step('fs.WriteFile',
                         description='Pin backports to normal level',
+                        after=['grub'],
                         path='{steps.mount.mountpoint}/etc/apt/preferences.d/backports',
                         content=APT_PREF_BACKPORT)
 
@@ -186,58 +203,69 @@ steps.pinbp   = Step('fs.WriteFile',
 
 steps.policy   = Step('fs.WriteFile',
                         description='Forbid execution of init scripts on installation',
+                        after=['grub'],
                         path='{steps.mount.mountpoint}/usr/sbin/policy-rc.d',
                         content=POLICY_RC_D)
 
 steps.policyperm   = Step('syscall.ChrootedSystemCall',
                         description='Enable policy-rc.d',
+                        after=['policy'],
                         command='chmod +x /usr/sbin/policy-rc.d',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.pkgbasedeps   = Step('deb.InstallDebPkg',
                         description='Install base img pkg)',
+                        after=['policyperm', 'pinbp', 'mbr'],
                         pkg='boxes-base',
                         chrootdir='{steps.mount.mountpoint}',
                         depsonly=True)
 
 steps.pkgplatformdeps   = Step('deb.InstallDebPkg',
                         description='Install platform img pkg)',
+                        after=['pkgbasedeps'],
                         pkg='boxes-{steps.imgdef.config[PLATFORM]}',
                         chrootdir='{steps.mount.mountpoint}',
                         depsonly=True)
 
 steps.pkgimgdeps   = Step('deb.InstallDebPkg',
                         description='Install specific img pkg)',
+                        after=['pkgplatformdeps'],
                         pkg='boxes-{chain.imgname}',
                         chrootdir='{steps.mount.mountpoint}',
                         depsonly=True)
 
 steps.pkgbase   = Step('deb.InstallDebPkg',
                         description='Install base img pkg)',
+                        after=['pkgimgdeps'],
                         pkg='boxes-base',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.pkgplatform   = Step('deb.InstallDebPkg',
                         description='Install platform img pkg)',
+                        after=['pkgbase'],
                         pkg='boxes-{steps.imgdef.config[PLATFORM]}',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.pkgimg   = Step('deb.InstallDebPkg',
                         description='Install specific img pkg)',
+                        after=['pkgplatform'],
                         pkg='boxes-{chain.imgname}',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.delpolicy   = Step('fs.RmPath',
                         description='Reenable init.d invokation',
+                        after=['pkgimg'],
                         path='{steps.mount.mountpoint}/usr/sbin/policy-rc.d')
 
 steps.namevmlinuz   = Step('fs.MovePath',
                         description='Rename kernel image to unspecific name',
+                        after=['pkgimg'],
                         source='{steps.mount.mountpoint}/boot/vmlinuz*',
                         destination='{steps.mount.mountpoint}/boot/vmlinuz')
 
 steps.nameinitrd   = Step('fs.MovePath',
                         description='Rename init ramdisk to unspecific name',
+                        after=['pkgimg'],
                         source='{steps.mount.mountpoint}/boot/initrd.img*',
                         destination='{steps.mount.mountpoint}/boot/initrd.img')
 
@@ -246,6 +274,7 @@ steps.nameinitrd   = Step('fs.MovePath',
 
 steps.defaultsh   = Step('syscall.ChrootedSystemCall',
                         description='Use zsh as default shell',
+                        after=['delpolicy'],
                         command='chsh -s /usr/bin/zsh root',
                         chrootdir='{steps.mount.mountpoint}')
 
@@ -253,35 +282,47 @@ steps.defaultsh   = Step('syscall.ChrootedSystemCall',
 
 steps.genicse   = Step('syscall.ChrootedSystemCall',
                         description='Generate generic icse conf',
+                        after=['defaultsh'],
                         command='/etc/init.d/genicseconf',
                         chrootdir='{steps.mount.mountpoint}')
 
 steps.cleantaco   = Step('fs.RmPath',
                         description='Remove superfluent taco stuff',
+                        after=['genicse'],
                         path='{steps.mount.mountpoint}/opt/taco/share/taco/dbase/res/TEST')
 
 steps.disdynmotd   = Step('syscall.ChrootedSystemCall',
                         description='Disable dynamic motd generation',
+                        after=['genicse'],
                         command='update-rc.d motd remove',
                         chrootdir='{steps.mount.mountpoint}')
 
 # TODO: create proper motd with all neccessary info (build time etc)
 steps.motd   = Step('fs.WriteFile',
                         description='Create motd',
+                        after=['disdynmotd'],
                         path='{steps.mount.mountpoint}/etc/motd',
                         append=True,
                         content=MOTD)
 
 steps.umount   = Step('generic.TriggerCleanup',
                         description='Unmount first image partition',
+                        after=['delpolicy',
+                               'namevmlinuz',
+                               'nameinitrd',
+                               'cleantaco',
+                               'motd'],
                         step='mount')
 
-steps.duppart   = Step('syscall.SystemCall',
+steps.duppart   = Step('fs.BlockCopy',
                         description='Dupilcate root partition',
-                        command='dcfldd if={steps.devmap.mapped[0]} of={steps.devmap.mapped[1]}')
+                        after=['umount'],
+                        source='{steps.devmap.mapped[0]}',
+                        destination='{steps.devmap.mapped[1]}')
 
 steps.mount2   = Step('fs.Mount',
                         description='Mount second image partition',
+                        after=['duppart'],
                         dev='{steps.devmap.mapped[1]}',
                         mountpoint='{steps.tmpdir.tmpdir}/mount2')
 
@@ -292,18 +333,23 @@ steps.fixfstab   = Step('syscall.ChrootedSystemCall',
 
 steps.umount2   = Step('generic.TriggerCleanup',
                         description='Unmount second image partition',
+                        after=['fixfstab'],
                         step='mount2')
 
-steps.partimg   = Step('syscall.SystemCall',
+steps.partimg   = Step('fs.BlockCopy',
                         description='Create part img file',
-                        command='dcfldd if={steps.devmap.mapped[0]} of=%s' % IMGFILE_PART)
+                        after=['umount'],
+                        source='{steps.devmap.mapped[0]}',
+                        destination=IMGFILE_PART)
 
 steps.unmap   = Step('generic.TriggerCleanup',
                         description='Unmap devices',
+                        after=['umount2', 'partimg'],
                         step='devmap')
 
 steps.mvtooutdir   = Step('fs.MovePath',
                         description='Move image files to output dir',
+                        after=['unmap'],
                         source='{steps.tmpdir.tmpdir}/%s.*.img' % IMGFILE_TARGET,
                         destination='{chain.outdir}')
 